@@ -8,157 +8,158 @@ Returns: HTTP response dict with settings data
 import json
 import os
 from typing import Dict, Any
-import psycopg2
 from psycopg2.extras import RealDictCursor
+from shared import aio, db, ledger, metrics, reconcile, response, rollups, settings, wallet_summary
 
+_SETTINGS = db.Prepared(
+    'admin_settings',
+    'SELECT id, key, value, description, created_at, updated_at FROM platform_settings ORDER BY key'
+)
+
+# Reads served from the replica when it is fresh enough; a settings PUT
+# sends this instance (and a client echoing X-Write-Timestamp) back to the
+# primary until it has replayed.
+READ_ONLY_ACTIONS = ('get_commission_report', 'get_earnings_report')
+SETTINGS_WRITES = 'platform_settings'
+
+
+def earnings_report(db_url: str, body_data: Dict[str, Any], event: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        query = rollups.parse_range(body_data)
+    except ValueError as e:
+        return response.error(400, str(e))
+    report_args = (query['granularity'], query['from'], query['to'])
+    report_options = {'author_id': query['author_id'], 'by_author': bool(body_data.get('by_author'))}
+    if aio.enabled():
+        dsn = db.read_dsn(db_url, SETTINGS_WRITES, event)
+        report = aio.run(rollups.report_async(*report_args, dsn=dsn, **report_options))
+    else:
+        with db.read_connection(db_url, SETTINGS_WRITES, event) as conn:
+            report = rollups.report(conn, *report_args, **report_options)
+    return response.json_response(200, report, event)
+
+
+@metrics.instrumented('admin')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Admin-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+        return response.preflight(
+            'GET, POST, PUT, OPTIONS', f'Content-Type, X-Admin-Token, If-None-Match, Idempotency-Key, {db.WRITE_HEADER}'
+        )
     
     db_url = os.environ.get('DATABASE_URL')
     if not db_url:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Database not configured'})
-        }
+        return response.error(500, 'Database not configured')
     
-    conn = psycopg2.connect(db_url)
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    body_data = json.loads(event.get('body', '{}')) if method in ('PUT', 'POST') else {}
+    if method == 'POST' and body_data.get('action') == 'get_earnings_report':
+        return earnings_report(db_url, body_data, event)
+    if method == 'GET' or body_data.get('action') in READ_ONLY_ACTIONS:
+        borrow = db.read_connection(db_url, SETTINGS_WRITES, event)
+    else:
+        borrow = db.connection(db_url)
     
-    if method == 'GET':
-        cursor.execute("SELECT * FROM platform_settings ORDER BY key")
-        settings = cursor.fetchall()
-        
-        result = {}
-        for setting in settings:
-            if 'created_at' in setting and setting['created_at']:
-                setting['created_at'] = setting['created_at'].isoformat()
-            if 'updated_at' in setting and setting['updated_at']:
-                setting['updated_at'] = setting['updated_at'].isoformat()
-            result[setting['key']] = setting
-        
-        cursor.close()
-        conn.close()
+    with borrow as conn:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+    
+        if method == 'GET':
+            _SETTINGS.execute(cursor)
+            result = {setting['key']: setting for setting in cursor.fetchall()}
+            cursor.close()
         
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'isBase64Encoded': False,
-            'body': json.dumps({'settings': result})
-        }
+            return response.json_response(200, {'settings': result}, event)
     
-    if method == 'PUT':
-        body_data = json.loads(event.get('body', '{}'))
-        key = body_data.get('key')
-        value = body_data.get('value')
+        if method == 'PUT':
+            key = body_data.get('key')
+            value = body_data.get('value')
         
-        if not key or value is None:
-            cursor.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Key and value required'})
-            }
+            if not key or value is None:
+                cursor.close()
+                return response.error(400, 'Key and value required')
         
-        try:
-            cursor.execute(
-                """UPDATE platform_settings 
-                   SET value = %s, updated_at = CURRENT_TIMESTAMP 
-                   WHERE key = %s
-                   RETURNING *""",
-                (str(value), key)
-            )
-            updated = cursor.fetchone()
-            
-            if not updated:
+            try:
                 cursor.execute(
-                    """INSERT INTO platform_settings (key, value, description)
-                       VALUES (%s, %s, %s) RETURNING *""",
-                    (key, str(value), body_data.get('description', ''))
+                    """UPDATE platform_settings 
+                       SET value = %s, updated_at = CURRENT_TIMESTAMP 
+                       WHERE key = %s
+                       RETURNING *""",
+                    (str(value), key)
                 )
                 updated = cursor.fetchone()
             
-            conn.commit()
-            
-            if 'created_at' in updated and updated['created_at']:
-                updated['created_at'] = updated['created_at'].isoformat()
-            if 'updated_at' in updated and updated['updated_at']:
-                updated['updated_at'] = updated['updated_at'].isoformat()
+                if not updated:
+                    cursor.execute(
+                        """INSERT INTO platform_settings (key, value, description)
+                           VALUES (%s, %s, %s) RETURNING *""",
+                        (key, str(value), body_data.get('description', ''))
+                    )
+                    updated = cursor.fetchone()
             
-            cursor.close()
-            conn.close()
+                settings.notify_changed(cursor, key)
+                conn.commit()
+                settings.invalidate()
+                cursor.close()
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'isBase64Encoded': False,
-                'body': json.dumps(dict(updated))
-            }
+                return db.note_write(SETTINGS_WRITES, response.json_response(200, updated))
             
-        except Exception as e:
-            conn.rollback()
-            cursor.close()
-            conn.close()
-            return {
-                'statusCode': 500,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': str(e)})
-            }
+            except Exception as e:
+                conn.rollback()
+                cursor.close()
+                return response.error(500, str(e))
     
-    if method == 'POST':
-        body_data = json.loads(event.get('body', '{}'))
-        action = body_data.get('action')
+        if method == 'POST':
+            action = body_data.get('action')
         
-        if action == 'get_commission_report':
-            cursor.execute(
-                """SELECT 
-                       SUM(CASE WHEN recipient_type = 'platform' THEN amount ELSE 0 END) as platform_total,
-                       SUM(CASE WHEN recipient_type = 'author' THEN amount ELSE 0 END) as authors_total,
-                       COUNT(DISTINCT transaction_id) as total_transactions
-                   FROM commission_splits
-                   WHERE status = %s""",
-                ('completed',)
-            )
-            report = cursor.fetchone()
+            if action == 'get_commission_report':
+                report = rollups.totals(conn)
             
-            cursor.execute(
-                "SELECT value FROM platform_settings WHERE key = %s",
-                ('platform_owner_account',)
-            )
-            owner_account = cursor.fetchone()
+                owner_account = settings.get(conn, 'platform_owner_account', '')
             
-            cursor.close()
-            conn.close()
+                cursor.close()
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'isBase64Encoded': False,
-                'body': json.dumps({
+                return response.json_response(200, {
                     'platform_earnings': float(report['platform_total'] or 0),
                     'authors_earnings': float(report['authors_total'] or 0),
                     'total_transactions': report['total_transactions'],
-                    'owner_account': owner_account['value'] if owner_account else ''
+                    'owner_account': owner_account
                 })
-            }
-    
-    cursor.close()
-    conn.close()
-    return {
-        'statusCode': 405,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'error': 'Method not allowed'})
-    }
+
+            if action == 'check_wallet_summaries':
+                cursor.close()
+                result = wallet_summary.check(conn, int(body_data.get('limit', 100)))
+                return response.json_response(200, result, event)
+
+            if action == 'settle_earnings':
+                cursor.close()
+                result = ledger.settle(
+                    conn,
+                    int(body_data.get('batch_size', ledger.SETTLE_BATCH_SIZE)),
+                    max_batches=int(body_data.get('max_batches', 20))
+                )
+                result['backlog'] = ledger.pending(conn)
+                return response.json_response(200, result)
+
+            if action == 'reconcile_wallets':
+                cursor.close()
+                result = reconcile.reconcile(
+                    conn,
+                    body_data.get('from_wallet_id'),
+                    body_data.get('to_wallet_id'),
+                    max_samples=int(body_data.get('max_samples', reconcile.MAX_SAMPLES))
+                )
+                return response.json_response(200, result)
+
+            if action == 'get_query_metrics':
+                cursor.close()
+                metrics.flush(db_url, force=True)
+                result = metrics.report(
+                    conn,
+                    minutes=int(body_data.get('minutes', 60)),
+                    function=body_data.get('function'),
+                    limit=int(body_data.get('limit', 50))
+                )
+                return response.json_response(200, result, event)
+
+        cursor.close()
+        return response.error(405, 'Method not allowed')
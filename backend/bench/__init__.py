@@ -0,0 +1,3 @@
+'''
+Local benchmarks for the backend functions.
+'''
@@ -0,0 +1,111 @@
+'''
+Business: Compare the synchronous and the pipelined (DB_ASYNC=1) handler paths
+Args: --carts N, --items K, --reports R, --threads T
+Returns: JSON with latency and throughput for cart checkout and the
+         by-author earnings report, sync vs async
+
+Both variants go through the real handler(event, context) entry points,
+so pooling, metrics and response encoding are included. The gain grows
+with the network round-trip time to the database; against a local socket
+it mostly shows the saved statement latency.
+
+Usage: BENCH_DATABASE_URL=postgresql://localhost/comics_bench \
+       python -m bench.async_pipeline --carts 1000 --items 5 --threads 8
+'''
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Dict, Any, List, Callable
+
+from bench import common
+
+
+def run_variant(call: Callable[[Dict[str, Any]], int], events: List[Dict[str, Any]],
+                threads: int) -> Dict[str, Any]:
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+    lock = threading.Lock()
+
+    def timed(event: Dict[str, Any]) -> None:
+        started = time.perf_counter()
+        status = call(event)
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(timed, events))
+    summary = common.summarize(latencies, time.perf_counter() - started, [])
+    del summary['round_trips_per_request']
+    summary['statuses'] = statuses
+    return summary
+
+
+def cart_events(ids: Dict[str, List[int]], count: int, items: int, rng: random.Random) -> List[Dict[str, Any]]:
+    '''Each cart goes to a distinct reader, so no two carts conflict.'''
+    events = []
+    for user_id in ids['readers'][:count]:
+        body = {'user_id': user_id, 'work_ids': rng.sample(ids['works'], items), 'payment_method': 'balance'}
+        events.append({'httpMethod': 'POST', 'body': json.dumps(body), 'headers': {}})
+    return events
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--carts', type=int, default=1000)
+    parser.add_argument('--items', type=int, default=5)
+    parser.add_argument('--reports', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--works', type=int, default=500)
+    parser.add_argument('--authors', type=int, default=50)
+    args = parser.parse_args()
+
+    from shared import aio
+    if not aio.available():
+        raise SystemExit('psycopg 3 is not installed: pip install "psycopg[binary]" psycopg-pool')
+
+    dsn = common.bench_dsn()
+    common.reset_schema(dsn)
+    ids = common.seed(dsn, readers=2 * args.carts, authors=args.authors, works=args.works)
+    os.environ['DATABASE_URL'] = dsn
+    os.environ.setdefault('DB_POOL_MAX_SIZE', str(args.threads))
+
+    payment = common.load_function('payment').handler
+    admin = common.load_function('admin').handler
+    context = SimpleNamespace(request_id='bench', function_name='bench')
+
+    def call(handler: Callable[..., Dict[str, Any]]) -> Callable[[Dict[str, Any]], int]:
+        return lambda event: handler(event, SimpleNamespace(**{**vars(context), 'request_id': str(uuid.uuid4())}))['statusCode']
+
+    rng = random.Random(3)
+    carts = cart_events(ids, 2 * args.carts, args.items, rng)
+    report_body = json.dumps({'action': 'get_earnings_report', 'granularity': 'hour', 'by_author': True})
+    reports = [{'httpMethod': 'POST', 'body': report_body, 'headers': {}}] * args.reports
+
+    results: Dict[str, Any] = {}
+    for variant, flag, cart_slice in (('sync', '0', carts[:args.carts]), ('async', '1', carts[args.carts:])):
+        os.environ['DB_ASYNC'] = flag
+        results[variant] = {
+            'cart_checkout': run_variant(call(payment), cart_slice, args.threads),
+            'earnings_report': run_variant(call(admin), reports, args.threads),
+        }
+
+    for scenario in ('cart_checkout', 'earnings_report'):
+        before = results['sync'][scenario]['latency_ms']['p50']
+        after = results['async'][scenario]['latency_ms']['p50']
+        results.setdefault('p50_change_pct', {})[scenario] = round((after - before) * 100 / before, 1) if before else None
+
+    print(json.dumps({'config': vars(args), 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
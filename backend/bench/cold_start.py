@@ -0,0 +1,124 @@
+'''
+Business: Time cold and warm starts of the payment, wallet and admin handlers
+Args: --starts N (fresh instances per handler), --warm W (requests after the first)
+Returns: JSON with import time, first-request and warm-request latency per
+         handler, with prepared statements on and off (DB_PREPARE)
+
+Every start is a new Python process, like a cold function instance: it
+times importing backend/<name>/index.py, then the first request (which
+opens the pooled connection, prepares the hot statements and loads the
+settings cache), then W warm requests on the same instance. The child
+imports nothing but the handler before the clock stops, so import time
+includes psycopg2 and shared.*.
+
+Usage: BENCH_DATABASE_URL=postgresql://localhost/comics_bench \
+       python -m bench.cold_start --starts 20 --warm 200
+'''
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, Any, List
+import psycopg2
+
+from bench import common
+
+FUNCTIONS = ('payment', 'wallet', 'admin')
+MODES = (('prepared', '1'), ('unprepared', '0'))
+
+_CHILD = r'''
+import importlib.util, sys, time
+from types import SimpleNamespace
+name, raw_events = sys.argv[1], sys.stdin.read()
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location('index', name + '/index.py')
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+import_ms = (time.perf_counter() - started) * 1000
+import json
+timings = []
+for i, event in enumerate(json.loads(raw_events)):
+    started = time.perf_counter()
+    result = module.handler(event, SimpleNamespace(request_id=f'cold-{i}', function_name=name))
+    timings.append((time.perf_counter() - started) * 1000)
+    if result['statusCode'] >= 400:
+        sys.exit(f"{name}: HTTP {result['statusCode']}: {result['body']}")
+print(json.dumps({'import_ms': import_ms, 'first_ms': timings[0], 'warm_ms': timings[1:]}))
+'''
+
+
+def events(name: str, reader_id: int, works: List[int], prices: Dict[int, Any], count: int) -> List[Dict[str, Any]]:
+    if name == 'payment':
+        return [
+            {'httpMethod': 'POST', 'headers': {}, 'body': json.dumps({
+                'user_id': reader_id, 'work_id': work_id, 'amount': float(prices[work_id]),
+                'payment_method': 'balance',
+            })}
+            for work_id in works[:count]
+        ]
+    if name == 'wallet':
+        return [{'httpMethod': 'GET', 'queryStringParameters': {'user_id': str(reader_id)}, 'headers': {}}] * count
+    return [{'httpMethod': 'GET', 'headers': {}}] * count
+
+
+def start(dsn: str, name: str, prepare: str, batch: List[Dict[str, Any]]) -> Dict[str, Any]:
+    '''One cold instance: returns its import, first and warm request timings.'''
+    env = {**os.environ, 'DATABASE_URL': dsn, 'DB_PREPARE': prepare}
+    child = subprocess.run(
+        [sys.executable, '-c', _CHILD, name], input=json.dumps(batch), cwd=common.BACKEND_DIR,
+        env=env, capture_output=True, text=True
+    )
+    if child.returncode != 0:
+        raise SystemExit(child.stderr.strip() or f'{name} exited with {child.returncode}')
+    # The handlers log one JSON line per request; the timings come last.
+    return json.loads(child.stdout.strip().splitlines()[-1])
+
+
+def summarize_ms(values: List[float]) -> Dict[str, float]:
+    ordered = sorted(values)
+    return {
+        'mean': round(statistics.fmean(ordered), 2) if ordered else 0.0,
+        'p50': round(common.percentile(ordered, 50), 2),
+        'p95': round(common.percentile(ordered, 95), 2),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--starts', type=int, default=20)
+    parser.add_argument('--warm', type=int, default=200)
+    args = parser.parse_args()
+
+    dsn = common.bench_dsn()
+    common.reset_schema(dsn)
+    ids = common.seed(dsn, readers=args.starts * len(MODES), authors=20, works=args.warm + 1,
+                      reader_balance=1_000_000)
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT id, price FROM works')
+            prices = dict(cursor.fetchall())
+    finally:
+        conn.close()
+
+    report: Dict[str, Any] = {}
+    for name in FUNCTIONS:
+        report[name] = {}
+        for index, (mode, prepare) in enumerate(MODES):
+            readers = ids['readers'][index * args.starts:(index + 1) * args.starts]
+            runs = [start(dsn, name, prepare, events(name, reader_id, ids['works'], prices, args.warm + 1))
+                    for reader_id in readers]
+            report[name][mode] = {
+                'import_ms': summarize_ms([run['import_ms'] for run in runs]),
+                'first_request_ms': summarize_ms([run['first_ms'] for run in runs]),
+                'warm_request_ms': summarize_ms([ms for run in runs for ms in run['warm_ms']]),
+            }
+
+    print(json.dumps({'config': vars(args), 'handlers': report}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+'''
+Business: Shared setup for backend benchmarks against a local Postgres
+Args: BENCH_DATABASE_URL - DSN of a throwaway database; it is wiped on reset
+Returns: schema/seed helpers, round-trip counting and latency summaries
+
+Run benchmarks from backend/, e.g. python -m bench.purchase_roundtrips.
+'''
+
+import importlib.util
+import os
+import random
+import statistics
+import sys
+import threading
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+import psycopg2
+import psycopg2.extensions
+from psycopg2.extras import wait_select
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+MIGRATIONS_DIR = BACKEND_DIR.parent / 'db_migrations'
+
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
+
+
+def bench_dsn() -> str:
+    dsn = os.environ.get('BENCH_DATABASE_URL')
+    if not dsn:
+        sys.exit('BENCH_DATABASE_URL is required (a local database that may be wiped)')
+    return dsn
+
+
+def load_function(name: str) -> Any:
+    '''Import backend/<name>/index.py as a module without touching sys.modules['index'].'''
+    spec = importlib.util.spec_from_file_location(f'{name}_index', BACKEND_DIR / name / 'index.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def reset_schema(dsn: str) -> None:
+    '''Drop everything in the public schema and apply db_migrations in order.'''
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('DROP SCHEMA public CASCADE')
+            cursor.execute('CREATE SCHEMA public')
+            for path in sorted(MIGRATIONS_DIR.glob('V*.sql')):
+                cursor.execute(path.read_text(encoding='utf-8'))
+    finally:
+        conn.close()
+
+
+def seed(dsn: str, readers: int, authors: int, works: int, reader_balance: float = 0,
+         author_balance: float = 0, rng: Optional[random.Random] = None) -> Dict[str, List[int]]:
+    '''Create reader/author users with RUB wallets and works with random prices.'''
+    rng = rng or random.Random(42)
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """INSERT INTO users (email, name, password_hash, role)
+                   SELECT 'author' || i || '@bench.local', 'Author ' || i, 'x', 'author'
+                   FROM generate_series(1, %s) i
+                   RETURNING id""",
+                (authors,)
+            )
+            author_ids = [row[0] for row in cursor.fetchall()]
+            cursor.execute(
+                """INSERT INTO users (email, name, password_hash, role)
+                   SELECT 'reader' || i || '@bench.local', 'Reader ' || i, 'x', 'reader'
+                   FROM generate_series(1, %s) i
+                   RETURNING id""",
+                (readers,)
+            )
+            reader_ids = [row[0] for row in cursor.fetchall()]
+            cursor.execute(
+                """INSERT INTO wallets (user_id, balance, currency)
+                   SELECT id, CASE WHEN role = 'reader' THEN %s ELSE %s END, 'RUB' FROM users""",
+                (reader_balance, author_balance)
+            )
+            work_rows = [
+                (rng.choice(author_ids), f'Work {i}', 'published', True, rng.choice([49, 99, 149, 299]))
+                for i in range(works)
+            ]
+            cursor.execute(
+                f"""INSERT INTO works (author_id, title, status, is_premium, price)
+                    VALUES {', '.join(['(%s, %s, %s, %s, %s)'] * len(work_rows))}
+                    RETURNING id""",
+                [value for row in work_rows for value in row]
+            )
+            work_ids = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+    finally:
+        conn.close()
+    return {'readers': reader_ids, 'authors': author_ids, 'works': work_ids}
+
+
+_counter = threading.local()
+
+
+def _counting_wait(conn: Any) -> None:
+    _counter.round_trips = getattr(_counter, 'round_trips', 0) + 1
+    wait_select(conn)
+
+
+def install_round_trip_counter() -> None:
+    '''
+    Route libpq waits through a counting callback. psycopg2 calls the wait
+    callback once per server exchange (query, commit, connect), so the count
+    is the number of network round trips made by the current thread.
+    '''
+    psycopg2.extensions.set_wait_callback(_counting_wait)
+
+
+def round_trips() -> int:
+    return getattr(_counter, 'round_trips', 0)
+
+
+def reset_round_trips() -> None:
+    _counter.round_trips = 0
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+def summarize(latencies: List[float], elapsed: float, trips: List[int]) -> Dict[str, Any]:
+    ordered = sorted(latencies)
+    return {
+        'requests': len(ordered),
+        'throughput_rps': round(len(ordered) / elapsed, 1) if elapsed else 0.0,
+        'latency_ms': {
+            'mean': round(statistics.fmean(ordered) * 1000, 2) if ordered else 0.0,
+            'p50': round(percentile(ordered, 50) * 1000, 2),
+            'p95': round(percentile(ordered, 95) * 1000, 2),
+            'p99': round(percentile(ordered, 99) * 1000, 2),
+        },
+        'round_trips_per_request': round(statistics.fmean(trips), 2) if trips else 0.0,
+    }
@@ -0,0 +1,119 @@
+'''
+Business: Time 50-work ownership checks through the entitlements handler
+Args: --readers N, --works W, --owned K, --checks C, --batch B
+Returns: JSON with cold (first check per reader) and warm latency, plus
+         how many fresh purchases were visible on the very next check
+
+Every reader owns K random works. The cold pass loads each reader's owned
+set; the warm pass repeats random B-work checks, answering owned works
+from memory and works not owned from the set while it is younger than
+ENTITLEMENT_NEGATIVE_TTL. Finally each reader buys one more work through
+the payment handler and is checked right away, echoing the purchase's
+X-Write-Timestamp as the frontend client does.
+
+Usage: BENCH_DATABASE_URL=postgresql://localhost/comics_bench \
+       python -m bench.entitlement_lookup --readers 500 --checks 20000
+'''
+
+import argparse
+import json
+import os
+import random
+import time
+import uuid
+from types import SimpleNamespace
+from typing import Dict, Any, List, Optional
+import psycopg2
+
+from bench import common
+
+
+def seed_purchases(dsn: str, readers: List[int], works: List[int], owned: int, rng: random.Random) -> Dict[int, List[int]]:
+    owned_by = {reader: rng.sample(works, owned) for reader in readers}
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cursor:
+            for reader, work_ids in owned_by.items():
+                cursor.execute(
+                    """WITH bought AS (
+                           SELECT unnest(%s::int[]) AS work_id
+                       ),
+                       inserted AS (
+                           INSERT INTO transactions
+                               (user_id, wallet_id, type, amount, currency, status, payment_method, metadata)
+                           SELECT w.user_id, w.id, 'purchase', 0, 'RUB', 'completed', 'balance',
+                                  jsonb_build_object('work_id', b.work_id)
+                           FROM bought b
+                           JOIN wallets w ON w.user_id = %s AND w.currency = 'RUB'
+                           RETURNING id, (metadata->>'work_id')::int AS work_id
+                       )
+                       INSERT INTO purchases (user_id, work_id, transaction_id, price)
+                       SELECT %s, work_id, id, 0 FROM inserted""",
+                    (work_ids, reader, reader)
+                )
+        conn.commit()
+    finally:
+        conn.close()
+    return owned_by
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--readers', type=int, default=500)
+    parser.add_argument('--works', type=int, default=2000)
+    parser.add_argument('--owned', type=int, default=100)
+    parser.add_argument('--checks', type=int, default=20000)
+    parser.add_argument('--batch', type=int, default=50)
+    args = parser.parse_args()
+
+    rng = random.Random(5)
+    dsn = common.bench_dsn()
+    common.reset_schema(dsn)
+    ids = common.seed(dsn, readers=args.readers, authors=20, works=args.works, reader_balance=10_000)
+    owned_by = seed_purchases(dsn, ids['readers'], ids['works'], args.owned, rng)
+    os.environ['DATABASE_URL'] = dsn
+
+    entitlements = common.load_function('entitlements').handler
+    payment = common.load_function('payment').handler
+
+    def context() -> SimpleNamespace:
+        return SimpleNamespace(request_id=str(uuid.uuid4()), function_name='bench')
+
+    def check(reader: int, work_ids: List[int], headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        params = {'user_id': str(reader), 'work_ids': ','.join(map(str, work_ids))}
+        result = entitlements({'httpMethod': 'GET', 'queryStringParameters': params, 'headers': headers or {}}, context())
+        return json.loads(result['body'])['works']
+
+    def timed(reader: int) -> float:
+        started = time.perf_counter()
+        check(reader, rng.sample(ids['works'], args.batch))
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    cold = [timed(reader) for reader in ids['readers']]
+    cold_elapsed = time.perf_counter() - started
+
+    started = time.perf_counter()
+    warm = [timed(rng.choice(ids['readers'])) for _ in range(args.checks)]
+    warm_elapsed = time.perf_counter() - started
+
+    visible = 0
+    for reader in ids['readers']:
+        work_id = rng.choice([work_id for work_id in ids['works'][:args.owned * 2] if work_id not in owned_by[reader]])
+        body = {'user_id': reader, 'work_id': work_id, 'amount': 1, 'payment_method': 'balance'}
+        bought = payment({'httpMethod': 'POST', 'body': json.dumps(body), 'headers': {}}, context())
+        echoed = {'X-Write-Timestamp': bought['headers']['X-Write-Timestamp']}
+        visible += bool(check(reader, [work_id], echoed)[str(work_id)])
+
+    results = {'cold': common.summarize(cold, cold_elapsed, []), 'warm': common.summarize(warm, warm_elapsed, [])}
+    for summary in results.values():
+        del summary['round_trips_per_request']
+    print(json.dumps({
+        'config': vars(args),
+        'results': results,
+        'purchases_visible_on_next_check': f'{visible}/{len(ids["readers"])}',
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
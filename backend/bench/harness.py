@@ -0,0 +1,295 @@
+'''
+Business: Local load test for the payment, wallet and admin handlers
+Args: --requests N, --workers T, --processes P, --mix scenario=weight,...
+      --save-baseline NAME / --compare NAME
+Returns: JSON report with throughput, p50/p95/p99 latency, DB round trips
+         per request and lock-wait time, per scenario
+
+The handlers are imported from backend/*/index.py and called with synthetic
+events, exactly as the function runtime would, against a local Postgres
+built from db_migrations (BENCH_DATABASE_URL, wiped on every run).
+
+Usage: BENCH_DATABASE_URL=postgresql://localhost/comics_bench \
+       python -m bench.harness --requests 5000 --workers 16 \
+       --mix purchase=40,wallet=35,history=10,withdraw=5,report=5,settings=4,settle=1 \
+       --save-baseline main
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, Any, List, Tuple, Callable
+import psycopg2
+
+from bench import common
+
+BASELINES_DIR = Path(__file__).resolve().parent / 'baselines'
+DEFAULT_MIX = 'purchase=40,wallet=35,history=10,withdraw=5,report=5,settings=4,settle=1'
+LOCK_SAMPLE_INTERVAL = 0.01
+
+
+def parse_mix(value: str) -> Dict[str, int]:
+    mix: Dict[str, int] = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in SCENARIOS:
+            raise SystemExit(f"Unknown scenario {name!r}; choose from {', '.join(SCENARIOS)}")
+        mix[name.strip()] = int(weight or 1)
+    return mix
+
+
+class Workload:
+    '''Builds synthetic events; purchases draw from unique (reader, work) pairs.'''
+
+    def __init__(self, ids: Dict[str, List[int]], prices: Dict[int, Any], seed: int):
+        self.ids = ids
+        self.prices = prices
+        self.rng = random.Random(seed)
+        pairs = [(user_id, work_id) for user_id in ids['readers'] for work_id in ids['works']]
+        self.rng.shuffle(pairs)
+        self._pairs = iter(pairs)
+        self._lock = threading.Lock()
+        self._users = ids['readers'] + ids['authors']
+
+    def _user(self) -> int:
+        return self.rng.choice(self._users)
+
+    def purchase(self) -> Tuple[str, Dict[str, Any]]:
+        with self._lock:
+            user_id, work_id = next(self._pairs)
+        body = {'user_id': user_id, 'work_id': work_id, 'amount': float(self.prices[work_id]),
+                'payment_method': 'balance'}
+        return 'payment', {'httpMethod': 'POST', 'body': json.dumps(body), 'headers': {}}
+
+    def wallet(self) -> Tuple[str, Dict[str, Any]]:
+        return 'wallet', {'httpMethod': 'GET', 'queryStringParameters': {'user_id': str(self._user())},
+                          'headers': {'Accept-Encoding': 'gzip'}}
+
+    def history(self) -> Tuple[str, Dict[str, Any]]:
+        return 'payment', {'httpMethod': 'GET', 'queryStringParameters': {'user_id': str(self._user())},
+                           'headers': {'Accept-Encoding': 'gzip'}}
+
+    def withdraw(self) -> Tuple[str, Dict[str, Any]]:
+        body = {'action': 'withdraw', 'user_id': self.rng.choice(self.ids['authors']), 'amount': 500,
+                'payment_method': 'card', 'payment_details': {'card_number': '4242'}}
+        return 'wallet', {'httpMethod': 'POST', 'body': json.dumps(body), 'headers': {}}
+
+    def report(self) -> Tuple[str, Dict[str, Any]]:
+        body = {'action': 'get_earnings_report', 'granularity': 'hour', 'by_author': True}
+        return 'admin', {'httpMethod': 'POST', 'body': json.dumps(body), 'headers': {}}
+
+    def settings(self) -> Tuple[str, Dict[str, Any]]:
+        return 'admin', {'httpMethod': 'GET', 'headers': {}}
+
+    def settle(self) -> Tuple[str, Dict[str, Any]]:
+        body = {'action': 'settle_earnings', 'max_batches': 1}
+        return 'admin', {'httpMethod': 'POST', 'body': json.dumps(body), 'headers': {}}
+
+
+SCENARIOS: Dict[str, Callable[[Workload], Tuple[str, Dict[str, Any]]]] = {
+    'purchase': Workload.purchase,
+    'wallet': Workload.wallet,
+    'history': Workload.history,
+    'withdraw': Workload.withdraw,
+    'report': Workload.report,
+    'settings': Workload.settings,
+    'settle': Workload.settle,
+}
+
+
+class LockWaitSampler(threading.Thread):
+    '''Samples pg_stat_activity for backends waiting on heavyweight locks.'''
+
+    def __init__(self, dsn: str):
+        super().__init__(daemon=True)
+        self.dsn = dsn
+        self.lock_wait_seconds = 0.0
+        self.peak_waiters = 0
+        self._done = threading.Event()
+
+    def run(self) -> None:
+        conn = psycopg2.connect(self.dsn)
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cursor:
+                while not self._done.wait(LOCK_SAMPLE_INTERVAL):
+                    cursor.execute(
+                        """SELECT count(*) FROM pg_stat_activity
+                           WHERE datname = current_database() AND wait_event_type = 'Lock'"""
+                    )
+                    waiters = cursor.fetchone()[0]
+                    self.lock_wait_seconds += waiters * LOCK_SAMPLE_INTERVAL
+                    self.peak_waiters = max(self.peak_waiters, waiters)
+        finally:
+            conn.close()
+
+    def stop(self) -> None:
+        self._done.set()
+        self.join()
+
+
+def _run_share(args: Tuple[str, Dict[str, Any], Dict[int, Any], List[str], int, int]) -> Dict[str, Any]:
+    '''Drive one process's share of the requests from a thread pool; returns raw samples.'''
+    dsn, ids, prices, plan, workers, seed = args
+    os.environ['DATABASE_URL'] = dsn
+    os.environ.setdefault('DB_POOL_MAX_SIZE', str(workers))
+    handlers = {name: common.load_function(name).handler for name in ('payment', 'wallet', 'admin')}
+    workload = Workload(ids, prices, seed)
+    common.install_round_trip_counter()
+
+    samples: Dict[str, Dict[str, List[Any]]] = {}
+    lock = threading.Lock()
+
+    def call(scenario: str) -> None:
+        function, event = SCENARIOS[scenario](workload)
+        context = SimpleNamespace(request_id=str(uuid.uuid4()), function_name=function)
+        common.reset_round_trips()
+        started = time.perf_counter()
+        try:
+            status = handlers[function](event, context)['statusCode']
+        except Exception:
+            status = 599
+        elapsed = time.perf_counter() - started
+        trips = common.round_trips()
+        with lock:
+            bucket = samples.setdefault(scenario, {'latencies': [], 'trips': [], 'statuses': []})
+            bucket['latencies'].append(elapsed)
+            bucket['trips'].append(trips)
+            bucket['statuses'].append(status)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(call, plan))
+    return samples
+
+
+def run(dsn: str, ids: Dict[str, List[int]], prices: Dict[int, Any], mix: Dict[str, int],
+        requests: int, workers: int, processes: int, seed: int) -> Dict[str, Any]:
+    rng = random.Random(seed)
+    names = list(mix)
+    plan = rng.choices(names, weights=[mix[name] for name in names], k=requests)
+    shares = [plan[i::processes] for i in range(processes)]
+    # Each process must draw purchases from a disjoint slice of (reader, work) pairs.
+    reader_slices = [ids['readers'][i::processes] for i in range(processes)]
+    jobs = [
+        (dsn, {**ids, 'readers': reader_slices[i]}, prices, shares[i], workers, seed + i)
+        for i in range(processes)
+    ]
+
+    sampler = LockWaitSampler(dsn)
+    sampler.start()
+    started = time.perf_counter()
+    if processes == 1:
+        results = [_run_share(jobs[0])]
+    else:
+        with multiprocessing.get_context('spawn').Pool(processes) as pool:
+            results = pool.map(_run_share, jobs)
+    elapsed = time.perf_counter() - started
+    sampler.stop()
+
+    merged: Dict[str, Dict[str, List[Any]]] = {}
+    for result in results:
+        for scenario, bucket in result.items():
+            target = merged.setdefault(scenario, {'latencies': [], 'trips': [], 'statuses': []})
+            for key in target:
+                target[key].extend(bucket[key])
+
+    report: Dict[str, Any] = {'scenarios': {}}
+    all_latencies: List[float] = []
+    all_trips: List[int] = []
+    for scenario, bucket in sorted(merged.items()):
+        summary = common.summarize(bucket['latencies'], elapsed, bucket['trips'])
+        summary['statuses'] = {
+            str(code): count for code, count in sorted(
+                (code, bucket['statuses'].count(code)) for code in set(bucket['statuses'])
+            )
+        }
+        report['scenarios'][scenario] = summary
+        all_latencies.extend(bucket['latencies'])
+        all_trips.extend(bucket['trips'])
+    report['overall'] = common.summarize(all_latencies, elapsed, all_trips)
+    report['overall']['lock_wait_seconds'] = round(sampler.lock_wait_seconds, 3)
+    report['overall']['lock_wait_ms_per_request'] = round(sampler.lock_wait_seconds * 1000 / max(1, requests), 3)
+    report['overall']['peak_lock_waiters'] = sampler.peak_waiters
+    return report
+
+
+def _flatten(report: Dict[str, Any]) -> Dict[str, float]:
+    flat: Dict[str, float] = {}
+    sections = {'overall': report['overall'], **report['scenarios']}
+    for section, metrics in sections.items():
+        for key, value in metrics.items():
+            if isinstance(value, dict):
+                if key == 'statuses':
+                    continue
+                for sub_key, sub_value in value.items():
+                    flat[f'{section}.{key}.{sub_key}'] = sub_value
+            else:
+                flat[f'{section}.{key}'] = value
+    return flat
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    '''Per-metric diff against a saved baseline, as absolute and percent change.'''
+    before, after = _flatten(baseline), _flatten(current)
+    diff: Dict[str, Dict[str, Any]] = {}
+    for key in sorted(set(before) & set(after)):
+        old, new = before[key], after[key]
+        if old == new:
+            continue
+        diff[key] = {
+            'baseline': old,
+            'current': new,
+            'change_pct': round((new - old) * 100 / old, 1) if old else None,
+        }
+    return diff
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=16, help='threads per process')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--readers', type=int, default=2000)
+    parser.add_argument('--authors', type=int, default=50)
+    parser.add_argument('--works', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save-baseline', metavar='NAME')
+    parser.add_argument('--compare', metavar='NAME')
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    dsn = common.bench_dsn()
+    common.reset_schema(dsn)
+    ids = common.seed(dsn, readers=args.readers, authors=args.authors, works=args.works,
+                      author_balance=10_000_000)
+
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT id, price FROM works')
+        prices = dict(cursor.fetchall())
+    conn.close()
+
+    report = run(dsn, ids, prices, mix, args.requests, args.workers, args.processes, args.seed)
+    report['config'] = {key: value for key, value in vars(args).items() if key not in ('save_baseline', 'compare')}
+
+    if args.compare:
+        baseline = json.loads((BASELINES_DIR / f'{args.compare}.json').read_text())
+        report['diff'] = compare(baseline, report)
+    if args.save_baseline:
+        BASELINES_DIR.mkdir(exist_ok=True)
+        (BASELINES_DIR / f'{args.save_baseline}.json').write_text(json.dumps(report, indent=2))
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+'''
+Business: Compare the statement-by-statement purchase with purchase_work()
+Args: --purchases N, --threads T, --authors A (fewer authors = hotter wallets)
+Returns: JSON with latency, throughput and round trips for both variants
+
+Usage: BENCH_DATABASE_URL=postgresql://localhost/comics_bench \
+       python -m bench.purchase_roundtrips --purchases 2000 --threads 8
+'''
+
+import argparse
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Tuple, Callable
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from bench import common
+
+
+def legacy_purchase(conn: Any, user_id: int, work_id: int, amount: Any, payment_method: str) -> Dict[str, Any]:
+    '''The purchase as payment.handler ran it before purchase_work(): one statement per step.'''
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    cursor.execute("SELECT id, author_id, price FROM works WHERE id = %s", (work_id,))
+    work = cursor.fetchone()
+    cursor.execute("SELECT id FROM wallets WHERE user_id = %s AND currency = %s", (user_id, 'RUB'))
+    wallet = cursor.fetchone()
+    if not wallet:
+        cursor.execute(
+            "INSERT INTO wallets (user_id, balance, currency) VALUES (%s, %s, %s) RETURNING id",
+            (user_id, 0, 'RUB')
+        )
+        wallet = {'id': cursor.fetchone()['id']}
+    cursor.execute(
+        """INSERT INTO transactions
+           (user_id, wallet_id, type, amount, currency, status, payment_method, description)
+           VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id""",
+        (user_id, wallet['id'], 'purchase', amount, 'RUB', 'completed', payment_method, f'Purchase work #{work_id}')
+    )
+    transaction_id = cursor.fetchone()['id']
+    cursor.execute("SELECT value FROM platform_settings WHERE key = %s", ('platform_commission_percentage',))
+    platform_commission = float(cursor.fetchone()['value']) / 100
+    platform_amount = float(amount) * platform_commission
+    author_amount = float(amount) * (1 - platform_commission)
+    cursor.execute(
+        """INSERT INTO commission_splits (transaction_id, recipient_type, recipient_id, amount, percentage, status)
+           VALUES (%s, %s, %s, %s, %s, %s)""",
+        (transaction_id, 'platform', None, platform_amount, platform_commission * 100, 'completed')
+    )
+    cursor.execute(
+        """INSERT INTO commission_splits (transaction_id, recipient_type, recipient_id, amount, percentage, status)
+           VALUES (%s, %s, %s, %s, %s, %s)""",
+        (transaction_id, 'author', work['author_id'], author_amount, (1 - platform_commission) * 100, 'completed')
+    )
+    cursor.execute(
+        "UPDATE wallets SET balance = balance + %s WHERE user_id = %s AND currency = %s",
+        (author_amount, work['author_id'], 'RUB')
+    )
+    cursor.execute(
+        """INSERT INTO purchases (user_id, work_id, transaction_id, price)
+           VALUES (%s, %s, %s, %s) RETURNING id""",
+        (user_id, work_id, transaction_id, amount)
+    )
+    purchase_id = cursor.fetchone()['id']
+    conn.commit()
+    cursor.close()
+    return {'transaction_id': transaction_id, 'purchase_id': purchase_id}
+
+
+def run_variant(dsn: str, purchase: Callable[..., Dict[str, Any]], jobs: List[Tuple[int, int, int]],
+                threads: int) -> Dict[str, Any]:
+    local = threading.local()
+    connections: List[Any] = []
+    lock = threading.Lock()
+    latencies: List[float] = []
+    trips: List[int] = []
+
+    def worker(job: Tuple[int, int, int]) -> None:
+        conn = getattr(local, 'conn', None)
+        if conn is None:
+            conn = local.conn = psycopg2.connect(dsn)
+            with lock:
+                connections.append(conn)
+        user_id, work_id, price = job
+        common.reset_round_trips()
+        started = time.perf_counter()
+        purchase(conn, user_id, work_id, price, 'balance')
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            trips.append(common.round_trips())
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(worker, jobs))
+    elapsed = time.perf_counter() - started
+    for conn in connections:
+        conn.close()
+    return common.summarize(latencies, elapsed, trips)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--purchases', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--authors', type=int, default=20)
+    parser.add_argument('--works', type=int, default=500)
+    args = parser.parse_args()
+
+    dsn = common.bench_dsn()
+    common.reset_schema(dsn)
+    readers = max(1, args.purchases * 2 // args.works + 1)
+    ids = common.seed(dsn, readers=readers, authors=args.authors, works=args.works)
+
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT id, price FROM works')
+        prices = dict(cursor.fetchall())
+    conn.close()
+
+    rng = random.Random(7)
+    pairs = [(user_id, work_id) for user_id in ids['readers'] for work_id in ids['works']]
+    rng.shuffle(pairs)
+    if len(pairs) < 2 * args.purchases:
+        raise SystemExit('Not enough distinct (reader, work) pairs; raise --works')
+    jobs = [(user_id, work_id, prices[work_id]) for user_id, work_id in pairs[:2 * args.purchases]]
+
+    payment = common.load_function('payment')
+    common.install_round_trip_counter()
+    results = {
+        'legacy': run_variant(dsn, legacy_purchase, jobs[:args.purchases], args.threads),
+        'purchase_work': run_variant(dsn, payment.purchase_single, jobs[args.purchases:], args.threads),
+    }
+    print(json.dumps({'config': vars(args), 'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
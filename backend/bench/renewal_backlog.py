@@ -0,0 +1,127 @@
+'''
+Business: Time the renewal job over a month-end backlog of subscriptions
+Args: --subscriptions N, --subscribers S, --authors A, --chunk-size C, --broke-pct P
+Returns: JSON with elapsed time, throughput and a consistency check
+
+Seeds N due subscriptions spread over S subscribers, P percent of whom
+cannot afford their renewals, then runs shared.renewals with
+--max-chunks 1 once (to leave a checkpoint behind, as a crash would) and
+again to resume and finish. The check verifies that money debited from
+subscribers equals the renewal transactions, the author splits equal the
+earnings ledger, and no due subscription is left unprocessed.
+
+Usage: BENCH_DATABASE_URL=postgresql://localhost/comics_bench \
+       python -m bench.renewal_backlog --subscriptions 200000 --subscribers 50000
+'''
+
+import argparse
+import json
+import time
+from typing import Dict, Any
+import psycopg2
+
+from bench import common
+
+STARTING_BALANCE = 10_000
+PRICE = 199
+
+
+def seed_subscriptions(dsn: str, subscriptions: int, subscribers: int, authors: int, broke_pct: int) -> None:
+    ids = common.seed(dsn, readers=subscribers, authors=authors, works=1,
+                      reader_balance=STARTING_BALANCE, author_balance=0)
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                'UPDATE wallets SET balance = 0 WHERE user_id = ANY(%s) AND user_id %% 100 < %s',
+                (ids['readers'], broke_pct)
+            )
+            cursor.execute(
+                """WITH readers AS (
+                       SELECT id, row_number() OVER (ORDER BY id) - 1 AS n FROM users WHERE id = ANY(%s)
+                   ),
+                   writers AS (
+                       SELECT id, row_number() OVER (ORDER BY id) - 1 AS n FROM users WHERE id = ANY(%s)
+                   )
+                   INSERT INTO subscriptions (subscriber_id, author_id, plan_type, price, status, expires_at, auto_renew)
+                   SELECT r.id, w.id, 'monthly', %s, 'active', LOCALTIMESTAMP - interval '1 hour', true
+                   FROM generate_series(1, %s) i
+                   JOIN readers r ON r.n = i %% %s
+                   JOIN writers w ON w.n = i %% %s""",
+                (ids['readers'], ids['authors'], PRICE, subscriptions, subscribers, authors)
+            )
+        conn.commit()
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute('VACUUM ANALYZE subscriptions')
+            cursor.execute('VACUUM ANALYZE wallets')
+    finally:
+        conn.close()
+
+
+def check(dsn: str) -> Dict[str, Any]:
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """SELECT
+                       (SELECT COALESCE(SUM(%s - w.balance), 0)::float FROM wallets w
+                        JOIN users u ON u.id = w.user_id
+                        WHERE u.role = 'reader' AND w.balance > 0),
+                       (SELECT COALESCE(SUM(amount), 0)::float FROM transactions WHERE type = 'subscription'),
+                       (SELECT COALESCE(SUM(amount), 0)::float FROM commission_splits WHERE recipient_type = 'author'),
+                       (SELECT COALESCE(SUM(author_amount), 0)::float FROM earnings_ledger),
+                       (SELECT COUNT(*) FROM subscriptions
+                        WHERE auto_renew AND status = 'active' AND expires_at <= LOCALTIMESTAMP),
+                       (SELECT COUNT(*) FROM subscriptions WHERE status = 'past_due'),
+                       (SELECT COUNT(*) FROM renewal_runs WHERE status = 'completed')""",
+                (STARTING_BALANCE,)
+            )
+            debited, charged, author_splits, ledger_total, still_due, past_due, runs = cursor.fetchone()
+    finally:
+        conn.close()
+    return {
+        'debited': debited,
+        'charged': charged,
+        'past_due': past_due,
+        'still_due': still_due,
+        'completed_runs': runs,
+        'consistent': abs(debited - charged) < 0.01 and abs(author_splits - ledger_total) < 0.01
+                      and still_due == 0 and runs == 1,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--subscriptions', type=int, default=200_000)
+    parser.add_argument('--subscribers', type=int, default=50_000)
+    parser.add_argument('--authors', type=int, default=2000)
+    parser.add_argument('--chunk-size', type=int, default=2000)
+    parser.add_argument('--broke-pct', type=int, default=5, help='percent of subscribers with an empty wallet')
+    args = parser.parse_args()
+
+    dsn = common.bench_dsn()
+    common.reset_schema(dsn)
+    seed_subscriptions(dsn, args.subscriptions, args.subscribers, args.authors, args.broke_pct)
+
+    from shared import renewals
+    conn = psycopg2.connect(dsn)
+    try:
+        started = time.perf_counter()
+        interrupted = renewals.renew(conn, args.chunk_size, max_chunks=1)
+        resumed = renewals.renew(conn, args.chunk_size)
+        elapsed = time.perf_counter() - started
+    finally:
+        conn.close()
+
+    print(json.dumps({
+        'config': vars(args),
+        'elapsed_seconds': round(elapsed, 2),
+        'throughput_per_second': round(args.subscriptions / elapsed, 1) if elapsed else 0.0,
+        'runs': [interrupted, resumed],
+        'check': check(dsn),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,4 @@
+#!/bin/bash
+# Let the replica container stream WAL from the primary.
+set -e
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
@@ -0,0 +1,114 @@
+'''
+Business: Compare per-view UPDATE works against buffered counters
+Args: --views N, --works W (hot titles), --threads T
+Returns: JSON with throughput, latency and WAL bytes per variant, and
+         whether the merged counts match the events sent
+
+The direct variant runs one UPDATE works SET views = views + 1 per view,
+as a naive endpoint would; every thread queues on the same few rows. The
+buffered variant posts the same views through the counters handler,
+which stages them in work_counter_deltas, then runs a final merge.
+
+Usage: BENCH_DATABASE_URL=postgresql://localhost/comics_bench \
+       python -m bench.view_counters --views 50000 --works 5 --threads 16
+'''
+
+import argparse
+import json
+import os
+import random
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Dict, Any, List, Callable
+import psycopg2
+
+from bench import common
+
+
+def wal_lsn(dsn: str) -> int:
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_current_wal_lsn() - '0/0'::pg_lsn")
+            return int(cursor.fetchone()[0])
+    finally:
+        conn.close()
+
+
+def total_views(dsn: str, work_ids: List[int]) -> int:
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT COALESCE(SUM(views), 0) FROM works WHERE id = ANY(%s)', (work_ids,))
+            return int(cursor.fetchone()[0])
+    finally:
+        conn.close()
+
+
+def run_variant(dsn: str, call: Callable[[int], None], work_ids: List[int], views: int, threads: int) -> Dict[str, Any]:
+    latencies: List[float] = []
+    rng = random.Random(11)
+    targets = [rng.choice(work_ids) for _ in range(views)]
+
+    def timed(work_id: int) -> None:
+        started = time.perf_counter()
+        call(work_id)
+        latencies.append(time.perf_counter() - started)
+
+    lsn_before = wal_lsn(dsn)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(timed, targets))
+    summary = common.summarize(latencies, time.perf_counter() - started, [])
+    del summary['round_trips_per_request']
+    summary['wal_bytes'] = wal_lsn(dsn) - lsn_before
+    return summary
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--views', type=int, default=50_000)
+    parser.add_argument('--works', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=16)
+    args = parser.parse_args()
+
+    dsn = common.bench_dsn()
+    common.reset_schema(dsn)
+    ids = common.seed(dsn, readers=1, authors=1, works=args.works)
+    os.environ['DATABASE_URL'] = dsn
+    os.environ.setdefault('DB_POOL_MAX_SIZE', str(args.threads))
+
+    from shared import counters, db
+    handler = common.load_function('counters').handler
+
+    def direct(work_id: int) -> None:
+        with db.connection(dsn) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute('UPDATE works SET views = views + 1 WHERE id = %s', (work_id,))
+            conn.commit()
+
+    def buffered(work_id: int) -> None:
+        body = json.dumps({'work_id': work_id, 'event': 'view'})
+        context = SimpleNamespace(request_id=str(uuid.uuid4()), function_name='bench')
+        handler({'httpMethod': 'POST', 'body': body, 'headers': {}}, context)
+
+    results = {'direct': run_variant(dsn, direct, ids['works'], args.views, args.threads)}
+    after_direct = total_views(dsn, ids['works'])
+
+    results['buffered'] = run_variant(dsn, buffered, ids['works'], args.views, args.threads)
+    counters.flush(dsn)
+    with db.connection(dsn) as conn:
+        counters.merge(conn)
+    merged = total_views(dsn, ids['works']) - after_direct
+
+    print(json.dumps({
+        'config': vars(args),
+        'results': results,
+        'check': {'direct_counted': after_direct, 'buffered_counted': merged, 'consistent': merged == args.views},
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+'''
+Business: Time the withdrawal worker clearing a large pending backlog
+Args: --withdrawals N, --processes P, --concurrency C, --latency S, --failure-rate F
+Returns: JSON with elapsed time, throughput and a consistency check
+
+Seeds N pending withdrawals (with their pending transactions), then runs P
+worker processes of shared.withdrawals against FakePayoutProvider in
+parallel. The check verifies every withdrawal was finished exactly once
+and every failure was refunded exactly once.
+
+Usage: BENCH_DATABASE_URL=postgresql://localhost/comics_bench \
+       python -m bench.withdrawal_backlog --withdrawals 100000 --processes 4
+'''
+
+import argparse
+import json
+import multiprocessing
+import time
+from typing import Dict, Any, Tuple
+import psycopg2
+
+from bench import common
+
+
+def seed_backlog(dsn: str, withdrawals: int, users: int) -> None:
+    ids = common.seed(dsn, readers=0, authors=users, works=1, author_balance=0)
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """WITH authors AS (
+                       SELECT w.id AS wallet_id, w.user_id, row_number() OVER (ORDER BY w.user_id) - 1 AS n
+                       FROM wallets w WHERE w.user_id = ANY(%s)
+                   ),
+                   inserted AS (
+                       INSERT INTO withdrawals (user_id, wallet_id, amount, status, payment_method, payment_details)
+                       SELECT a.user_id, a.wallet_id, 500, 'pending', 'card',
+                              jsonb_build_object('card_number', lpad((i %% 10000)::text, 4, '0'))
+                       FROM generate_series(1, %s) i
+                       JOIN authors a ON a.n = i %% %s
+                       RETURNING id, user_id, wallet_id, amount
+                   )
+                   INSERT INTO transactions
+                       (user_id, wallet_id, type, amount, currency, status, payment_method, description, metadata)
+                   SELECT user_id, wallet_id, 'withdrawal', -amount, 'RUB', 'pending', 'card',
+                          'Withdrawal #' || id, jsonb_build_object('withdrawal_id', id)
+                   FROM inserted""",
+                (ids['authors'], withdrawals, len(ids['authors']))
+            )
+        conn.commit()
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute('VACUUM ANALYZE withdrawals')
+            cursor.execute('VACUUM ANALYZE transactions')
+    finally:
+        conn.close()
+
+
+def _worker(args: Tuple[str, int, int, float, float, int]) -> Dict[str, Any]:
+    dsn, batch_size, concurrency, latency, failure_rate, seed = args
+    from shared import payouts, withdrawals
+    conn = psycopg2.connect(dsn)
+    try:
+        provider = payouts.FakePayoutProvider(latency=latency, failure_rate=failure_rate, seed=seed)
+        return withdrawals.process(conn, provider, batch_size, concurrency)
+    finally:
+        conn.close()
+
+
+def check(dsn: str) -> Dict[str, Any]:
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """SELECT
+                       (SELECT COUNT(*) FROM withdrawals WHERE status IN ('pending', 'processing')),
+                       (SELECT COUNT(*) FROM withdrawals WHERE status = 'completed'),
+                       (SELECT COUNT(*) FROM withdrawals WHERE status = 'failed'),
+                       (SELECT COUNT(*) FROM transactions WHERE type = 'withdrawal_refund'),
+                       (SELECT COUNT(*) FROM transactions WHERE type = 'withdrawal' AND status = 'pending'),
+                       (SELECT COALESCE(SUM(balance), 0)::float FROM wallets),
+                       (SELECT COALESCE(SUM(amount), 0)::float FROM withdrawals WHERE status = 'failed')"""
+            )
+            open_count, completed, failed, refunds, pending_transactions, balances, failed_amount = cursor.fetchone()
+    finally:
+        conn.close()
+    return {
+        'open': open_count,
+        'completed': completed,
+        'failed': failed,
+        'refund_transactions': refunds,
+        'pending_transactions': pending_transactions,
+        'consistent': open_count == 0 and refunds == failed and pending_transactions == 0
+                      and abs(balances - failed_amount) < 0.01,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--withdrawals', type=int, default=100_000)
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--latency', type=float, default=0.05, help='fake provider seconds per payout')
+    parser.add_argument('--failure-rate', type=float, default=0.02)
+    args = parser.parse_args()
+
+    dsn = common.bench_dsn()
+    common.reset_schema(dsn)
+    seed_backlog(dsn, args.withdrawals, args.users)
+
+    jobs = [
+        (dsn, args.batch_size, args.concurrency, args.latency, args.failure_rate, i)
+        for i in range(args.processes)
+    ]
+    started = time.perf_counter()
+    with multiprocessing.get_context('spawn').Pool(args.processes) as pool:
+        workers = pool.map(_worker, jobs)
+    elapsed = time.perf_counter() - started
+
+    print(json.dumps({
+        'config': vars(args),
+        'elapsed_seconds': round(elapsed, 2),
+        'throughput_per_second': round(args.withdrawals / elapsed, 1) if elapsed else 0.0,
+        'workers': workers,
+        'check': check(dsn),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+'''
+Business: Accept view/like events for works and serve live counts
+Args: event - dict with httpMethod, body, queryStringParameters
+      context - object with attributes: request_id, function_name
+Returns: HTTP response dict with accepted event count or per-work counts
+
+Events are staged by shared.counters and reach works.views / works.likes
+in periodic set-based merges, so a page view does not write the works row.
+A POST with an Idempotency-Key is counted once however often it is retried.
+'''
+
+import json
+import os
+from typing import Dict, Any, List
+from shared import counters, db, idempotency, metrics, response
+
+MAX_EVENTS = 500
+MAX_WORKS = 200
+
+
+def _parse_events(body_data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    events = body_data['events'] if 'events' in body_data else [body_data]
+    if not isinstance(events, list) or not events:
+        raise ValueError('events must be a non-empty list')
+    if len(events) > MAX_EVENTS:
+        raise ValueError(f'At most {MAX_EVENTS} events per request')
+    parsed = []
+    for item in events:
+        if item.get('event') not in counters.EVENT_DELTAS:
+            raise ValueError(f"event must be one of: {', '.join(counters.EVENT_DELTAS)}")
+        parsed.append({'work_id': int(item['work_id']), 'event': item['event']})
+    return parsed
+
+
+def record_events(conn: Any, events: List[Dict[str, Any]]) -> Dict[str, Any]:
+    '''Stage the events in the transaction that stores the Idempotency-Key response.'''
+    counters.stage(conn, [(item['work_id'], item['event']) for item in events])
+    return idempotency.commit(conn, response.json_response(202, {'accepted': len(events)}))
+
+
+@metrics.instrumented('counters')
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'GET')
+
+    if method == 'OPTIONS':
+        return response.preflight('GET, POST, OPTIONS', f'Content-Type, X-User-Id, Idempotency-Key, {db.WRITE_HEADER}')
+
+    db_url = os.environ.get('DATABASE_URL')
+    if not db_url:
+        return response.error(500, 'Database not configured')
+
+    if method == 'POST':
+        try:
+            body_data = json.loads(event.get('body') or '{}')
+            events = _parse_events(body_data)
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            return response.error(400, str(e) if isinstance(e, ValueError) else 'work_id and event required')
+        if response.header(event, idempotency.HEADER):
+            with db.connection(db_url) as conn:
+                result = idempotency.guard(conn, 'counters', event, body_data,
+                                           lambda: record_events(conn, events))
+                counters.merge_if_due(conn)
+            return result
+        for item in events:
+            counters.record(item['work_id'], item['event'])
+        counters.flush(db_url)
+        return response.json_response(202, {'accepted': len(events)})
+
+    if method == 'GET':
+        params = event.get('queryStringParameters') or {}
+        try:
+            work_ids = [int(part) for part in (params.get('work_ids') or '').split(',') if part.strip()]
+        except ValueError:
+            return response.error(400, 'work_ids must be integers')
+        if not work_ids:
+            return response.error(400, 'work_ids required')
+        if len(work_ids) > MAX_WORKS:
+            return response.error(400, f'At most {MAX_WORKS} works per request')
+
+        with db.connection(db_url) as conn:
+            counts = counters.live_counts(conn, work_ids)
+        return response.json_response(200, {
+            'works': {str(work_id): count for work_id, count in counts.items()},
+        }, event)
+
+    return response.error(405, 'Method not allowed')
@@ -0,0 +1,58 @@
+'''
+Business: Check which works a user owns, for gating premium content
+Args: event - dict with httpMethod, queryStringParameters (user_id, work_id or work_ids)
+      context - object with attributes: request_id, function_name
+Returns: HTTP response dict with ownership per work
+
+Answers come from the per-user owned-set cache in shared.entitlements, so
+a warm instance checks owned works without querying the database. The
+X-Write-Timestamp the client echoes after a purchase makes the cache
+reload a set loaded before it.
+'''
+
+import os
+from typing import Dict, Any, List
+from shared import db, entitlements, metrics, response
+
+MAX_BATCH_WORKS = 200
+
+
+def _parse_ids(value: str) -> List[int]:
+    return [int(part) for part in value.split(',') if part.strip()]
+
+
+@metrics.instrumented('entitlements')
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'GET')
+
+    if method == 'OPTIONS':
+        return response.preflight('GET, OPTIONS', f'Content-Type, X-User-Id, {db.WRITE_HEADER}')
+
+    if method != 'GET':
+        return response.error(405, 'Method not allowed')
+
+    params = event.get('queryStringParameters') or {}
+    try:
+        user_id = int(params.get('user_id') or 0)
+        work_ids = _parse_ids(params.get('work_ids') or params.get('work_id') or '')
+    except ValueError:
+        return response.error(400, 'user_id and work ids must be integers')
+
+    if not user_id or not work_ids:
+        return response.error(400, 'user_id and work_id or work_ids required')
+    if len(work_ids) > MAX_BATCH_WORKS:
+        return response.error(400, f'At most {MAX_BATCH_WORKS} works per check')
+
+    db_url = os.environ.get('DATABASE_URL')
+    if not db_url:
+        return response.error(500, 'Database not configured')
+
+    with db.connection(db_url) as conn:
+        owned = entitlements.owned(conn, user_id, work_ids, db.written_at(user_id, event))
+
+    if 'work_ids' not in params:
+        return response.json_response(200, {'user_id': user_id, 'work_id': work_ids[0], 'owned': owned[work_ids[0]]})
+    return response.json_response(200, {
+        'user_id': user_id,
+        'works': {str(work_id): is_owned for work_id, is_owned in owned.items()},
+    })
@@ -0,0 +1,48 @@
+'''
+Business: Serve precomputed top-works and top-authors leaderboards
+Args: event - dict with httpMethod, queryStringParameters
+      (board, metric, period, page, page_size)
+      context - object with attributes: request_id, function_name
+Returns: HTTP response dict with one page of a ranked list
+'''
+
+import os
+from typing import Dict, Any
+from shared import db, leaderboards, metrics, response
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 50
+
+
+@metrics.instrumented('leaderboards')
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'GET')
+
+    if method == 'OPTIONS':
+        return response.preflight('GET, OPTIONS', f'Content-Type, X-User-Id, If-None-Match, {db.WRITE_HEADER}')
+
+    if method != 'GET':
+        return response.error(405, 'Method not allowed')
+
+    params = event.get('queryStringParameters') or {}
+    board = params.get('board', 'works')
+    metric = params.get('metric', 'sales')
+    period = params.get('period', '7d')
+    for name, value, allowed in (('board', board, leaderboards.BOARDS),
+                                 ('metric', metric, leaderboards.METRICS),
+                                 ('period', period, leaderboards.PERIODS)):
+        if value not in allowed:
+            return response.error(400, f"{name} must be one of: {', '.join(allowed)}")
+    try:
+        page_number = max(1, int(params.get('page') or 1))
+        page_size = max(1, min(int(params.get('page_size') or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+    except ValueError:
+        return response.error(400, 'page and page_size must be integers')
+
+    db_url = os.environ.get('DATABASE_URL')
+    if not db_url:
+        return response.error(500, 'Database not configured')
+
+    with db.connection(db_url) as conn:
+        result = leaderboards.page(conn, board, metric, period, page_number, page_size)
+    return response.json_response(200, result, event)
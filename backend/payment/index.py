@@ -7,191 +7,352 @@ Returns: HTTP response dict with payment data
 
 import json
 import os
-from typing import Dict, Any
-from datetime import datetime
-import psycopg2
+from decimal import Decimal, ROUND_HALF_UP
+from typing import Dict, Any, List, Optional, Tuple
+from psycopg2 import IntegrityError
+from psycopg2.errors import NoDataFound, UniqueViolation
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
 from psycopg2.extras import RealDictCursor
+from shared import aio, db, idempotency, ledger, metrics, response, settings, wallet_summary
 
+MAX_CART_ITEMS = 100
+EXPORT_MAX_ROWS = 50000
+CENT = Decimal('0.01')
+
+
+_PURCHASE_WORK = db.Prepared(
+    'purchase_work',
+    """SELECT out_transaction_id, out_purchase_id, out_author_amount, out_platform_amount
+       FROM purchase_work(%s, %s, %s, %s, %s)"""
+)
+
+
+def purchase_single(conn: Any, user_id: int, work_id: int, amount: Any, payment_method: str) -> Dict[str, Any]:
+    '''
+    Buy one work with a single statement: purchase_work() (V0007) performs
+    the work lookup, wallet, transaction, splits, ledger entry, summary and
+    purchase writes server-side, so row locks are held for one round
+    trip. Runs in autocommit, making the statement its own transaction,
+    unless an Idempotency-Key is claimed: then the caller commits it
+    together with the stored response (idempotency.commit).
+    '''
+    platform_percentage = settings.get(conn, 'platform_commission_percentage')
+    if conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+        conn.rollback()
+
+    autocommit = not idempotency.active()
+    conn.autocommit = autocommit
+    try:
+        with conn.cursor() as cursor:
+            _PURCHASE_WORK.execute(cursor, (user_id, work_id, amount, payment_method, platform_percentage))
+            transaction_id, purchase_id, author_amount, platform_amount = cursor.fetchone()
+    finally:
+        if autocommit:
+            conn.autocommit = False
+
+    return {
+        'transaction_id': transaction_id,
+        'purchase_id': purchase_id,
+        'author_amount': float(author_amount),
+        'platform_amount': float(platform_amount),
+        'status': 'success'
+    }
+
+
+_CART_LOOKUP_SQL = """SELECT w.id, w.author_id, w.price, p.id IS NOT NULL AS owned
+                       FROM works w
+                       LEFT JOIN purchases p ON p.work_id = w.id AND p.user_id = %s
+                       WHERE w.id = ANY(%s)"""
+
+_WALLET_UPSERT_SQL = """INSERT INTO wallets (user_id, balance, currency) VALUES (%s, %s, %s)
+                        ON CONFLICT (user_id, currency) DO UPDATE SET user_id = EXCLUDED.user_id
+                        RETURNING id"""
+
+# The synchronous checkout's hot statements; psycopg 3 prepares its own.
+_CART_LOOKUP = db.Prepared('cart_lookup', _CART_LOOKUP_SQL)
+_WALLET_UPSERT = db.Prepared('wallet_upsert', _WALLET_UPSERT_SQL)
+
+_COMMISSION_SQL = "SELECT value FROM platform_settings WHERE key = 'platform_commission_percentage'"
+
+
+def _cart_items(works: Dict[int, Dict[str, Any]], work_ids: List[int],
+                platform_percentage: Decimal) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    '''
+    Per-item outcome for every requested id, plus the items to buy. Splits
+    are rounded exactly like purchase_work(): the platform share to the
+    kopeck, and the author gets the rest, so they always add up.
+    '''
+    items: List[Dict[str, Any]] = []
+    to_buy: List[Dict[str, Any]] = []
+    seen = set()
+    for work_id in work_ids:
+        if work_id in seen:
+            items.append({'work_id': work_id, 'status': 'duplicate'})
+            continue
+        seen.add(work_id)
+        work = works.get(work_id)
+        if not work:
+            items.append({'work_id': work_id, 'status': 'not_found'})
+        elif work['owned']:
+            items.append({'work_id': work_id, 'status': 'already_owned'})
+        else:
+            amount = Decimal(work['price'] or 0)
+            platform_amount = (amount * platform_percentage / 100).quantize(CENT, ROUND_HALF_UP)
+            item = {
+                'work_id': work_id,
+                'status': 'purchased',
+                'author_id': work['author_id'],
+                'amount': amount,
+                'platform_amount': platform_amount,
+                'author_amount': amount - platform_amount,
+            }
+            items.append(item)
+            to_buy.append(item)
+    return items, to_buy
+
+
+def _cart_transactions_sql(user_id: int, wallet_id: int, to_buy: List[Dict[str, Any]],
+                           payment_method: str) -> Tuple[str, List[Any]]:
+    values: List[Any] = []
+    for item in to_buy:
+        values.extend([
+            user_id, wallet_id, 'purchase', item['amount'], 'RUB', 'completed', payment_method,
+            f"Purchase work #{item['work_id']}", json.dumps({'work_id': item['work_id']})
+        ])
+    return (
+        f"""INSERT INTO transactions
+            (user_id, wallet_id, type, amount, currency, status, payment_method, description, metadata)
+            VALUES {', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s, %s)'] * len(to_buy))}
+            RETURNING id, (metadata->>'work_id')::int AS work_id""",
+        values
+    )
+
+
+def _cart_followup_sql(user_id: int, to_buy: List[Dict[str, Any]],
+                       platform_percentage: Decimal) -> List[Tuple[str, List[Any]]]:
+    '''
+    Splits, ledger entries, buyer summary and purchases: they only need the
+    transaction ids, not each other's results. The purchases insert is last
+    and returns the purchase ids.
+    '''
+    values: List[Any] = []
+    for item in to_buy:
+        values.extend([
+            item['transaction_id'], 'platform', None, item['platform_amount'], platform_percentage, 'completed',
+            item['transaction_id'], 'author', item['author_id'], item['author_amount'], 100 - platform_percentage, 'completed',
+        ])
+    splits = (
+        f"""INSERT INTO commission_splits
+            (transaction_id, recipient_type, recipient_id, amount, percentage, status)
+            VALUES {', '.join(['(%s, %s, %s, %s, %s, %s)'] * (2 * len(to_buy)))}""",
+        values
+    )
+    entries = ledger.append_sql([
+        (item['transaction_id'], item['author_id'], item['author_amount'], item['platform_amount'])
+        for item in to_buy
+    ])
+    summary = wallet_summary.deltas_sql({int(user_id): {'purchases': len(to_buy)}})
+
+    values = []
+    for item in to_buy:
+        values.extend([user_id, item['work_id'], item['transaction_id'], item['amount']])
+    purchases = (
+        f"""INSERT INTO purchases (user_id, work_id, transaction_id, price)
+            VALUES {', '.join(['(%s, %s, %s, %s)'] * len(to_buy))}
+            RETURNING id, work_id""",
+        values
+    )
+    return [splits, entries, summary, purchases]
+
+
+def _cart_result(items: List[Dict[str, Any]], to_buy: List[Dict[str, Any]],
+                 purchase_ids: Dict[int, int]) -> Dict[str, Any]:
+    for item in to_buy:
+        item['purchase_id'] = purchase_ids[item['work_id']]
+        del item['author_id']
+
+    return {
+        'status': 'success',
+        'items': items,
+        'purchased_count': len(to_buy),
+        'total_amount': sum(item['amount'] for item in to_buy),
+        'author_amount': sum(item['author_amount'] for item in to_buy),
+        'platform_amount': sum(item['platform_amount'] for item in to_buy),
+    }
+
+
+def _nothing_to_buy(items: List[Dict[str, Any]]) -> Tuple[int, Dict[str, Any]]:
+    return 409, {'error': 'Nothing to purchase', 'status': 'rejected', 'items': items}
+
+
+def checkout_cart(conn: Any, user_id: int, work_ids: List[int], payment_method: str) -> Tuple[int, Dict[str, Any]]:
+    '''
+    Buy several works in one transaction: one lookup for all works and
+    existing purchases, and multi-row inserts for transactions, splits,
+    earnings ledger entries and purchases. Authors are credited by
+    settlement (shared.ledger), so no author row is locked here. The
+    caller commits, with the stored response (idempotency.commit).
+    '''
+    platform_percentage = Decimal(settings.get(conn, 'platform_commission_percentage'))
+
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    _CART_LOOKUP.execute(cursor, (user_id, work_ids))
+    works = {row['id']: row for row in cursor.fetchall()}
+
+    items, to_buy = _cart_items(works, work_ids, platform_percentage)
+    if not to_buy:
+        conn.rollback()
+        cursor.close()
+        return _nothing_to_buy(items)
+
+    _WALLET_UPSERT.execute(cursor, (user_id, 0, 'RUB'))
+    wallet_id = cursor.fetchone()['id']
+
+    cursor.execute(*_cart_transactions_sql(user_id, wallet_id, to_buy, payment_method))
+    transaction_ids = {row['work_id']: row['id'] for row in cursor.fetchall()}
+    for item in to_buy:
+        item['transaction_id'] = transaction_ids[item['work_id']]
+
+    for sql, params in _cart_followup_sql(user_id, to_buy, platform_percentage):
+        cursor.execute(sql, params)
+    purchase_ids = {row['work_id']: row['id'] for row in cursor.fetchall()}
+    cursor.close()
+    return 200, _cart_result(items, to_buy, purchase_ids)
+
+
+async def checkout_cart_async(user_id: int, work_ids: List[int], payment_method: str,
+                              marker: Optional[Tuple[str, Any]] = None) -> Tuple[int, Dict[str, Any]]:
+    '''
+    checkout_cart() over psycopg 3 pipelines: the lookup, wallet upsert and
+    commission read share one round trip, the transactions insert takes
+    one, and all follow-up inserts plus the commit take the last, along
+    with the Idempotency-Key `marker` (idempotency.marker()).
+    '''
+    async with aio.connection() as aconn:
+        works_rows, wallet_rows, commission_rows = await aio.pipeline(aconn, [
+            (_CART_LOOKUP_SQL, (user_id, work_ids)),
+            (_WALLET_UPSERT_SQL, (user_id, 0, 'RUB')),
+            (_COMMISSION_SQL, ()),
+        ])
+        platform_percentage = Decimal(commission_rows[0][0])
+        works = {
+            row[0]: {'id': row[0], 'author_id': row[1], 'price': row[2], 'owned': row[3]}
+            for row in works_rows
+        }
+
+        items, to_buy = _cart_items(works, work_ids, platform_percentage)
+        if not to_buy:
+            await aconn.rollback()
+            return _nothing_to_buy(items)
+
+        (transaction_rows,) = await aio.pipeline(aconn, [
+            _cart_transactions_sql(user_id, wallet_rows[0][0], to_buy, payment_method)
+        ])
+        transaction_ids = {row[1]: row[0] for row in transaction_rows}
+        for item in to_buy:
+            item['transaction_id'] = transaction_ids[item['work_id']]
+
+        followups = _cart_followup_sql(user_id, to_buy, platform_percentage)
+        results = await aio.pipeline(aconn, [marker, *followups] if marker else followups)
+        purchase_ids = {row[1]: row[0] for row in results[-1]}
+
+    return 200, _cart_result(items, to_buy, purchase_ids)
+
+
+def create_payment(conn: Any, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    '''Single purchase or cart checkout, depending on the body.'''
+    user_id = body_data.get('user_id')
+
+    if 'work_ids' in body_data:
+        work_ids = body_data.get('work_ids')
+        if not user_id or not isinstance(work_ids, list) or not work_ids:
+            return response.error(400, 'user_id and a non-empty work_ids list required')
+        if len(work_ids) > MAX_CART_ITEMS:
+            return response.error(400, f'At most {MAX_CART_ITEMS} works per checkout')
+        
+        cart = (int(user_id), [int(work_id) for work_id in work_ids], body_data.get('payment_method', 'balance'))
+        try:
+            if aio.enabled():
+                status_code, result = aio.run(checkout_cart_async(*cart, idempotency.marker()))
+                return response.json_response(status_code, result)
+            status_code, result = checkout_cart(conn, *cart)
+            return idempotency.commit(conn, response.json_response(status_code, result))
+        except (IntegrityError, aio.IntegrityError):
+            conn.rollback()
+            return response.error(409, 'One of the works was purchased concurrently, retry checkout')
+        except Exception as e:
+            conn.rollback()
+            return response.error(500, str(e))
+
+    work_id = body_data.get('work_id')
+    amount = body_data.get('amount')
+    payment_method = body_data.get('payment_method', 'balance')
+
+    if not all([user_id, work_id, amount]):
+        return response.error(400, 'Missing required fields')
+
+    try:
+        result = purchase_single(conn, user_id, work_id, amount, payment_method)
+    except NoDataFound:
+        conn.rollback()
+        return response.error(404, 'Work not found')
+    except UniqueViolation:
+        conn.rollback()
+        return response.error(409, 'Work already purchased')
+    except Exception as e:
+        conn.rollback()
+        return response.error(500, str(e))
+    
+    return idempotency.commit(conn, response.json_response(200, result))
+
+
+@metrics.instrumented('payment')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+        return response.preflight(
+            'GET, POST, OPTIONS', f'Content-Type, X-User-Id, If-None-Match, Idempotency-Key, {db.WRITE_HEADER}'
+        )
     
     db_url = os.environ.get('DATABASE_URL')
     if not db_url:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Database not configured'})
-        }
-    
-    conn = psycopg2.connect(db_url)
-    conn.autocommit = False
+        return response.error(500, 'Database not configured')
     
     if method == 'POST':
         body_data = json.loads(event.get('body', '{}'))
         user_id = body_data.get('user_id')
-        work_id = body_data.get('work_id')
-        amount = body_data.get('amount')
-        payment_method = body_data.get('payment_method', 'balance')
-        
-        if not all([user_id, work_id, amount]):
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Missing required fields'})
-            }
-        
-        try:
-            cursor = conn.cursor(cursor_factory=RealDictCursor)
-            
-            cursor.execute("SELECT id, author_id, price FROM works WHERE id = %s", (work_id,))
-            work = cursor.fetchone()
-            if not work:
-                conn.rollback()
-                conn.close()
-                return {
-                    'statusCode': 404,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Work not found'})
-                }
-            
-            cursor.execute(
-                "SELECT id FROM wallets WHERE user_id = %s AND currency = %s",
-                (user_id, 'RUB')
-            )
-            wallet = cursor.fetchone()
-            if not wallet:
-                cursor.execute(
-                    "INSERT INTO wallets (user_id, balance, currency) VALUES (%s, %s, %s) RETURNING id",
-                    (user_id, 0, 'RUB')
-                )
-                wallet = {'id': cursor.fetchone()['id']}
-            
-            cursor.execute(
-                """INSERT INTO transactions 
-                   (user_id, wallet_id, type, amount, currency, status, payment_method, description)
-                   VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id""",
-                (user_id, wallet['id'], 'purchase', amount, 'RUB', 'completed', payment_method, f'Purchase work #{work_id}')
-            )
-            transaction_id = cursor.fetchone()['id']
-            
-            cursor.execute(
-                "SELECT value FROM platform_settings WHERE key = %s",
-                ('platform_commission_percentage',)
-            )
-            platform_commission = float(cursor.fetchone()['value']) / 100
-            author_commission = 1 - platform_commission
-            
-            platform_amount = float(amount) * platform_commission
-            author_amount = float(amount) * author_commission
-            
-            cursor.execute(
-                """INSERT INTO commission_splits 
-                   (transaction_id, recipient_type, recipient_id, amount, percentage, status)
-                   VALUES (%s, %s, %s, %s, %s, %s)""",
-                (transaction_id, 'platform', None, platform_amount, platform_commission * 100, 'completed')
-            )
-            
-            cursor.execute(
-                """INSERT INTO commission_splits 
-                   (transaction_id, recipient_type, recipient_id, amount, percentage, status)
-                   VALUES (%s, %s, %s, %s, %s, %s)""",
-                (transaction_id, 'author', work['author_id'], author_amount, author_commission * 100, 'completed')
-            )
-            
-            cursor.execute(
-                "UPDATE wallets SET balance = balance + %s WHERE user_id = %s AND currency = %s",
-                (author_amount, work['author_id'], 'RUB')
-            )
-            
-            cursor.execute(
-                """INSERT INTO purchases (user_id, work_id, transaction_id, price)
-                   VALUES (%s, %s, %s, %s) RETURNING id""",
-                (user_id, work_id, transaction_id, amount)
-            )
-            purchase_id = cursor.fetchone()['id']
-            
-            conn.commit()
-            cursor.close()
-            conn.close()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'isBase64Encoded': False,
-                'body': json.dumps({
-                    'transaction_id': transaction_id,
-                    'purchase_id': purchase_id,
-                    'author_amount': author_amount,
-                    'platform_amount': platform_amount,
-                    'status': 'success'
-                })
-            }
-            
-        except Exception as e:
-            conn.rollback()
-            conn.close()
-            return {
-                'statusCode': 500,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': str(e)})
-            }
+        with db.connection(db_url) as conn:
+            result = idempotency.guard(conn, f'payment:{user_id}', event, body_data,
+                                       lambda: create_payment(conn, body_data))
+        return db.note_write(user_id, result)
     
     if method == 'GET':
-        params = event.get('queryStringParameters', {})
+        params = event.get('queryStringParameters') or {}
         user_id = params.get('user_id')
-        
+    
         if not user_id:
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'user_id required'})
-            }
-        
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(
-            """SELECT t.*, w.balance 
-               FROM transactions t
-               LEFT JOIN wallets w ON t.wallet_id = w.id
-               WHERE t.user_id = %s
-               ORDER BY t.created_at DESC
-               LIMIT 50""",
-            (user_id,)
-        )
-        transactions = cursor.fetchall()
-        
-        for txn in transactions:
-            if 'created_at' in txn and txn['created_at']:
-                txn['created_at'] = txn['created_at'].isoformat()
-            if 'updated_at' in txn and txn['updated_at']:
-                txn['updated_at'] = txn['updated_at'].isoformat()
-        
-        cursor.close()
-        conn.close()
+            return response.error(400, 'user_id required')
+    
+        # csv and the export writers are only needed here, not at cold start.
+        from shared import history
+        try:
+            filters = history.parse_filters(params)
+        except ValueError as e:
+            return response.error(400, str(e))
+    
+        with db.read_connection(db_url, user_id, event) as conn:
+            export_format = params.get('export')
+            if export_format:
+                if export_format not in history.EXPORT_FORMATS:
+                    return response.error(400, f"export must be one of: {', '.join(history.EXPORT_FORMATS)}")
+                body, next_cursor = history.export(conn, int(user_id), filters, export_format, EXPORT_MAX_ROWS)
+                headers = {'Access-Control-Expose-Headers': 'X-Next-Cursor'}
+                if next_cursor:
+                    headers['X-Next-Cursor'] = next_cursor
+                content_type = 'text/csv; charset=utf-8' if export_format == 'csv' else 'application/x-ndjson'
+                return response.raw_response(200, body, content_type, event, headers)
         
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'isBase64Encoded': False,
-            'body': json.dumps({'transactions': transactions})
-        }
+            return response.json_response(200, history.page(conn, int(user_id), filters), event)
     
-    conn.close()
-    return {
-        'statusCode': 405,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'error': 'Method not allowed'})
-    }
+    return response.error(405, 'Method not allowed')
@@ -0,0 +1,3 @@
+'''
+Shared helpers for the payment, wallet and admin functions.
+'''
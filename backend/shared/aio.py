@@ -0,0 +1,155 @@
+'''
+Business: Optional async execution mode (psycopg 3) with pipelined queries
+Args: DB_ASYNC - '1' to route supported paths through this module
+      DB_POOL_MAX_SIZE - shared with shared.db (default 4)
+Returns: query results via pipeline(); handler results via run()
+
+psycopg2 sends one statement per round trip. psycopg 3 pipeline mode sends
+a whole group of statements and reads all results in one exchange, so
+queries that do not depend on each other's results cost a single round
+trip. Handlers keep their synchronous handler(event, context) entry point:
+run() executes a coroutine on one long-lived event loop thread per warm
+instance, which also owns the async connection pool. Statement timings are
+collected inside the coroutine and reported to shared.metrics from the
+calling thread, so the per-request log line stays complete.
+
+Paths that support it check enabled(); without psycopg 3 installed they
+keep using shared.db. psycopg 3 and asyncio are imported by enabled() the
+first time DB_ASYNC is on: they are the slowest imports in the backend, so
+instances running the synchronous paths never pay for them at cold start.
+'''
+
+import contextvars
+import os
+import threading
+import time
+from typing import Dict, Any, List, Optional, Sequence, Tuple, Coroutine
+from shared import metrics
+
+MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 4))
+
+Query = Tuple[str, Sequence[Any]]
+
+psycopg: Any = None
+AsyncConnectionPool: Any = None
+
+
+class IntegrityError(Exception):
+    '''Stand-in so callers can catch it before (or without) psycopg 3.'''
+
+
+_lock = threading.Lock()
+_available: Optional[bool] = None
+_loop: Any = None
+_pools: Dict[str, Any] = {}
+_pools_lock: Any = None
+_records: contextvars.ContextVar = contextvars.ContextVar('aio_records')
+
+
+def available() -> bool:
+    '''Whether psycopg 3 is installed; imports it on the first call.'''
+    global psycopg, AsyncConnectionPool, IntegrityError, _available
+    with _lock:
+        if _available is None:
+            try:
+                import psycopg as module
+                from psycopg_pool import AsyncConnectionPool as pool_class
+            except ImportError:
+                _available = False
+            else:
+                psycopg, AsyncConnectionPool, IntegrityError = module, pool_class, module.IntegrityError
+                _available = True
+        return _available
+
+
+def enabled() -> bool:
+    return os.environ.get('DB_ASYNC') == '1' and available()
+
+
+def _event_loop() -> Any:
+    global _loop, _pools_lock
+    import asyncio
+    with _lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _pools_lock = asyncio.Lock()
+            threading.Thread(target=_loop.run_forever, name='aio-db', daemon=True).start()
+        return _loop
+
+
+async def _collecting(coro: Coroutine[Any, Any, Any]) -> Tuple[Any, List[Tuple[str, Any, float, int]]]:
+    records: List[Tuple[str, Any, float, int]] = []
+    _records.set(records)
+    return await coro, records
+
+
+def run(coro: Coroutine[Any, Any, Any]) -> Any:
+    '''Run a coroutine on the instance's event loop and wait for its result.'''
+    import asyncio
+    result, records = asyncio.run_coroutine_threadsafe(_collecting(coro), _event_loop()).result()
+    for kind, query, ms, rows in records:
+        if kind == 'connect':
+            metrics.record_connect(ms)
+        else:
+            metrics.record_statement(query, ms, rows)
+    return result
+
+
+def _record(kind: str, query: Any, ms: float, rows: int = 0) -> None:
+    records = _records.get(None)
+    if records is not None:
+        records.append((kind, query, ms, rows))
+
+
+async def _pool(dsn: Optional[str] = None) -> Any:
+    dsn = dsn or os.environ['DATABASE_URL']
+    async with _pools_lock:
+        pool = _pools.get(dsn)
+        if pool is None:
+            pool = AsyncConnectionPool(dsn, min_size=0, max_size=MAX_SIZE, open=False)
+            await pool.open()
+            _pools[dsn] = pool
+    return pool
+
+
+class connection:
+    '''
+    async with aio.connection() as aconn: ... commits on success and rolls
+    back on error, like psycopg_pool's own context manager.
+    '''
+
+    def __init__(self, dsn: Optional[str] = None):
+        self.dsn = dsn
+        self._context: Any = None
+
+    async def __aenter__(self) -> Any:
+        started = time.perf_counter()
+        self._context = (await _pool(self.dsn)).connection()
+        aconn = await self._context.__aenter__()
+        _record('connect', None, (time.perf_counter() - started) * 1000)
+        return aconn
+
+    async def __aexit__(self, *exc: Any) -> Any:
+        return await self._context.__aexit__(*exc)
+
+
+async def pipeline(aconn: Any, queries: Sequence[Query]) -> List[List[Tuple[Any, ...]]]:
+    '''
+    Send `queries` in one pipeline and return each one's rows (an empty
+    list for statements without a result set). A failing statement aborts
+    the rest of the group, as it would inside a transaction.
+    '''
+    started = time.perf_counter()
+    cursors = []
+    async with aconn.pipeline():
+        for sql, params in queries:
+            cursor = aconn.cursor()
+            await cursor.execute(sql, params)
+            cursors.append(cursor)
+    results = [await cursor.fetchall() if cursor.description else [] for cursor in cursors]
+    elapsed = (time.perf_counter() - started) * 1000
+    # Statements in a pipeline share one exchange; split its time evenly.
+    for (sql, _), cursor in zip(queries, cursors):
+        _record('statement', sql, elapsed / len(queries), cursor.rowcount)
+    return results
+
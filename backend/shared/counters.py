@@ -0,0 +1,255 @@
+'''
+Business: Buffered view/like counters for works
+Args: COUNTERS_MERGE_INTERVAL - seconds between merges into works (default 30)
+Returns: approximate live counts via live_counts(conn, work_ids)
+
+A request's events are summed per work and flushed before it returns, as
+one multi-row insert into the UNLOGGED work_counter_deltas table, which
+writes no WAL and takes no lock on works. Every COUNTERS_MERGE_INTERVAL one instance (holding an
+advisory lock) drains the staging table into works.views / works.likes
+with a single set-based UPDATE, so a popular title's row is written once
+per merge instead of once per page view. The same statement adds the
+merged views to work_stats_hourly for the 24h/7d view leaderboards
+(shared.leaderboards). Reads add staged and locally buffered deltas to
+the stored columns.
+
+Requests carrying an Idempotency-Key are not buffered: stage() inserts
+their events in the transaction that stores the response
+(shared.idempotency), so a retried request is counted once.
+
+Loss window: events of a request whose flush failed stay in memory and go
+out with the instance's next request, so an instance that dies after a
+failed flush loses them; a Postgres crash truncates the staging table (at
+most one merge interval).
+
+CLI: python -m shared.counters merge
+     python -m shared.counters pending
+'''
+
+import json
+import os
+import sys
+import threading
+import time
+from typing import Dict, Any, List, Optional, Tuple
+from shared import db
+
+MERGE_INTERVAL = float(os.environ.get('COUNTERS_MERGE_INTERVAL', 30))
+
+EVENT_DELTAS = {
+    'view': (1, 0),
+    'like': (0, 1),
+    'unlike': (0, -1),
+}
+
+_lock = threading.Lock()
+# work_id -> [views, likes] not yet flushed by this instance
+_pending: Dict[int, List[int]] = {}
+_last_merge = 0.0
+
+_MERGE_SQL = """
+    WITH drained AS (
+        DELETE FROM work_counter_deltas
+        RETURNING work_id, views, likes
+    ),
+    merged AS (
+        SELECT work_id, SUM(views) AS views, SUM(likes) AS likes
+        FROM drained
+        GROUP BY work_id
+    ),
+    locked AS (
+        SELECT id FROM works
+        WHERE id IN (SELECT work_id FROM merged)
+        ORDER BY id
+        FOR UPDATE
+    ),
+    updated AS (
+        UPDATE works w
+        SET views = COALESCE(w.views, 0) + m.views,
+            likes = GREATEST(COALESCE(w.likes, 0) + m.likes, 0)
+        FROM locked
+        JOIN merged m ON m.work_id = locked.id
+        WHERE w.id = locked.id
+        RETURNING w.id
+    ),
+    hourly AS (
+        INSERT INTO work_stats_hourly (work_id, bucket_start, views)
+        SELECT m.work_id, date_trunc('hour', LOCALTIMESTAMP), m.views
+        FROM merged m
+        JOIN locked ON locked.id = m.work_id
+        WHERE m.views > 0
+        ON CONFLICT (work_id, bucket_start) DO UPDATE
+        SET views = work_stats_hourly.views + EXCLUDED.views
+    )
+    SELECT (SELECT COUNT(*) FROM drained), (SELECT COUNT(*) FROM updated)
+"""
+
+
+def record(work_id: int, event: str, count: int = 1) -> None:
+    views, likes = EVENT_DELTAS[event]
+    with _lock:
+        totals = _pending.setdefault(work_id, [0, 0])
+        totals[0] += views * count
+        totals[1] += likes * count
+
+
+def _restore(pending: Dict[int, List[int]]) -> None:
+    with _lock:
+        for work_id, (views, likes) in pending.items():
+            totals = _pending.setdefault(work_id, [0, 0])
+            totals[0] += views
+            totals[1] += likes
+
+
+def _stage_sql(pending: Dict[int, List[int]]) -> Tuple[str, List[Any]]:
+    rows: List[Any] = []
+    for work_id, (views, likes) in pending.items():
+        rows.extend([work_id, views, likes])
+    return (
+        f"""INSERT INTO work_counter_deltas (work_id, views, likes)
+            VALUES {', '.join(['(%s, %s, %s)'] * len(pending))}""",
+        rows
+    )
+
+
+def stage(conn: Any, events: List[Tuple[int, str]]) -> int:
+    '''
+    Insert one request's (work_id, event) pairs into work_counter_deltas
+    inside the caller's transaction, bypassing the buffer; the caller
+    commits.
+    '''
+    pending: Dict[int, List[int]] = {}
+    for work_id, event in events:
+        views, likes = EVENT_DELTAS[event]
+        totals = pending.setdefault(work_id, [0, 0])
+        totals[0] += views
+        totals[1] += likes
+    pending = {work_id: totals for work_id, totals in pending.items() if totals != [0, 0]}
+    if pending:
+        with conn.cursor() as cursor:
+            cursor.execute(*_stage_sql(pending))
+    return len(pending)
+
+
+def merge_if_due(conn: Any) -> None:
+    '''
+    Merge when COUNTERS_MERGE_INTERVAL has passed since this instance last
+    tried. A failed merge is logged; the staged deltas wait for the next one.
+    '''
+    if time.monotonic() - _last_merge < MERGE_INTERVAL:
+        return
+    try:
+        merge(conn)
+    except Exception as e:
+        conn.rollback()
+        print(json.dumps({'counters_merge_error': str(e)}))
+
+
+def flush(dsn: Optional[str] = None) -> int:
+    '''
+    Append buffered deltas to work_counter_deltas, then merge if the merge
+    interval has passed. On a database error the deltas go back into the
+    buffer for the next request's flush.
+    '''
+    global _pending
+    with _lock:
+        pending, _pending = _pending, {}
+    pending = {work_id: totals for work_id, totals in pending.items() if totals != [0, 0]}
+    if not pending:
+        return 0
+
+    committed = False
+    try:
+        with db.connection(dsn) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(*_stage_sql(pending))
+            conn.commit()
+            committed = True
+            merge_if_due(conn)
+    except Exception as e:
+        if not committed:
+            _restore(pending)
+        print(json.dumps({'counters_flush_error': str(e)}))
+    return len(pending) if committed else 0
+
+
+def merge(conn: Any) -> Dict[str, Any]:
+    '''
+    Fold all staged deltas into works in one statement. Skipped when
+    another instance holds the merge lock; deltas staged meanwhile wait
+    for the next merge.
+    '''
+    global _last_merge
+    _last_merge = time.monotonic()
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_xact_lock(hashtext('work_counter_merge'))")
+        if not cursor.fetchone()[0]:
+            conn.rollback()
+            return {'merged': False, 'deltas': 0, 'works': 0}
+        cursor.execute(_MERGE_SQL)
+        deltas, works = cursor.fetchone()
+    conn.commit()
+    return {'merged': True, 'deltas': deltas, 'works': works}
+
+
+def live_counts(conn: Any, work_ids: List[int]) -> Dict[int, Dict[str, int]]:
+    '''Stored counts plus staged and locally buffered deltas; approximate.'''
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """SELECT w.id,
+                      COALESCE(w.views, 0) + COALESCE(SUM(d.views), 0),
+                      COALESCE(w.likes, 0) + COALESCE(SUM(d.likes), 0)
+               FROM works w
+               LEFT JOIN work_counter_deltas d ON d.work_id = w.id
+               WHERE w.id = ANY(%s)
+               GROUP BY w.id""",
+            (work_ids,)
+        )
+        rows = cursor.fetchall()
+    with _lock:
+        local = {work_id: list(totals) for work_id, totals in _pending.items()}
+    counts = {}
+    for work_id, views, likes in rows:
+        buffered_views, buffered_likes = local.get(work_id, (0, 0))
+        counts[work_id] = {'views': int(views) + buffered_views, 'likes': max(int(likes) + buffered_likes, 0)}
+    return counts
+
+
+def pending(conn: Any) -> Dict[str, Any]:
+    '''Staged deltas not yet merged into works.'''
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """SELECT COUNT(*), COUNT(DISTINCT work_id),
+                      COALESCE(SUM(views), 0), COALESCE(SUM(likes), 0),
+                      EXTRACT(EPOCH FROM LOCALTIMESTAMP - MIN(created_at))
+               FROM work_counter_deltas"""
+        )
+        rows, works, views, likes, oldest = cursor.fetchone()
+    return {
+        'rows': rows,
+        'works': works,
+        'views': int(views),
+        'likes': int(likes),
+        'oldest_seconds': float(oldest) if oldest is not None else None,
+    }
+
+
+def main(argv: List[str]) -> int:
+    if not argv or argv[0] not in ('merge', 'pending'):
+        print('usage: python -m shared.counters merge | pending')
+        return 2
+
+    import psycopg2
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        if argv[0] == 'merge':
+            print(json.dumps(merge(conn)))
+        else:
+            print(json.dumps(pending(conn)))
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
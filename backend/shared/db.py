@@ -0,0 +1,589 @@
+'''
+Business: Warm Postgres connection pool shared by the backend functions
+Args: DATABASE_URL - DSN of the primary database
+      DB_POOL_MAX_SIZE - max connections kept per instance (default 4)
+      DB_POOL_MAX_IDLE - seconds an idle connection may stay in the pool (default 300)
+      DB_POOL_MAX_LIFETIME - seconds before a connection is recycled (default 1800)
+      DB_POOL_PING_AFTER - idle seconds after which a connection is pinged (default 30)
+      DB_PREPARE - '0' to run Prepared statements as plain queries, e.g.
+                   behind a transaction-pooling proxy (default '1')
+      DATABASE_REPLICA_URL - DSN of a streaming read replica (optional)
+      DB_REPLICA_MAX_LAG - seconds of replay lag above which reads go to the primary (default 5)
+      DB_REPLICA_LAG_CHECK_INTERVAL - seconds between replica lag probes (default 1)
+Returns: pooled psycopg2 connections via connection() and, for read-only
+         paths, read_connection()
+'''
+
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Any, List, Optional, Iterator, Callable, Sequence, Tuple
+import psycopg2
+import psycopg2.extensions
+from psycopg2.errors import InvalidSqlStatementName
+from psycopg2.extras import RealDictCursor
+from shared import metrics, response
+
+PREPARE = os.environ.get('DB_PREPARE', '1') != '0'
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+REPLICA_MAX_LAG = _env_float('DB_REPLICA_MAX_LAG', 5.0)
+REPLICA_CHECK_INTERVAL = _env_float('DB_REPLICA_LAG_CHECK_INTERVAL', 1.0)
+WRITE_HEADER = 'X-Write-Timestamp'
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+# EXECUTE text of each Prepared statement -> its SQL, so metrics keep
+# fingerprinting (and spotting locks in) the statement itself.
+_executes: Dict[str, str] = {}
+
+
+def _statement_text(query: Any) -> Any:
+    return _executes.get(query, query) if isinstance(query, str) else query
+
+
+class _TimedCursorMixin:
+    '''Reports every execute() to shared.metrics for the current request.'''
+
+    def execute(self, query: Any, vars: Any = None) -> Any:
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            metrics.record_statement(_statement_text(query), (time.perf_counter() - started) * 1000, self.rowcount)
+
+    def executemany(self, query: Any, vars_list: Any) -> Any:
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            metrics.record_statement(query, (time.perf_counter() - started) * 1000, self.rowcount)
+
+
+class TimedCursor(_TimedCursorMixin, psycopg2.extensions.cursor):
+    pass
+
+
+class TimedRealDictCursor(_TimedCursorMixin, RealDictCursor):
+    pass
+
+
+_TIMED_CURSORS = {
+    psycopg2.extensions.cursor: TimedCursor,
+    RealDictCursor: TimedRealDictCursor,
+}
+
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    '''Connection whose cursors, whatever factory is requested, are timed.'''
+
+    def cursor(self, *args: Any, **kwargs: Any) -> Any:
+        factory = kwargs.get('cursor_factory') or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs['cursor_factory'] = _TIMED_CURSORS.get(factory, factory)
+        return super().cursor(*args, **kwargs)
+
+
+_connect_hooks: List[Callable[[Any], None]] = []
+
+
+def on_connect(hook: Callable[[Any], None]) -> Callable[[Any], None]:
+    '''
+    Register a callback run once on every freshly opened connection,
+    e.g. to LISTEN on a channel. The pool commits after the hooks run.
+    '''
+    if hook not in _connect_hooks:
+        _connect_hooks.append(hook)
+    return hook
+
+
+_channels: Dict[str, Callable[[str], None]] = {}
+
+
+def _listen(conn: Any) -> None:
+    with conn.cursor() as cursor:
+        for channel in _channels:
+            cursor.execute(f'LISTEN {channel}')
+
+
+def listen(channel: str, callback: Callable[[str], None]) -> None:
+    '''
+    LISTEN on `channel` from every freshly opened connection and pass each
+    notification's payload to callback() in drain_notifications().
+    '''
+    _channels[channel] = callback
+    on_connect(_listen)
+
+
+def drain_notifications(conn: Any) -> None:
+    '''Dispatch NOTIFYs already sitting on the socket; no round trip.'''
+    if conn.closed:
+        return
+    conn.poll()
+    if not conn.notifies:
+        return
+    notifies = list(conn.notifies)
+    del conn.notifies[:]
+    for notify in notifies:
+        callback = _channels.get(notify.channel)
+        if callback is not None:
+            callback(notify.payload)
+
+
+_statements: Dict[str, 'Prepared'] = {}
+_PLACEHOLDER = re.compile(r'(%%|%s)')
+
+
+class Prepared:
+    '''
+    A hot statement that every pooled connection PREPAREs once and then
+    only EXECUTEs, so Postgres stops parsing and analysing the same text
+    on each call and can switch to a cached generic plan. `sql` uses the
+    usual %s placeholders. Statements declared at import time are all
+    prepared in one round trip when a connection opens; ones declared
+    later are prepared on first use. Connections from plain
+    psycopg2.connect() (CLIs, benchmarks) just run `sql`. List columns
+    instead of SELECT *: a prepared statement fails on warm connections
+    once a migration changes the shape of its result.
+    '''
+
+    def __init__(self, name: str, sql: str):
+        declared = _statements.get(name)
+        if declared is not None and declared.sql != sql:
+            raise ValueError(f'Prepared statement {name} is already declared with different SQL')
+        self.name = name
+        self.sql = sql
+        count = 0
+        body = []
+        for token in _PLACEHOLDER.split(sql):
+            if token == '%s':
+                count += 1
+                token = f'${count}'
+            elif token == '%%':
+                token = '%'
+            body.append(token)
+        self.prepare_sql = f"PREPARE {name} AS {''.join(body)}"
+        self.execute_sql = f"EXECUTE {name}({', '.join(['%s'] * count)})" if count else f'EXECUTE {name}'
+        _statements[name] = self
+        _executes[self.execute_sql] = sql
+
+    def execute(self, cursor: Any, params: Sequence[Any] = ()) -> None:
+        prepared = getattr(cursor.connection, 'prepared', None)
+        if prepared is None or not PREPARE:
+            cursor.execute(self.sql, params)
+            return
+        if self.name not in prepared:
+            cursor.execute(self.prepare_sql)
+            prepared.add(self.name)
+        try:
+            cursor.execute(self.execute_sql, params)
+        except InvalidSqlStatementName:
+            # Dropped server-side (DISCARD ALL); prepare again next time.
+            prepared.discard(self.name)
+            raise
+
+
+def _prepare_statements(conn: Any) -> None:
+    statements = list(_statements.values())
+    if PREPARE and statements:
+        with conn.cursor() as cursor:
+            cursor.execute('; '.join(statement.prepare_sql for statement in statements))
+        conn.prepared.update(statement.name for statement in statements)
+
+
+on_connect(_prepare_statements)
+
+
+def _open_connection(dsn: str, replica: bool = False) -> Any:
+    conn = psycopg2.connect(dsn, connection_factory=InstrumentedConnection)
+    conn.prepared = set()
+    if replica:
+        # Hot standbys refuse LISTEN; Prepared statements are prepared on
+        # first use instead of all at once.
+        try:
+            conn.set_session(readonly=True)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+    try:
+        for hook in _connect_hooks:
+            hook(conn)
+        conn.commit()
+    except Exception:
+        conn.close()
+        raise
+    return conn
+
+
+class _PooledConnection:
+    __slots__ = ('conn', 'created_at', 'last_used_at')
+
+    def __init__(self, conn: Any):
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used_at = self.created_at
+
+
+class ConnectionPool:
+    '''
+    LIFO pool of psycopg2 connections that survives warm invocations.
+    Idle connections are pinged before reuse and recycled when too old.
+    '''
+
+    def __init__(self, dsn: str, max_size: int = 4, max_idle: int = 300,
+                 max_lifetime: int = 1800, ping_after: int = 30, acquire_timeout: float = 5.0,
+                 replica: bool = False):
+        self.dsn = dsn
+        self.replica = replica
+        self.max_size = max(1, max_size)
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.ping_after = ping_after
+        self.acquire_timeout = acquire_timeout
+        self._idle: List[_PooledConnection] = []
+        self._in_use: Dict[int, _PooledConnection] = {}
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_size)
+        self.stats: Dict[str, int] = {
+            'hits': 0,
+            'misses': 0,
+            'recycled': 0,
+            'discarded': 0,
+            'failed_pings': 0,
+        }
+
+    def _expired(self, pooled: _PooledConnection, now: float) -> bool:
+        return (now - pooled.created_at > self.max_lifetime
+                or now - pooled.last_used_at > self.max_idle)
+
+    def _healthy(self, pooled: _PooledConnection, now: float) -> bool:
+        conn = pooled.conn
+        if conn.closed:
+            return False
+        if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if now - pooled.last_used_at < self.ping_after:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            self.stats['failed_pings'] += 1
+            return False
+
+    def _close_quietly(self, conn: Any) -> None:
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def acquire(self) -> Any:
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise PoolExhausted(f'No free database connection within {self.acquire_timeout}s')
+        try:
+            now = time.monotonic()
+            while True:
+                with self._lock:
+                    pooled = self._idle.pop() if self._idle else None
+                if pooled is None:
+                    break
+                if self._expired(pooled, now):
+                    self.stats['recycled'] += 1
+                    self._close_quietly(pooled.conn)
+                    continue
+                if not self._healthy(pooled, now):
+                    self.stats['discarded'] += 1
+                    self._close_quietly(pooled.conn)
+                    continue
+                self.stats['hits'] += 1
+                break
+
+            if pooled is None:
+                self.stats['misses'] += 1
+                pooled = _PooledConnection(_open_connection(self.dsn, self.replica))
+
+            pooled.conn.autocommit = False
+            with self._lock:
+                self._in_use[id(pooled.conn)] = pooled
+            return pooled.conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn: Any, discard: bool = False) -> None:
+        with self._lock:
+            pooled = self._in_use.pop(id(conn), None)
+        if pooled is None:
+            return
+        try:
+            if not discard and not conn.closed:
+                try:
+                    if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                    conn.autocommit = False
+                except psycopg2.Error:
+                    discard = True
+            if discard or conn.closed:
+                self.stats['discarded'] += 1
+                self._close_quietly(conn)
+                return
+            pooled.last_used_at = time.monotonic()
+            with self._lock:
+                self._idle.append(pooled)
+        finally:
+            self._slots.release()
+
+    def close_all(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for pooled in idle:
+            self._close_quietly(pooled.conn)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self.stats,
+                'idle': len(self._idle),
+                'in_use': len(self._in_use),
+                'max_size': self.max_size,
+            }
+
+
+_pools: Dict[str, ConnectionPool] = {}
+_replica_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(dsn: Optional[str] = None, replica: bool = False) -> ConnectionPool:
+    dsn = dsn or os.environ['DATABASE_URL']
+    pools = _replica_pools if replica else _pools
+    pool = pools.get(dsn)
+    if pool is None:
+        with _pools_lock:
+            pool = pools.get(dsn)
+            if pool is None:
+                pool = ConnectionPool(
+                    dsn,
+                    max_size=_env_int('DB_POOL_MAX_SIZE', 4),
+                    max_idle=_env_int('DB_POOL_MAX_IDLE', 300),
+                    max_lifetime=_env_int('DB_POOL_MAX_LIFETIME', 1800),
+                    ping_after=_env_int('DB_POOL_PING_AFTER', 30),
+                    replica=replica,
+                )
+                pools[dsn] = pool
+    return pool
+
+
+@contextmanager
+def _borrowed(pool: ConnectionPool, conn: Any) -> Iterator[Any]:
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        pool.release(conn, discard=broken)
+
+
+@contextmanager
+def connection(dsn: Optional[str] = None) -> Iterator[Any]:
+    '''
+    Borrow a pooled connection for one invocation. Open transactions are
+    rolled back on return; connections broken by the request are dropped.
+    '''
+    pool = get_pool(dsn)
+    started = time.perf_counter()
+    conn = pool.acquire()
+    metrics.record_connect((time.perf_counter() - started) * 1000)
+    with _borrowed(pool, conn) as conn:
+        yield conn
+
+
+# Replay lag in seconds; 0 when the standby has replayed all it received
+# (pg_last_xact_replay_timestamp() stays old while the primary is idle),
+# or when the DSN points at a primary.
+_LAG_SQL = """
+    SELECT CASE
+               WHEN NOT pg_is_in_recovery() THEN 0
+               WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+               ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+           END
+"""
+
+# A caught-up standby has only replayed what it has received: commits from
+# the last second may still be on the wire, so they count as not replayed.
+_IN_FLIGHT = 1.0
+RECENT_WRITES = 10000
+
+# replica DSN -> (monotonic time of the probe, wall-clock time up to which
+# every commit has been replayed, or None while lagging or unreachable)
+_replica_probes: Dict[str, Tuple[float, Optional[float]]] = {}
+_recent_writes: 'OrderedDict[str, float]' = OrderedDict()
+_writes_lock = threading.Lock()
+
+
+def note_write(key: Any, result: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Record that `key` (a user id) has just committed a write, so this
+    instance reads its data from the primary until the replica has replayed
+    it, and return the time to the client as X-Write-Timestamp to echo on
+    its next reads, which may land on another instance. Failed responses
+    are returned untouched.
+    '''
+    if result.get('statusCode', 500) >= 300:
+        return result
+    written_at = time.time()
+    with _writes_lock:
+        _recent_writes[str(key)] = written_at
+        _recent_writes.move_to_end(str(key))
+        while len(_recent_writes) > RECENT_WRITES:
+            _recent_writes.popitem(last=False)
+    headers = result.setdefault('headers', {})
+    headers[WRITE_HEADER] = f'{written_at:.3f}'
+    expose = headers.get('Access-Control-Expose-Headers')
+    headers['Access-Control-Expose-Headers'] = f'{expose}, {WRITE_HEADER}' if expose else WRITE_HEADER
+    return result
+
+
+def written_at(key: Any, event: Optional[Dict[str, Any]]) -> float:
+    '''When `key` last wrote, as seen by this instance or echoed by the client.'''
+    try:
+        echoed = float(response.header(event, WRITE_HEADER) or 0)
+    except ValueError:
+        echoed = 0.0
+    local = _recent_writes.get(str(key), 0.0) if key is not None else 0.0
+    return max(local, echoed)
+
+
+def _probe(conn: Any) -> Optional[float]:
+    started = time.time()
+    with conn.cursor() as cursor:
+        cursor.execute(_LAG_SQL)
+        lag = cursor.fetchone()[0]
+    conn.rollback()
+    if lag is None or float(lag) > REPLICA_MAX_LAG:
+        return None
+    return started - max(float(lag), _IN_FLIGHT)
+
+
+def _replica(dsn: str, since: float) -> Optional[Tuple[ConnectionPool, Any]]:
+    '''
+    A replica connection that has replayed everything committed up to
+    `since`, or None. Lag is probed at most once per
+    REPLICA_CHECK_INTERVAL; in between the last horizon is reused, which
+    only understates how far the replica has got.
+    '''
+    now = time.monotonic()
+    probe = _replica_probes.get(dsn)
+    fresh = probe is not None and now - probe[0] < REPLICA_CHECK_INTERVAL
+    if fresh and (probe[1] is None or since > probe[1]):
+        return None
+
+    pool = get_pool(dsn, replica=True)
+    try:
+        conn = pool.acquire()
+    except PoolExhausted:
+        return None
+    except psycopg2.Error:
+        _replica_probes[dsn] = (now, None)
+        return None
+
+    if fresh:
+        horizon = probe[1]
+    else:
+        try:
+            horizon = _probe(conn)
+        except psycopg2.Error:
+            pool.release(conn, discard=True)
+            _replica_probes[dsn] = (now, None)
+            return None
+        _replica_probes[dsn] = (now, horizon)
+
+    if horizon is None or since > horizon:
+        pool.release(conn)
+        return None
+    return pool, conn
+
+
+@contextmanager
+def read_connection(dsn: Optional[str] = None, key: Any = None,
+                    event: Optional[Dict[str, Any]] = None) -> Iterator[Any]:
+    '''
+    Borrow a connection for a read-only path. It comes from the replica in
+    DATABASE_REPLICA_URL when that lags at most DB_REPLICA_MAX_LAG and has
+    replayed the last write of `key` (see note_write(); `event` carries the
+    client's X-Write-Timestamp), and from the primary otherwise: with no
+    replica configured, while it lags or is unreachable, and right after
+    the user's own write. Replica connections are read-only.
+    '''
+    replica_dsn = os.environ.get('DATABASE_REPLICA_URL')
+    if not replica_dsn:
+        with connection(dsn) as conn:
+            yield conn
+        return
+
+    started = time.perf_counter()
+    borrowed = _replica(replica_dsn, written_at(key, event))
+    if borrowed is None:
+        metrics.record_route('primary')
+        with connection(dsn) as conn:
+            yield conn
+        return
+
+    metrics.record_connect((time.perf_counter() - started) * 1000)
+    metrics.record_route('replica')
+    pool, conn = borrowed
+    with _borrowed(pool, conn) as conn:
+        yield conn
+
+
+def read_dsn(dsn: Optional[str] = None, key: Any = None,
+             event: Optional[Dict[str, Any]] = None) -> str:
+    '''
+    The DSN read_connection() would read from, for callers with their own
+    connections (shared.aio). Probes lag like read_connection() but keeps
+    no connection borrowed.
+    '''
+    dsn = dsn or os.environ['DATABASE_URL']
+    replica_dsn = os.environ.get('DATABASE_REPLICA_URL')
+    if not replica_dsn:
+        return dsn
+
+    borrowed = _replica(replica_dsn, written_at(key, event))
+    if borrowed is None:
+        metrics.record_route('primary')
+        return dsn
+
+    metrics.record_route('replica')
+    pool, conn = borrowed
+    pool.release(conn)
+    return replica_dsn
+
+
+def pool_stats() -> Dict[str, Dict[str, Any]]:
+    stats = {dsn.rsplit('@', 1)[-1]: pool.snapshot() for dsn, pool in _pools.items()}
+    stats.update({f"replica:{dsn.rsplit('@', 1)[-1]}": pool.snapshot() for dsn, pool in _replica_pools.items()})
+    return stats
@@ -0,0 +1,97 @@
+'''
+Business: In-process cache of the works each user owns, for ownership checks
+Args: ENTITLEMENT_CACHE_SIZE - users kept per warm instance (default 10000)
+      ENTITLEMENT_CACHE_TTL - max seconds an owned set is served (default 600)
+      ENTITLEMENT_NEGATIVE_TTL - max seconds a "not owned" answer is served
+                                 from the cached set (default 5)
+Returns: {work_id: owned} via owned(conn, user_id, work_ids, written_at)
+
+A user's purchased work ids are loaded with one index-only scan of
+purchases(user_id, work_id) into a sorted array('i') of 4 bytes per work,
+and answered with binary searches. Owned works stay owned, so they are
+served for the full TTL. Purchases are made by the payment function,
+which does not share this cache, so a work missing from the set may have
+been bought since it was loaded: "not owned" is answered from the set only
+while it is younger than ENTITLEMENT_NEGATIVE_TTL and older than the
+buyer's last write (the X-Write-Timestamp the client echoes after a
+purchase); otherwise the set is reloaded first. That bounds both the
+queries spent on works users do not own and how long a purchase made
+elsewhere can go unseen. The TTL bounds staleness for purchases removed
+by hand.
+'''
+
+import bisect
+import os
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+
+CACHE_SIZE = int(os.environ.get('ENTITLEMENT_CACHE_SIZE', 10000))
+TTL_SECONDS = float(os.environ.get('ENTITLEMENT_CACHE_TTL', 600))
+NEGATIVE_TTL_SECONDS = float(os.environ.get('ENTITLEMENT_NEGATIVE_TTL', 5))
+
+_lock = threading.Lock()
+# user_id -> (loaded_at, sorted work ids); least recently used first.
+# loaded_at is wall-clock time so it compares with echoed write timestamps.
+_owned: 'OrderedDict[int, Tuple[float, array]]' = OrderedDict()
+
+
+def invalidate(user_id: Optional[int] = None) -> None:
+    with _lock:
+        if user_id is None:
+            _owned.clear()
+        else:
+            _owned.pop(user_id, None)
+
+
+def _load(conn: Any, user_id: int) -> array:
+    loaded_at = time.time()
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT work_id FROM purchases WHERE user_id = %s ORDER BY work_id', (user_id,))
+        works = array('i', [row[0] for row in cursor.fetchall()])
+    with _lock:
+        _owned[user_id] = (loaded_at, works)
+        while len(_owned) > CACHE_SIZE:
+            _owned.popitem(last=False)
+    return works
+
+
+def _cached(user_id: int) -> Optional[Tuple[float, array]]:
+    with _lock:
+        entry = _owned.get(user_id)
+        if entry is None:
+            return None
+        if time.time() - entry[0] > TTL_SECONDS:
+            del _owned[user_id]
+            return None
+        _owned.move_to_end(user_id)
+        return entry
+
+
+def _lookup(works: array, work_ids: List[int]) -> Dict[int, bool]:
+    size = len(works)
+    result = {}
+    for work_id in work_ids:
+        index = bisect.bisect_left(works, work_id)
+        result[work_id] = index < size and works[index] == work_id
+    return result
+
+
+def owned(conn: Any, user_id: int, work_ids: List[int], written_at: float = 0.0) -> Dict[int, bool]:
+    '''
+    Whether `user_id` owns each of `work_ids`. Queries on a cache miss, and
+    on a hit only when some of the works are not in a set that is older
+    than ENTITLEMENT_NEGATIVE_TTL or than `written_at`, the user's last
+    write as echoed by the client.
+    '''
+    entry = _cached(user_id)
+    if entry is None:
+        return _lookup(_load(conn, user_id), work_ids)
+    loaded_at, works = entry
+    result = _lookup(works, work_ids)
+    fresh = time.time() - loaded_at <= NEGATIVE_TTL_SECONDS and loaded_at > written_at
+    if all(result.values()) or fresh:
+        return result
+    return _lookup(_load(conn, user_id), work_ids)
@@ -0,0 +1,213 @@
+'''
+Business: Keyset-paginated and streamed transaction history
+Args: conn - database connection; filters - type/status/from/to
+Returns: pages of transactions with an opaque next cursor, or NDJSON/CSV lines
+
+Pages are ordered by (created_at, id) DESC and continue strictly after the
+last row of the previous page, which the (user_id, created_at DESC, id DESC)
+index from V0005 serves without a sort. transactions is partitioned by
+month (V0014); the cursor also bounds created_at on its own, because
+partition pruning does not look inside the row comparison. Exports read through a server-side
+named cursor in fixed-size chunks, so memory stays flat for any history size.
+
+CLI: python -m shared.history export <user_id> [ndjson|csv] > history.ndjson
+'''
+
+import base64
+import csv
+import io
+import json
+import os
+import sys
+from datetime import datetime
+from decimal import Decimal
+from typing import Dict, Any, List, Optional, Iterator, Tuple
+from psycopg2.extras import RealDictCursor
+from shared import response
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_FORMATS = ('ndjson', 'csv')
+EXPORT_COLUMNS = [
+    'id', 'created_at', 'type', 'amount', 'currency', 'status',
+    'payment_method', 'description', 'wallet_id', 'updated_at',
+]
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(value: str) -> Tuple[datetime, int]:
+    try:
+        padded = value + '=' * (-len(value) % 4)
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+
+
+def parse_filters(params: Dict[str, Any]) -> Dict[str, Any]:
+    '''Validate query parameters; raises ValueError with a user-facing message.'''
+    filters: Dict[str, Any] = {
+        'type': params.get('type') or None,
+        'status': params.get('status') or None,
+        'from': None,
+        'to': None,
+        'after': None,
+    }
+    try:
+        if params.get('from'):
+            filters['from'] = datetime.fromisoformat(params['from'])
+        if params.get('to'):
+            filters['to'] = datetime.fromisoformat(params['to'])
+    except ValueError:
+        raise ValueError('from/to must be ISO 8601 dates')
+    if params.get('cursor'):
+        filters['after'] = decode_cursor(params['cursor'])
+    try:
+        filters['limit'] = max(1, min(int(params.get('limit') or DEFAULT_PAGE_SIZE), MAX_PAGE_SIZE))
+    except ValueError:
+        raise ValueError('limit must be an integer')
+    return filters
+
+
+def _where(user_id: int, filters: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    clauses = ['t.user_id = %(user_id)s']
+    values: Dict[str, Any] = {'user_id': user_id}
+    if filters.get('type'):
+        clauses.append('t.type = %(type)s')
+        values['type'] = filters['type']
+    if filters.get('status'):
+        clauses.append('t.status = %(status)s')
+        values['status'] = filters['status']
+    if filters.get('from'):
+        clauses.append('t.created_at >= %(from)s')
+        values['from'] = filters['from']
+    if filters.get('to'):
+        clauses.append('t.created_at < %(to)s')
+        values['to'] = filters['to']
+    if filters.get('after'):
+        clauses.append('t.created_at <= %(after_created_at)s')
+        clauses.append('(t.created_at, t.id) < (%(after_created_at)s, %(after_id)s)')
+        values['after_created_at'], values['after_id'] = filters['after']
+    return ' AND '.join(clauses), values
+
+
+def _plain(value: Any) -> Any:
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def page(conn: Any, user_id: int, filters: Dict[str, Any]) -> Dict[str, Any]:
+    limit = filters.get('limit') or DEFAULT_PAGE_SIZE
+    where, values = _where(user_id, filters)
+    values['limit'] = limit + 1
+    with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        cursor.execute(
+            f"""SELECT t.*, w.balance
+                FROM transactions t
+                LEFT JOIN wallets w ON t.wallet_id = w.id
+                WHERE {where}
+                ORDER BY t.created_at DESC, t.id DESC
+                LIMIT %(limit)s""",
+            values
+        )
+        rows = cursor.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1]['created_at'], rows[-1]['id'])
+
+    return {
+        'transactions': rows,
+        'next_cursor': next_cursor,
+    }
+
+
+def iter_rows(conn: Any, user_id: int, filters: Dict[str, Any],
+              chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[Dict[str, Any]]:
+    '''Yield every matching transaction via a named (server-side) cursor.'''
+    where, values = _where(user_id, filters)
+    with conn.cursor(name=f'history_export_{user_id}', cursor_factory=RealDictCursor) as cursor:
+        cursor.itersize = chunk_size
+        cursor.execute(
+            f"""SELECT {', '.join('t.' + column for column in EXPORT_COLUMNS)}
+                FROM transactions t
+                WHERE {where}
+                ORDER BY t.created_at DESC, t.id DESC""",
+            values
+        )
+        for row in cursor:
+            yield row
+
+
+def iter_export(conn: Any, user_id: int, filters: Dict[str, Any], fmt: str) -> Iterator[str]:
+    '''Yield the whole history as NDJSON or CSV lines (CSV starts with a header).'''
+    if fmt == 'csv':
+        yield _header()
+    for row in iter_rows(conn, user_id, filters):
+        yield _line(row, fmt)
+
+
+def export(conn: Any, user_id: int, filters: Dict[str, Any], fmt: str, max_rows: int) -> Tuple[str, Optional[str]]:
+    '''
+    Build one bounded export response body. Function responses cannot be
+    streamed, so large histories are exported in max_rows slices chained by
+    the returned cursor; the CLI below streams without a bound.
+    '''
+    lines: List[str] = []
+    last: Optional[Dict[str, Any]] = None
+    for count, row in enumerate(iter_rows(conn, user_id, filters)):
+        if count >= max_rows:
+            return _render(lines, fmt), encode_cursor(last['created_at'], last['id'])
+        lines.append(_line(row, fmt))
+        last = row
+    return _render(lines, fmt), None
+
+
+def _line(row: Dict[str, Any], fmt: str) -> str:
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow([_plain(row[column]) for column in EXPORT_COLUMNS])
+        return buffer.getvalue()
+    return response.dumps({column: row[column] for column in EXPORT_COLUMNS}) + '\n'
+
+
+def _header() -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(EXPORT_COLUMNS)
+    return buffer.getvalue()
+
+
+def _render(lines: List[str], fmt: str) -> str:
+    return ''.join([_header()] + lines if fmt == 'csv' else lines)
+
+
+def main(argv: List[str]) -> int:
+    if len(argv) < 2 or argv[0] != 'export':
+        print('usage: python -m shared.history export <user_id> [ndjson|csv]')
+        return 2
+    fmt = argv[2] if len(argv) > 2 else 'ndjson'
+    if fmt not in EXPORT_FORMATS:
+        print(f"format must be one of: {', '.join(EXPORT_FORMATS)}")
+        return 2
+
+    import psycopg2
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        for line in iter_export(conn, int(argv[1]), {}, fmt):
+            sys.stdout.write(line)
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
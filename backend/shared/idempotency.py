@@ -0,0 +1,278 @@
+'''
+Business: Idempotency-Key handling for payment, withdrawal and counter POSTs
+Args: IDEMPOTENCY_TTL_HOURS - how long a completed key is replayed (default 24)
+      IDEMPOTENCY_WAIT_SECONDS - how long a duplicate waits for the original (default 8)
+Returns: the stored response for replays, otherwise the operation's response
+
+A request carrying an Idempotency-Key claims (scope, key) in
+idempotency_keys with a committed insert before doing any work. The
+claimant runs the operation and stores its response; a replay of a
+completed key gets that response back (from the in-process LRU when warm)
+without touching the ledger, and a duplicate that arrives while the
+original is still running polls until it finishes instead of racing it.
+Server errors release the claim so the client's retry runs again. Claims
+whose owner died are taken over after IDEMPOTENCY_STALE_SECONDS; expired
+keys are purged opportunistically.
+
+Operations commit through commit(), which stores the response in the same
+transaction as their work, so a claim is never left in flight (and later
+taken over and run again) after the work has committed. Work committed on
+another connection (psycopg 3 pipelines) runs marker() in its transaction
+instead: a 'committed' key is never taken over, and if its owner died
+before storing the response, retries get a 409 without Retry-After.
+'''
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple, Callable
+from shared import response
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+TTL_HOURS = float(os.environ.get('IDEMPOTENCY_TTL_HOURS', 24))
+WAIT_SECONDS = float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', 8))
+STALE_SECONDS = float(os.environ.get('IDEMPOTENCY_STALE_SECONDS', 60))
+CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 2048))
+PURGE_INTERVAL = 300
+PURGE_BATCH = 1000
+
+_lock = threading.Lock()
+_local = threading.local()
+_cache: 'OrderedDict[Tuple[str, str], Tuple[str, int, str, float]]' = OrderedDict()
+_last_purge = 0.0
+
+
+def request_hash(body: Dict[str, Any]) -> str:
+    return hashlib.sha1(json.dumps(body, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _cached(scope: str, key: str) -> Optional[Tuple[str, int, str]]:
+    with _lock:
+        entry = _cache.get((scope, key))
+        if entry is None:
+            return None
+        if entry[3] < time.time():
+            del _cache[(scope, key)]
+            return None
+        _cache.move_to_end((scope, key))
+        return entry[:3]
+
+
+def _remember(scope: str, key: str, hashed: str, status: int, body: str) -> None:
+    with _lock:
+        _cache[(scope, key)] = (hashed, status, body, time.time() + TTL_HOURS * 3600)
+        _cache.move_to_end((scope, key))
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def _replay(hashed: str, stored_hash: str, status: int, body: str) -> Dict[str, Any]:
+    if stored_hash != hashed:
+        return response.error(422, f'{HEADER} was already used with a different request')
+    return response.raw_response(status, body, 'application/json', headers={'Idempotent-Replayed': 'true'})
+
+
+def _claim(conn: Any, scope: str, key: str, hashed: str) -> Optional[Tuple[str, str, Optional[int], Optional[str]]]:
+    '''
+    Claim the key; returns None when this request owns it, otherwise the
+    existing (status, request_hash, response_status, response_body).
+    '''
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """INSERT INTO idempotency_keys (scope, key, request_hash, expires_at)
+               VALUES (%s, %s, %s, LOCALTIMESTAMP + make_interval(secs => %s))
+               ON CONFLICT (scope, key) DO UPDATE
+               SET request_hash = EXCLUDED.request_hash,
+                   status = 'in_flight',
+                   response_status = NULL,
+                   response_body = NULL,
+                   created_at = LOCALTIMESTAMP,
+                   expires_at = EXCLUDED.expires_at
+               WHERE idempotency_keys.expires_at < LOCALTIMESTAMP
+                  OR (idempotency_keys.status = 'in_flight'
+                      AND idempotency_keys.created_at < LOCALTIMESTAMP - make_interval(secs => %s))
+               RETURNING 1""",
+            (scope, key, hashed, TTL_HOURS * 3600, STALE_SECONDS)
+        )
+        if cursor.fetchone():
+            conn.commit()
+            return None
+        cursor.execute(
+            """SELECT status, request_hash, response_status, response_body
+               FROM idempotency_keys WHERE scope = %s AND key = %s""",
+            (scope, key)
+        )
+        row = cursor.fetchone()
+    conn.rollback()
+    return row or ('in_flight', hashed, None, None)
+
+
+def _wait(conn: Any, scope: str, key: str) -> Optional[Tuple[str, str, Optional[int], Optional[str]]]:
+    '''Poll an in-flight or committed key until its owner stores a response or gives up.'''
+    deadline = time.monotonic() + WAIT_SECONDS
+    delay = 0.05
+    row = ('in_flight', '', None, None)
+    while time.monotonic() < deadline:
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """SELECT status, request_hash, response_status, response_body
+                   FROM idempotency_keys WHERE scope = %s AND key = %s""",
+                (scope, key)
+            )
+            row = cursor.fetchone()
+        conn.rollback()
+        if row is None or row[0] == 'completed':
+            return row
+    return row
+
+
+def _store(conn: Any, scope: str, key: str, status: int, body: str) -> None:
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """UPDATE idempotency_keys
+               SET status = 'completed', response_status = %s, response_body = %s
+               WHERE scope = %s AND key = %s""",
+            (status, body, scope, key)
+        )
+
+
+def _finish(conn: Any, scope: str, key: str, status: int, body: str) -> None:
+    _store(conn, scope, key, status, body)
+    conn.commit()
+
+
+def _storable(result: Dict[str, Any]) -> bool:
+    return result['statusCode'] < 500 and not result.get('isBase64Encoded')
+
+
+def active() -> bool:
+    '''Whether the running operation holds an Idempotency-Key claim.'''
+    return getattr(_local, 'claim', None) is not None
+
+
+def commit(conn: Any, result: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Commit the operation's work. Under guard() the response is stored in
+    the same transaction, so the key completes exactly when the work does.
+    Returns `result`.
+    '''
+    claim = getattr(_local, 'claim', None)
+    if claim is not None and _storable(result):
+        _store(conn, *claim, result['statusCode'], result['body'])
+        conn.commit()
+        _local.stored = True
+    else:
+        conn.commit()
+    return result
+
+
+def marker() -> Optional[Tuple[str, Tuple[str, str]]]:
+    '''
+    (sql, params) marking the claimed key 'committed', for an operation
+    that commits on another connection to run in that transaction; None
+    outside guard(). Call it on the request's thread.
+    '''
+    claim = getattr(_local, 'claim', None)
+    if claim is None:
+        return None
+    return "UPDATE idempotency_keys SET status = 'committed' WHERE scope = %s AND key = %s", claim
+
+
+def _release(conn: Any, scope: str, key: str) -> None:
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM idempotency_keys WHERE scope = %s AND key = %s AND status = 'in_flight'",
+            (scope, key)
+        )
+    conn.commit()
+
+
+def _purge(conn: Any) -> None:
+    global _last_purge
+    now = time.monotonic()
+    if now - _last_purge < PURGE_INTERVAL:
+        return
+    _last_purge = now
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """DELETE FROM idempotency_keys
+               WHERE ctid = ANY(ARRAY(
+                   SELECT ctid FROM idempotency_keys
+                   WHERE expires_at < LOCALTIMESTAMP
+                   LIMIT %s
+               ))""",
+            (PURGE_BATCH,)
+        )
+    conn.commit()
+
+
+def guard(conn: Any, scope: str, event: Dict[str, Any], body: Dict[str, Any],
+          operation: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+    '''
+    Run operation() at most once per Idempotency-Key within `scope`.
+    Requests without the header run unguarded. Responses below 500 are
+    stored and replayed; the operation must commit its work through
+    commit() (or marker()).
+    '''
+    key = response.header(event, HEADER).strip()
+    if not key:
+        return operation()
+    if len(key) > MAX_KEY_LENGTH:
+        return response.error(400, f'{HEADER} must be at most {MAX_KEY_LENGTH} characters')
+
+    hashed = request_hash(body)
+    cached = _cached(scope, key)
+    if cached:
+        return _replay(hashed, *cached)
+
+    existing = _claim(conn, scope, key, hashed)
+    if existing and existing[0] in ('in_flight', 'committed'):
+        existing = _wait(conn, scope, key)
+        if existing is None:
+            existing = _claim(conn, scope, key, hashed)
+    if existing:
+        status, stored_hash, stored_status, stored_body = existing
+        if status == 'in_flight':
+            return response.json_response(
+                409,
+                {'error': 'A request with this Idempotency-Key is still in progress', 'retry_after': 1},
+                headers={'Retry-After': '1', 'Access-Control-Expose-Headers': 'Retry-After'}
+            )
+        if status == 'committed':
+            return response.error(409, 'A request with this Idempotency-Key was processed, '
+                                       'but its response was not recorded')
+        _remember(scope, key, stored_hash, stored_status, stored_body)
+        return _replay(hashed, stored_hash, stored_status, stored_body)
+
+    _local.claim = (scope, key)
+    _local.stored = False
+    try:
+        result = operation()
+    except Exception:
+        conn.rollback()
+        _release(conn, scope, key)
+        raise
+    finally:
+        _local.claim = None
+
+    if _local.stored:
+        _remember(scope, key, hashed, result['statusCode'], result['body'])
+        _purge(conn)
+        return result
+
+    if not _storable(result):
+        _release(conn, scope, key)
+        return result
+
+    # No work was committed (validation errors), or it was committed on
+    # another connection with marker().
+    _finish(conn, scope, key, result['statusCode'], result['body'])
+    _remember(scope, key, hashed, result['statusCode'], result['body'])
+    _purge(conn)
+    return result
@@ -0,0 +1,274 @@
+'''
+Business: Precomputed top-works and top-authors leaderboards
+Args: LEADERBOARD_TOP_N - entries kept per list (default 100)
+      LEADERBOARD_REFRESH_INTERVAL - seconds between refreshes (default 60)
+      LEADERBOARD_CACHE_TTL - seconds a list is served from memory (default 30)
+      LEADERBOARD_PURCHASE_LAG - seconds a purchase must be old before it is folded (default 30)
+Returns: ranked pages via page(conn, board, metric, period, page, page_size)
+
+Lists are ranked from compact per-work statistics instead of purchases,
+commission_splits and works. refresh() first folds purchases past
+leaderboard_state.purchase_watermark into work_stats_hourly and
+work_stats (sales and author earnings), then re-ranks every
+board/metric/period list from those tables into leaderboard_entries.
+Views reach work_stats_hourly through the counters merge. Only purchases
+older than LEADERBOARD_PURCHASE_LAG are folded, and only up to the first
+younger one, so a slower purchase transaction that commits a lower id
+late is not skipped by the watermark.
+
+Refreshes run from cron every LEADERBOARD_REFRESH_INTERVAL (one at a
+time, behind an advisory lock), never from the read path: a fold and a
+full re-rank would otherwise land on whichever user request found the
+lists stale. Readers always get the last committed lists, flagged
+`stale` once they are older than the refresh interval.
+
+CLI: python -m shared.leaderboards refresh
+'''
+
+import json
+import os
+import sys
+import threading
+import time
+from typing import Dict, Any, List, Optional, Tuple
+
+TOP_N = int(os.environ.get('LEADERBOARD_TOP_N', 100))
+REFRESH_INTERVAL = float(os.environ.get('LEADERBOARD_REFRESH_INTERVAL', 60))
+CACHE_TTL = float(os.environ.get('LEADERBOARD_CACHE_TTL', 30))
+PURCHASE_LAG_SECONDS = float(os.environ.get('LEADERBOARD_PURCHASE_LAG', 30))
+FOLD_BATCH_SIZE = 10000
+
+BOARDS = ('works', 'authors')
+METRICS = ('sales', 'earnings', 'views')
+PERIODS = ('24h', '7d', 'all')
+
+_lock = threading.Lock()
+# (board, metric, period) -> (loaded_at, entries, refreshed_at, stale)
+_cache: Dict[Tuple[str, str, str], Tuple[float, List[Dict[str, Any]], Optional[str], bool]] = {}
+
+_FOLD_SQL = """
+    WITH state AS (
+        SELECT purchase_watermark AS watermark FROM leaderboard_state WHERE id = 1
+    ),
+    too_recent AS (
+        SELECT MIN(p.id) AS id
+        FROM purchases p, state
+        WHERE p.id > state.watermark
+          AND p.created_at >= LOCALTIMESTAMP - make_interval(secs => %(lag)s)
+    ),
+    batch AS (
+        SELECT p.id, p.work_id, p.transaction_id, p.created_at
+        FROM purchases p, state, too_recent
+        WHERE p.id > state.watermark
+          AND (too_recent.id IS NULL OR p.id < too_recent.id)
+        ORDER BY p.id
+        LIMIT %(limit)s
+    ),
+    deltas AS (
+        SELECT b.work_id, date_trunc('hour', b.created_at) AS bucket_start,
+               COUNT(*) AS sales, COALESCE(SUM(cs.amount), 0) AS earnings
+        FROM batch b
+        LEFT JOIN commission_splits cs ON cs.transaction_id = b.transaction_id AND cs.recipient_type = 'author'
+        GROUP BY 1, 2
+    ),
+    hourly AS (
+        INSERT INTO work_stats_hourly (work_id, bucket_start, sales, earnings)
+        SELECT work_id, bucket_start, sales, earnings FROM deltas
+        ON CONFLICT (work_id, bucket_start) DO UPDATE
+        SET sales = work_stats_hourly.sales + EXCLUDED.sales,
+            earnings = work_stats_hourly.earnings + EXCLUDED.earnings
+    ),
+    totals AS (
+        INSERT INTO work_stats (work_id, sales, earnings)
+        SELECT work_id, SUM(sales), SUM(earnings) FROM deltas GROUP BY work_id
+        ON CONFLICT (work_id) DO UPDATE
+        SET sales = work_stats.sales + EXCLUDED.sales,
+            earnings = work_stats.earnings + EXCLUDED.earnings
+    ),
+    advanced AS (
+        UPDATE leaderboard_state
+        SET purchase_watermark = (SELECT MAX(id) FROM batch)
+        WHERE id = 1 AND EXISTS (SELECT 1 FROM batch)
+    )
+    SELECT COUNT(*), MAX(id) FROM batch
+"""
+
+_RANK_SQL = """
+    WITH windowed AS (
+        SELECT p.period, s.work_id,
+               SUM(s.sales)::numeric AS sales, SUM(s.earnings) AS earnings, SUM(s.views)::numeric AS views
+        FROM (VALUES ('24h', 24), ('7d', 168)) AS p(period, hours)
+        JOIN work_stats_hourly s
+          ON s.bucket_start >= date_trunc('hour', LOCALTIMESTAMP) - make_interval(hours => p.hours - 1)
+        GROUP BY p.period, s.work_id
+    ),
+    all_time AS (
+        SELECT 'all', w.id, COALESCE(t.sales, 0)::numeric, COALESCE(t.earnings, 0), COALESCE(w.views, 0)::numeric
+        FROM works w
+        LEFT JOIN work_stats t ON t.work_id = w.id
+    ),
+    work_scores AS (
+        SELECT 'works' AS board, m.metric, s.period, s.work_id AS subject_id, m.score
+        FROM (SELECT * FROM windowed UNION ALL SELECT * FROM all_time) s
+        CROSS JOIN LATERAL (VALUES ('sales', s.sales), ('earnings', s.earnings), ('views', s.views)) AS m(metric, score)
+        WHERE m.score > 0
+    ),
+    author_scores AS (
+        SELECT 'authors' AS board, ws.metric, ws.period, w.author_id AS subject_id, SUM(ws.score) AS score
+        FROM work_scores ws
+        JOIN works w ON w.id = ws.subject_id
+        GROUP BY ws.metric, ws.period, w.author_id
+    ),
+    ranked AS (
+        SELECT board, metric, period, subject_id, score,
+               row_number() OVER (PARTITION BY board, metric, period ORDER BY score DESC, subject_id) AS rank
+        FROM (SELECT * FROM work_scores UNION ALL SELECT * FROM author_scores) scores
+    )
+    INSERT INTO leaderboard_entries (board, metric, period, rank, subject_id, score)
+    SELECT board, metric, period, rank, subject_id, score
+    FROM ranked
+    WHERE rank <= %(top_n)s
+"""
+
+
+def fold_purchases(conn: Any, limit: int = FOLD_BATCH_SIZE) -> Dict[str, Any]:
+    '''Fold purchases past the watermark into the per-work statistics.'''
+    folded, watermark = 0, None
+    with conn.cursor() as cursor:
+        while True:
+            cursor.execute(_FOLD_SQL, {'lag': PURCHASE_LAG_SECONDS, 'limit': limit})
+            count, last_id = cursor.fetchone()
+            folded += count
+            watermark = last_id or watermark
+            if count < limit:
+                break
+    return {'purchases': folded, 'watermark': watermark}
+
+
+def refresh(conn: Any, force: bool = False) -> Dict[str, Any]:
+    '''
+    Fold new purchases and re-rank all lists in one transaction; readers
+    keep seeing the previous lists until it commits. Skipped when another
+    instance is refreshing, or when the lists are fresh unless `force`.
+    '''
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_xact_lock(hashtext('leaderboard_refresh'))")
+        if not cursor.fetchone()[0]:
+            conn.rollback()
+            return {'refreshed': False}
+        if not force:
+            cursor.execute(
+                """SELECT refreshed_at IS NOT NULL
+                          AND refreshed_at > LOCALTIMESTAMP - make_interval(secs => %s)
+                   FROM leaderboard_state WHERE id = 1""",
+                (REFRESH_INTERVAL,)
+            )
+            if cursor.fetchone()[0]:
+                conn.rollback()
+                return {'refreshed': False}
+
+        started = time.perf_counter()
+        folded = fold_purchases(conn)
+        cursor.execute('DELETE FROM leaderboard_entries')
+        cursor.execute(_RANK_SQL, {'top_n': TOP_N})
+        entries = cursor.rowcount
+        cursor.execute('UPDATE leaderboard_state SET refreshed_at = LOCALTIMESTAMP WHERE id = 1')
+    conn.commit()
+    with _lock:
+        _cache.clear()
+    return {
+        'refreshed': True,
+        **folded,
+        'entries': entries,
+        'elapsed_seconds': round(time.perf_counter() - started, 3),
+    }
+
+
+def _load(conn: Any, board: str, metric: str, period: str) -> Tuple[List[Dict[str, Any]], Optional[str], bool]:
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """SELECT refreshed_at::text,
+                      refreshed_at IS NULL OR refreshed_at <= LOCALTIMESTAMP - make_interval(secs => %s)
+               FROM leaderboard_state WHERE id = 1""",
+            (REFRESH_INTERVAL,)
+        )
+        refreshed_at, stale = cursor.fetchone() or (None, True)
+        if board == 'works':
+            cursor.execute(
+                """SELECT e.rank, e.subject_id, e.score, w.title, w.author_id, u.name
+                   FROM leaderboard_entries e
+                   JOIN works w ON w.id = e.subject_id
+                   LEFT JOIN users u ON u.id = w.author_id
+                   WHERE e.board = 'works' AND e.metric = %s AND e.period = %s
+                   ORDER BY e.rank""",
+                (metric, period)
+            )
+            entries = [
+                {'rank': rank, 'work_id': work_id, 'title': title, 'author_id': author_id,
+                 'author_name': author_name, 'score': _score(metric, score)}
+                for rank, work_id, score, title, author_id, author_name in cursor.fetchall()
+            ]
+        else:
+            cursor.execute(
+                """SELECT e.rank, e.subject_id, e.score, u.name
+                   FROM leaderboard_entries e
+                   LEFT JOIN users u ON u.id = e.subject_id
+                   WHERE e.board = 'authors' AND e.metric = %s AND e.period = %s
+                   ORDER BY e.rank""",
+                (metric, period)
+            )
+            entries = [
+                {'rank': rank, 'author_id': author_id, 'name': name, 'score': _score(metric, score)}
+                for rank, author_id, score, name in cursor.fetchall()
+            ]
+    return entries, refreshed_at, stale
+
+
+def _score(metric: str, score: Any) -> Any:
+    return float(score) if metric == 'earnings' else int(score)
+
+
+def page(conn: Any, board: str, metric: str, period: str, page_number: int = 1,
+         page_size: int = 20) -> Dict[str, Any]:
+    '''
+    One page of a ranked list, served from memory for CACHE_TTL seconds.
+    Stale lists are served as they are; refreshing them is cron's job.
+    '''
+    key = (board, metric, period)
+    cached = _cache.get(key)
+    if cached is None or time.monotonic() - cached[0] > CACHE_TTL:
+        cached = (time.monotonic(), *_load(conn, board, metric, period))
+        with _lock:
+            _cache[key] = cached
+
+    _, entries, refreshed_at, stale = cached
+    offset = (page_number - 1) * page_size
+    return {
+        'board': board,
+        'metric': metric,
+        'period': period,
+        'page': page_number,
+        'page_size': page_size,
+        'total': len(entries),
+        'items': entries[offset:offset + page_size],
+        'refreshed_at': refreshed_at,
+        'stale': stale,
+    }
+
+
+def main(argv: List[str]) -> int:
+    if not argv or argv[0] != 'refresh':
+        print('usage: python -m shared.leaderboards refresh')
+        return 2
+
+    import psycopg2
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        print(json.dumps(refresh(conn, force=True)))
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
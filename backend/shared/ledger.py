@@ -0,0 +1,208 @@
+'''
+Business: Append-only author earnings ledger with batched settlement
+Args: cursor - cursor inside the caller's purchase transaction (append)
+      conn - connection for settlement and backlog reads
+Returns: nothing for writers; settled counts for settle()
+
+Purchases append one earnings_ledger row per sale instead of updating the
+author's wallet, summary and rollup rows, so concurrent purchases of one
+author's works never wait on each other's row locks. Settlement folds
+unsettled entries into wallets.balance, wallet_summaries.total_earned and
+commission_rollups in batches, all in one statement, so an entry is either
+pending or applied and never both. An author who had no wallet when the
+sale was appended gets one at settlement. Readers add the author's unsettled
+entries (served by the partial idx_earnings_ledger_unsettled index) to stay
+exact; the withdraw path settles the author's own entries under the wallet
+lock before checking funds.
+
+CLI: python -m shared.ledger settle [batch_size]
+     python -m shared.ledger pending
+'''
+
+import json
+import os
+import sys
+from typing import Dict, Any, List, Optional, Sequence, Tuple
+
+SETTLE_BATCH_SIZE = int(os.environ.get('LEDGER_SETTLE_BATCH_SIZE', 5000))
+
+_SETTLE_SQL = """
+    WITH batch AS (
+        SELECT e.id, COALESCE(e.wallet_id, w.id) AS wallet_id
+        FROM earnings_ledger e
+        LEFT JOIN wallets w ON e.wallet_id IS NULL AND w.user_id = e.author_id AND w.currency = 'RUB'
+        WHERE e.settled_at IS NULL
+          AND (e.wallet_id IS NOT NULL OR w.id IS NOT NULL)
+          AND (%(author_id)s::int IS NULL OR e.author_id = %(author_id)s::int)
+        ORDER BY e.id
+        LIMIT %(limit)s
+        FOR UPDATE OF e SKIP LOCKED
+    ),
+    settled AS (
+        UPDATE earnings_ledger e
+        SET settled_at = CURRENT_TIMESTAMP,
+            wallet_id = batch.wallet_id
+        FROM batch
+        WHERE e.id = batch.id
+        RETURNING e.author_id, e.wallet_id, e.author_amount, e.platform_amount, e.created_at
+    ),
+    per_wallet AS (
+        SELECT wallet_id, SUM(author_amount) AS amount
+        FROM settled
+        GROUP BY wallet_id
+    ),
+    locked AS (
+        SELECT w.id FROM wallets w
+        WHERE w.id IN (SELECT wallet_id FROM per_wallet)
+        ORDER BY w.id
+        FOR UPDATE
+    ),
+    credited AS (
+        UPDATE wallets w
+        SET balance = w.balance + p.amount,
+            updated_at = CURRENT_TIMESTAMP
+        FROM locked
+        JOIN per_wallet p ON p.wallet_id = locked.id
+        WHERE w.id = locked.id
+        RETURNING w.id
+    ),
+    summaries AS (
+        INSERT INTO wallet_summaries (user_id, total_earned, total_purchases, last_activity_at)
+        SELECT author_id, SUM(author_amount), 0, MAX(created_at)
+        FROM settled
+        GROUP BY author_id
+        ORDER BY author_id
+        ON CONFLICT (user_id) DO UPDATE
+        SET total_earned = wallet_summaries.total_earned + EXCLUDED.total_earned,
+            last_activity_at = GREATEST(wallet_summaries.last_activity_at, EXCLUDED.last_activity_at),
+            updated_at = CURRENT_TIMESTAMP
+        RETURNING user_id
+    ),
+    buckets AS (
+        INSERT INTO commission_rollups
+            (granularity, bucket_start, author_id, platform_total, author_total, transaction_count)
+        SELECT g.granularity, date_trunc(g.granularity, s.created_at), s.author_id,
+               SUM(s.platform_amount), SUM(s.author_amount), COUNT(*)
+        FROM settled s
+        CROSS JOIN (VALUES ('hour'), ('day')) AS g(granularity)
+        GROUP BY 1, 2, 3
+        ORDER BY 1, 2, 3
+        ON CONFLICT (granularity, bucket_start, author_id) DO UPDATE
+        SET platform_total = commission_rollups.platform_total + EXCLUDED.platform_total,
+            author_total = commission_rollups.author_total + EXCLUDED.author_total,
+            transaction_count = commission_rollups.transaction_count + EXCLUDED.transaction_count,
+            updated_at = CURRENT_TIMESTAMP
+        RETURNING 1
+    )
+    SELECT (SELECT COUNT(*) FROM settled),
+           (SELECT COUNT(*) FROM credited),
+           (SELECT COUNT(*) FROM summaries),
+           (SELECT COUNT(*) FROM buckets)
+"""
+
+# Entries appended before the author had a wallet carry a NULL wallet_id;
+# their wallets are created first, and the settle statement resolves them.
+# An entry whose wallet still cannot be found stays pending for a later run.
+_WALLETS_SQL = """
+    INSERT INTO wallets (user_id, balance, currency)
+    SELECT DISTINCT author_id, 0, 'RUB'
+    FROM earnings_ledger
+    WHERE settled_at IS NULL AND wallet_id IS NULL
+      AND (%(author_id)s::int IS NULL OR author_id = %(author_id)s::int)
+    ORDER BY author_id
+    ON CONFLICT (user_id, currency) DO NOTHING
+"""
+
+
+def append_sql(entries: Sequence[Tuple[int, int, Any, Any]]) -> Tuple[str, List[Any]]:
+    '''
+    Build the insert for (transaction_id, author_id, author_amount,
+    platform_amount) entries. wallet_id is resolved in SQL; authors without
+    a wallet get a NULL wallet_id, and settlement creates and credits it.
+    '''
+    rows: List[Any] = []
+    for entry in entries:
+        rows.extend(entry)
+    return (
+        f"""INSERT INTO earnings_ledger (transaction_id, author_id, wallet_id, author_amount, platform_amount)
+            SELECT v.transaction_id, v.author_id, w.id, v.author_amount, v.platform_amount
+            FROM (VALUES {', '.join(['(%s::int, %s::int, %s::numeric, %s::numeric)'] * len(entries))})
+                 AS v(transaction_id, author_id, author_amount, platform_amount)
+            LEFT JOIN wallets w ON w.user_id = v.author_id AND w.currency = 'RUB'""",
+        rows
+    )
+
+
+def append(cursor: Any, entries: Sequence[Tuple[int, int, Any, Any]]) -> None:
+    if entries:
+        cursor.execute(*append_sql(entries))
+
+
+def settle_batch(conn: Any, limit: Optional[int] = SETTLE_BATCH_SIZE,
+                 author_id: Optional[int] = None) -> Dict[str, int]:
+    '''
+    Settle up to `limit` of the oldest pending entries (all of them when
+    None) inside the caller's open transaction; the caller commits. Entries
+    locked by a concurrent settlement are skipped, not waited for; wallets,
+    summaries and rollup buckets are locked in key order.
+    '''
+    with conn.cursor() as cursor:
+        cursor.execute(_WALLETS_SQL, {'author_id': author_id})
+        cursor.execute(_SETTLE_SQL, {'limit': limit, 'author_id': author_id})
+        entries, wallets, authors, buckets = cursor.fetchone()
+    return {'entries': entries, 'wallets': wallets, 'authors': authors, 'buckets': buckets}
+
+
+def settle(conn: Any, batch_size: int = SETTLE_BATCH_SIZE, max_batches: Optional[int] = None) -> Dict[str, int]:
+    '''Settle pending entries batch by batch, committing after each one.'''
+    totals = {'entries': 0, 'wallets': 0, 'authors': 0, 'buckets': 0, 'batches': 0}
+    while max_batches is None or totals['batches'] < max_batches:
+        result = settle_batch(conn, batch_size)
+        conn.commit()
+        if not result['entries']:
+            break
+        totals['batches'] += 1
+        for key, value in result.items():
+            totals[key] += value
+    return totals
+
+
+def pending(conn: Any) -> Dict[str, Any]:
+    '''Size and age of the unsettled backlog.'''
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """SELECT COUNT(*), COALESCE(SUM(author_amount), 0)::float,
+                      COUNT(DISTINCT author_id), MIN(created_at)
+               FROM earnings_ledger
+               WHERE settled_at IS NULL"""
+        )
+        count, amount, authors, oldest = cursor.fetchone()
+    conn.rollback()
+    return {
+        'pending_entries': count,
+        'pending_amount': amount,
+        'pending_authors': authors,
+        'oldest_pending_at': oldest.isoformat() if oldest else None,
+    }
+
+
+def main(argv: List[str]) -> int:
+    if not argv or argv[0] not in ('settle', 'pending'):
+        print('usage: python -m shared.ledger settle [batch_size] | pending')
+        return 2
+
+    import psycopg2
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        if argv[0] == 'settle':
+            batch_size = int(argv[1]) if len(argv) > 1 else SETTLE_BATCH_SIZE
+            print(json.dumps(settle(conn, batch_size)))
+        else:
+            print(json.dumps(pending(conn)))
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
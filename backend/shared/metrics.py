@@ -0,0 +1,287 @@
+'''
+Business: Per-request SQL instrumentation and aggregated query histograms
+Args: METRICS_FLUSH_INTERVAL - seconds between flushes to query_metrics (default 60)
+Returns: one structured log line per invocation; histograms via report()
+
+Every statement run through a pooled connection is timed and fingerprinted
+(whitespace collapsed, repeated VALUES groups folded). Timings are tagged
+with context.request_id and summarised in a single JSON log line when the
+handler returns. Each instance also folds them into per-minute histograms
+and periodically upserts those into query_metrics, so the admin function
+can report slow statements and lock waits from every function.
+'''
+
+import functools
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import Dict, Any, List, Optional, Tuple, Callable
+
+HISTOGRAM_BOUNDS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 60))
+HANDLER_FINGERPRINT = '__handler__'
+CONNECT_FINGERPRINT = '__connect__'
+
+_WHITESPACE = re.compile(r'\s+')
+_VALUES_GROUPS = re.compile(r'(\([^()]*\))(\s*,\s*\([^()]*\))+')
+_LOCKING = re.compile(r'\bFOR UPDATE\b|^\s*(UPDATE|LOCK)\b', re.IGNORECASE)
+
+_local = threading.local()
+_lock = threading.Lock()
+_pending: Dict[Tuple[str, str], '_Stat'] = {}
+_last_flush = time.monotonic()
+
+
+def fingerprint(query: Any) -> Tuple[str, str]:
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    text = _WHITESPACE.sub(' ', str(query)).strip()
+    text = _VALUES_GROUPS.sub(r'\1, ...', text)
+    return hashlib.md5(text.encode()).hexdigest()[:12], text[:300]
+
+
+def bucket_index(ms: float) -> int:
+    for index, bound in enumerate(HISTOGRAM_BOUNDS_MS):
+        if ms <= bound:
+            return index
+    return len(HISTOGRAM_BOUNDS_MS)
+
+
+class _Stat:
+    __slots__ = ('statement', 'locking', 'calls', 'total_ms', 'max_ms', 'rows', 'histogram')
+
+    def __init__(self, statement: str, locking: bool):
+        self.statement = statement
+        self.locking = locking
+        self.calls = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.histogram = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+
+    def add(self, ms: float, rows: int) -> None:
+        self.calls += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.rows += max(rows, 0)
+        self.histogram[bucket_index(ms)] += 1
+
+
+class RequestMetrics:
+    def __init__(self, request_id: str, function: str):
+        self.request_id = request_id
+        self.function = function
+        self.started = time.perf_counter()
+        self.connect_ms = 0.0
+        self.db_route: Optional[str] = None
+        self.statements: List[Dict[str, Any]] = []
+
+
+def current() -> Optional[RequestMetrics]:
+    return getattr(_local, 'request', None)
+
+
+def record_statement(query: Any, ms: float, rows: int) -> None:
+    request = current()
+    if request is None:
+        return
+    fp, text = fingerprint(query)
+    request.statements.append({
+        'fingerprint': fp,
+        'statement': text,
+        'ms': round(ms, 3),
+        'rows': rows,
+        'locking': bool(_LOCKING.search(text)),
+    })
+
+
+def record_connect(ms: float) -> None:
+    request = current()
+    if request is not None:
+        request.connect_ms += ms
+
+
+def record_route(route: str) -> None:
+    '''Where shared.db routed this request's reads: 'replica' or 'primary'.'''
+    request = current()
+    if request is not None:
+        request.db_route = route
+
+
+def _aggregate(request: RequestMetrics, total_ms: float) -> None:
+    with _lock:
+        for item in request.statements:
+            key = (request.function, item['fingerprint'])
+            stat = _pending.get(key)
+            if stat is None:
+                stat = _pending[key] = _Stat(item['statement'], item['locking'])
+            stat.add(item['ms'], item['rows'])
+        for fp, label, ms in (
+            (HANDLER_FINGERPRINT, 'handler total', total_ms),
+            (CONNECT_FINGERPRINT, 'pool acquire / connect', request.connect_ms),
+        ):
+            key = (request.function, fp)
+            stat = _pending.get(key)
+            if stat is None:
+                stat = _pending[key] = _Stat(label, False)
+            stat.add(ms, 0)
+
+
+def flush(dsn: Optional[str] = None, force: bool = False) -> int:
+    '''Upsert pending histograms into query_metrics; best effort.'''
+    global _pending, _last_flush
+    now = time.monotonic()
+    if not force and now - _last_flush < FLUSH_INTERVAL:
+        return 0
+    with _lock:
+        pending, _pending = _pending, {}
+        _last_flush = now
+    if not pending:
+        return 0
+
+    from shared import db
+    rows: List[Any] = []
+    for (function, fp), stat in pending.items():
+        rows.extend([function, fp, stat.statement, stat.locking, stat.calls,
+                     round(stat.total_ms, 3), round(stat.max_ms, 3), stat.rows, stat.histogram])
+    try:
+        with db.connection(dsn) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    f"""INSERT INTO query_metrics
+                            (bucket_start, function_name, fingerprint, statement, locking,
+                             calls, total_ms, max_ms, row_count, histogram)
+                        SELECT date_trunc('minute', LOCALTIMESTAMP), v.*
+                        FROM (VALUES {', '.join(['(%s, %s, %s, %s, %s, %s::float8, %s::float8, %s, %s::int[])'] * len(pending))})
+                             AS v(function_name, fingerprint, statement, locking, calls, total_ms, max_ms, row_count, histogram)
+                        ON CONFLICT (bucket_start, function_name, fingerprint) DO UPDATE
+                        SET calls = query_metrics.calls + EXCLUDED.calls,
+                            total_ms = query_metrics.total_ms + EXCLUDED.total_ms,
+                            max_ms = GREATEST(query_metrics.max_ms, EXCLUDED.max_ms),
+                            row_count = query_metrics.row_count + EXCLUDED.row_count,
+                            histogram = ARRAY(
+                                SELECT a + b FROM unnest(query_metrics.histogram, EXCLUDED.histogram) AS h(a, b)
+                            )""",
+                    rows
+                )
+            conn.commit()
+    except Exception as e:
+        print(json.dumps({'metrics_flush_error': str(e)}))
+        return 0
+    return len(pending)
+
+
+def instrumented(function_name: str) -> Callable[[Callable[..., Dict[str, Any]]], Callable[..., Dict[str, Any]]]:
+    '''Decorate a function handler: time it, log one line, aggregate and flush.'''
+    def decorate(handler: Callable[[Dict[str, Any], Any], Dict[str, Any]]) -> Callable[[Dict[str, Any], Any], Dict[str, Any]]:
+        @functools.wraps(handler)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            request = RequestMetrics(getattr(context, 'request_id', '') or '', function_name)
+            _local.request = request
+            status = 500
+            try:
+                result = handler(event, context)
+                status = result.get('statusCode', 200)
+                return result
+            finally:
+                _local.request = None
+                total_ms = (time.perf_counter() - request.started) * 1000
+                db_ms = sum(item['ms'] for item in request.statements)
+                slowest = sorted(request.statements, key=lambda item: item['ms'], reverse=True)[:3]
+                from shared import db
+                print(json.dumps({
+                    'request_id': request.request_id,
+                    'function': function_name,
+                    'method': event.get('httpMethod'),
+                    'status': status,
+                    'total_ms': round(total_ms, 3),
+                    'connect_ms': round(request.connect_ms, 3),
+                    'db_route': request.db_route,
+                    'db_ms': round(db_ms, 3),
+                    'lock_statement_ms': round(sum(item['ms'] for item in request.statements if item['locking']), 3),
+                    'statements': len(request.statements),
+                    'slowest': [
+                        {'fingerprint': item['fingerprint'], 'ms': item['ms'], 'rows': item['rows']}
+                        for item in slowest
+                    ],
+                    'db_pool': db.pool_stats(),
+                }))
+                if event.get('httpMethod') != 'OPTIONS':
+                    _aggregate(request, total_ms)
+                    if os.environ.get('DATABASE_URL'):
+                        flush()
+
+        return wrapper
+
+    return decorate
+
+
+def _percentile(histogram: List[int], pct: float) -> Optional[float]:
+    total = sum(histogram)
+    if not total:
+        return None
+    threshold = total * pct / 100
+    running = 0
+    for index, count in enumerate(histogram):
+        running += count
+        if running >= threshold:
+            return float(HISTOGRAM_BOUNDS_MS[index]) if index < len(HISTOGRAM_BOUNDS_MS) else None
+    return None
+
+
+def report(conn: Any, minutes: int = 60, function: Optional[str] = None, limit: int = 50) -> Dict[str, Any]:
+    '''
+    Aggregate query_metrics over the last `minutes`. Percentiles are the
+    upper bound of the histogram bucket (None = above the last bound).
+    '''
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """SELECT function_name, fingerprint, statement, locking, calls, total_ms, max_ms, row_count, histogram
+               FROM query_metrics
+               WHERE bucket_start >= date_trunc('minute', LOCALTIMESTAMP) - make_interval(mins => %s)
+                 AND (%s::text IS NULL OR function_name = %s::text)""",
+            (minutes, function, function)
+        )
+        rows = cursor.fetchall()
+
+    merged: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for function_name, fp, statement, locking, calls, total_ms, max_ms, row_count, histogram in rows:
+        entry = merged.setdefault((function_name, fp), {
+            'function': function_name,
+            'fingerprint': fp,
+            'statement': statement,
+            'locking': locking,
+            'calls': 0,
+            'total_ms': 0.0,
+            'max_ms': 0.0,
+            'rows': 0,
+            'histogram': [0] * (len(HISTOGRAM_BOUNDS_MS) + 1),
+        })
+        entry['calls'] += calls
+        entry['total_ms'] += total_ms
+        entry['max_ms'] = max(entry['max_ms'], max_ms)
+        entry['rows'] += row_count
+        entry['histogram'] = [a + b for a, b in zip(entry['histogram'], histogram)]
+
+    entries = sorted(merged.values(), key=lambda entry: entry['total_ms'], reverse=True)
+    for entry in entries:
+        entry['mean_ms'] = round(entry['total_ms'] / entry['calls'], 3) if entry['calls'] else 0.0
+        entry['total_ms'] = round(entry['total_ms'], 3)
+        entry['p50_ms'] = _percentile(entry['histogram'], 50)
+        entry['p95_ms'] = _percentile(entry['histogram'], 95)
+        entry['p99_ms'] = _percentile(entry['histogram'], 99)
+
+    handlers = [entry for entry in entries if entry['fingerprint'] == HANDLER_FINGERPRINT]
+    connects = [entry for entry in entries if entry['fingerprint'] == CONNECT_FINGERPRINT]
+    statements = [entry for entry in entries if not entry['fingerprint'].startswith('__')]
+    return {
+        'minutes': minutes,
+        'histogram_bounds_ms': list(HISTOGRAM_BOUNDS_MS),
+        'handlers': handlers,
+        'connect': connects,
+        'statements': statements[:limit],
+        'lock_statements': [entry for entry in statements if entry['locking']][:limit],
+    }
@@ -0,0 +1,295 @@
+'''
+Business: Monthly partitions of transactions and commission_splits
+Args: conn - the job's own connection
+      PARTITIONS_AHEAD - future months kept created (default 3)
+      PARTITIONS_RETAIN_MONTHS - months kept attached before archiving (default 24)
+      PARTITIONS_ARCHIVE_DIR - where archived months are exported (default ./archive)
+Returns: created partitions via ensure(); exported months via archive()
+
+Both tables are range-partitioned on created_at (V0014), one partition
+per month, so date-bounded scans only touch the months they cover and
+vacuum works month by month. ensure() creates the current month and the
+next PARTITIONS_AHEAD months through ensure_month_partition(), which also
+moves rows out of the default partition if the job was late; run it from
+cron daily.
+
+archive() retires months older than the retention window, oldest first,
+in two steps. First, in one transaction, the month's totals are folded
+into archived_totals (so wallet summaries and reconciliation still add
+up) and both of its partitions are detached. Then each detached table is
+exported to <dir>/<partition>.csv.gz with COPY, fsynced, recorded in
+partition_archives and dropped. A run that dies between the steps
+resumes the exports on the next start. A month with unsettled earnings
+or pending transactions is never archived.
+
+CLI: python -m shared.partitions ensure [--ahead N]
+     python -m shared.partitions archive [--older-than N] [--dir PATH] [--keep]
+     python -m shared.partitions status
+'''
+
+import argparse
+import gzip
+import json
+import os
+import sys
+from datetime import date
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+
+PARENTS = ('transactions', 'commission_splits')
+AHEAD = int(os.environ.get('PARTITIONS_AHEAD', 3))
+RETAIN_MONTHS = int(os.environ.get('PARTITIONS_RETAIN_MONTHS', 24))
+ARCHIVE_DIR = os.environ.get('PARTITIONS_ARCHIVE_DIR', 'archive')
+# DDL on the parents waits at most this long for a lock instead of
+# queueing every payment behind it.
+LOCK_TIMEOUT = '5s'
+
+_ENSURE_SQL = """
+    SELECT created
+    FROM unnest(%(parents)s::text[]) AS p(parent)
+    CROSS JOIN generate_series(
+        date_trunc('month', LOCALTIMESTAMP),
+        date_trunc('month', LOCALTIMESTAMP) + make_interval(months => %(ahead)s),
+        interval '1 month'
+    ) AS m(month)
+    CROSS JOIN LATERAL ensure_month_partition(p.parent, m.month::date) AS created
+    WHERE created IS NOT NULL
+"""
+
+_ARCHIVABLE_SQL = """
+    SELECT to_date(right(c.relname, 7), 'YYYY_MM') AS month
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'transactions'::regclass
+      AND c.relname ~ '^transactions_p[0-9]{4}_[0-9]{2}$'
+      AND to_date(right(c.relname, 7), 'YYYY_MM')
+          < date_trunc('month', LOCALTIMESTAMP) - make_interval(months => %(older_than)s)
+    ORDER BY 1
+"""
+
+_BLOCKERS_SQL = """
+    SELECT (SELECT COUNT(*) FROM {transactions} WHERE status = 'pending')
+         + (SELECT COUNT(*) FROM earnings_ledger l
+            JOIN {transactions} t ON t.id = l.transaction_id
+            WHERE l.settled_at IS NULL)
+"""
+
+# The month's share of what wallet_summary and reconcile compute from the
+# live tables, attributed the same way (see those modules).
+_FOLD_SQL = """
+    WITH earned AS (
+        SELECT recipient_id AS user_id, SUM(amount) AS earned, MAX(created_at) AS last_at
+        FROM {splits}
+        WHERE recipient_type = 'author' AND status = 'completed' AND recipient_id IS NOT NULL
+        GROUP BY recipient_id
+    ),
+    credited AS (
+        SELECT w.user_id, SUM(cs.amount) AS credited
+        FROM {splits} cs
+        LEFT JOIN earnings_ledger l ON l.transaction_id = cs.transaction_id
+        LEFT JOIN wallets fallback ON l.id IS NULL AND fallback.user_id = cs.recipient_id
+                                  AND fallback.currency = 'RUB'
+        JOIN wallets w ON w.id = COALESCE(l.wallet_id, fallback.id)
+        WHERE cs.recipient_type = 'author'
+          AND cs.status = 'completed'
+          AND (l.id IS NULL OR l.settled_at IS NOT NULL)
+        GROUP BY w.user_id
+    ),
+    paid AS (
+        SELECT w.user_id, SUM(t.amount) AS subscriptions
+        FROM {transactions} t
+        JOIN wallets w ON w.id = t.wallet_id
+        WHERE t.type = 'subscription' AND t.status = 'completed'
+        GROUP BY w.user_id
+    ),
+    totals AS (
+        SELECT user_id, SUM(earned) AS earned, MAX(last_at) AS last_at,
+               SUM(credited) AS credited, SUM(subscriptions) AS subscriptions
+        FROM (
+            SELECT user_id, earned, last_at, 0 AS credited, 0 AS subscriptions FROM earned
+            UNION ALL
+            SELECT user_id, 0, NULL, credited, 0 FROM credited
+            UNION ALL
+            SELECT user_id, 0, NULL, 0, subscriptions FROM paid
+        ) s
+        GROUP BY user_id
+    )
+    INSERT INTO archived_totals (user_id, earned, last_earned_at, credited, subscriptions)
+    SELECT user_id, earned, last_at, credited, subscriptions
+    FROM totals
+    ORDER BY user_id
+    ON CONFLICT (user_id) DO UPDATE
+    SET earned = archived_totals.earned + EXCLUDED.earned,
+        last_earned_at = GREATEST(archived_totals.last_earned_at, EXCLUDED.last_earned_at),
+        credited = archived_totals.credited + EXCLUDED.credited,
+        subscriptions = archived_totals.subscriptions + EXCLUDED.subscriptions,
+        updated_at = LOCALTIMESTAMP
+"""
+
+
+def partition_name(parent: str, month: date) -> str:
+    return f'{parent}_p{month:%Y_%m}'
+
+
+def ensure(conn: Any, ahead: int = AHEAD) -> List[str]:
+    '''Create this month's and the next `ahead` months' partitions; returns the new ones.'''
+    with conn.cursor() as cursor:
+        cursor.execute('SET LOCAL lock_timeout = %s', (LOCK_TIMEOUT,))
+        cursor.execute(_ENSURE_SQL, {'parents': list(PARENTS), 'ahead': ahead})
+        created = [row[0] for row in cursor.fetchall()]
+    conn.commit()
+    return created
+
+
+def _detach(conn: Any, month: date) -> Optional[str]:
+    '''
+    Fold the month into archived_totals and detach its partitions, in one
+    transaction. Returns why the month was skipped, or None.
+    '''
+    tables = {'transactions': partition_name('transactions', month),
+              'splits': partition_name('commission_splits', month)}
+    with conn.cursor() as cursor:
+        cursor.execute('SET LOCAL lock_timeout = %s', (LOCK_TIMEOUT,))
+        cursor.execute(_BLOCKERS_SQL.format(**tables))
+        blockers = cursor.fetchone()[0]
+        if blockers:
+            conn.rollback()
+            return f'{blockers} pending transactions or unsettled earnings'
+        cursor.execute(_FOLD_SQL.format(**tables))
+        for parent in PARENTS:
+            partition = partition_name(parent, month)
+            cursor.execute(f'ALTER TABLE {parent} DETACH PARTITION {partition}')
+            cursor.execute(
+                f"""INSERT INTO partition_archives (partition, parent, month, row_count)
+                    SELECT %s, %s, %s, COUNT(*) FROM {partition}""",
+                (partition, parent, month)
+            )
+    conn.commit()
+    return None
+
+
+def _export(conn: Any, partition: str, directory: Path, keep: bool) -> Dict[str, Any]:
+    '''COPY a detached partition into a gzipped CSV, then record and drop it.'''
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f'{partition}.csv.gz'
+    partial = directory / f'{partition}.csv.gz.partial'
+    with open(partial, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as compressed:
+            with conn.cursor() as cursor:
+                cursor.copy_expert(f'COPY {partition} TO STDOUT WITH (FORMAT csv, HEADER)', compressed)
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(partial, path)
+
+    file_bytes = path.stat().st_size
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """UPDATE partition_archives
+               SET status = 'archived', file_path = %s, file_bytes = %s, archived_at = LOCALTIMESTAMP
+               WHERE partition = %s
+               RETURNING row_count""",
+            (str(path.resolve()), file_bytes, partition)
+        )
+        row_count = cursor.fetchone()[0]
+        if not keep:
+            cursor.execute(f'DROP TABLE {partition}')
+    conn.commit()
+    return {'partition': partition, 'rows': row_count, 'file': str(path), 'bytes': file_bytes}
+
+
+def archive(conn: Any, older_than: int = RETAIN_MONTHS, directory: str = ARCHIVE_DIR,
+            keep: bool = False) -> Dict[str, Any]:
+    '''
+    Detach and export every month older than `older_than` months, oldest
+    first, stopping at the first month that cannot be archived yet. With
+    keep=True the detached tables are left in place after the export.
+    Only one archiver runs at a time.
+    '''
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(hashtext('partition_archive'))")
+        if not cursor.fetchone()[0]:
+            conn.rollback()
+            return {'started': False, 'reason': 'another archive run is in progress'}
+    skipped = None
+    exported: List[Dict[str, Any]] = []
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(_ARCHIVABLE_SQL, {'older_than': older_than})
+            months = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+        for month in months:
+            reason = _detach(conn, month)
+            if reason:
+                skipped = {'month': month.isoformat(), 'reason': reason}
+                break
+
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT partition FROM partition_archives WHERE status = 'detached' ORDER BY month, parent")
+            pending = [row[0] for row in cursor.fetchall()]
+        conn.commit()
+        for partition in pending:
+            exported.append(_export(conn, partition, Path(directory), keep))
+            print(json.dumps({'archived': exported[-1]}))
+    finally:
+        conn.rollback()
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_unlock(hashtext('partition_archive'))")
+        conn.commit()
+
+    return {'started': True, 'exported': exported, 'skipped': skipped}
+
+
+def status(conn: Any) -> Dict[str, Any]:
+    '''Attached partitions with their estimated rows and size, plus archived months.'''
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """SELECT parent.relname, child.relname, pg_get_expr(child.relpartbound, child.oid),
+                      GREATEST(child.reltuples, 0)::bigint, pg_total_relation_size(child.oid)
+               FROM pg_inherits i
+               JOIN pg_class parent ON parent.oid = i.inhparent
+               JOIN pg_class child ON child.oid = i.inhrelid
+               WHERE parent.relname = ANY(%s) AND child.relkind = 'r'
+               ORDER BY parent.relname, child.relname""",
+            (list(PARENTS),)
+        )
+        attached = [
+            {'parent': parent, 'partition': partition, 'bounds': bounds, 'estimated_rows': rows, 'bytes': size}
+            for parent, partition, bounds, rows, size in cursor.fetchall()
+        ]
+        cursor.execute(
+            """SELECT partition, status, row_count, file_path, file_bytes, archived_at::text
+               FROM partition_archives
+               ORDER BY month, parent"""
+        )
+        columns = ('partition', 'status', 'rows', 'file', 'bytes', 'archived_at')
+        archived = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    conn.rollback()
+    return {'attached': attached, 'archived': archived}
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(prog='python -m shared.partitions')
+    parser.add_argument('command', choices=['ensure', 'archive', 'status'])
+    parser.add_argument('--ahead', type=int, default=AHEAD)
+    parser.add_argument('--older-than', type=int, default=RETAIN_MONTHS, help='months to keep attached')
+    parser.add_argument('--dir', default=ARCHIVE_DIR)
+    parser.add_argument('--keep', action='store_true', help='keep detached tables after exporting them')
+    args = parser.parse_args(argv)
+
+    import psycopg2
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        if args.command == 'ensure':
+            result: Dict[str, Any] = {'created': ensure(conn, args.ahead)}
+        elif args.command == 'archive':
+            result = archive(conn, args.older_than, args.dir, args.keep)
+        else:
+            result = status(conn)
+        print(json.dumps(result))
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,78 @@
+'''
+Business: Payout providers used by the withdrawal worker
+Args: PAYOUT_PROVIDER - 'package.module:ClassName', or 'fake' for local runs (required)
+Returns: a PayoutResult per withdrawal from provider.send()
+
+A provider sends one payout and reports whether it went through. send()
+is called from worker threads, so implementations must be thread-safe.
+The withdrawal id is passed as the payout reference; a real provider
+should use it as its idempotency key, because a withdrawal whose worker
+died mid-batch is claimed and sent again.
+
+There is no default provider: the fake one marks payouts as sent without
+moving money, so it has to be chosen explicitly.
+'''
+
+import importlib
+import os
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Any, NamedTuple, Optional
+
+
+class PayoutResult(NamedTuple):
+    ok: bool
+    reference: Optional[str] = None
+    reason: Optional[str] = None
+
+
+class PayoutError(Exception):
+    '''Outcome unknown (timeout, 5xx); the withdrawal is retried.'''
+
+
+class PayoutProvider(ABC):
+    @abstractmethod
+    def send(self, withdrawal: Dict[str, Any]) -> PayoutResult:
+        '''Send one payout; raise PayoutError when the outcome is unknown.'''
+
+
+class FakePayoutProvider(PayoutProvider):
+    '''
+    Local stand-in: sleeps `latency` seconds per payout, declines card
+    numbers ending in 0000 and randomly declines `failure_rate` of the rest.
+    Sent payouts are recorded in `sent` for assertions.
+    '''
+
+    def __init__(self, latency: float = 0.05, failure_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.sent: Dict[int, PayoutResult] = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def send(self, withdrawal: Dict[str, Any]) -> PayoutResult:
+        if self.latency:
+            time.sleep(self.latency)
+        details = withdrawal.get('payment_details') or {}
+        with self._lock:
+            declined = str(details.get('card_number', '')).endswith('0000') or self._rng.random() < self.failure_rate
+            result = (
+                PayoutResult(False, reason='Declined by provider') if declined
+                else PayoutResult(True, reference=f"fake-{withdrawal['id']}")
+            )
+            self.sent[withdrawal['id']] = result
+        return result
+
+
+def load_provider(spec: Optional[str] = None) -> PayoutProvider:
+    spec = spec or os.environ.get('PAYOUT_PROVIDER')
+    if not spec:
+        raise ValueError("PAYOUT_PROVIDER is not set: use 'package.module:ClassName', or 'fake' for local runs")
+    if spec == 'fake':
+        return FakePayoutProvider(latency=float(os.environ.get('FAKE_PAYOUT_LATENCY', 0.05)))
+    module_name, _, class_name = spec.partition(':')
+    if not class_name:
+        raise ValueError("PAYOUT_PROVIDER must be 'fake' or 'package.module:ClassName'")
+    return getattr(importlib.import_module(module_name), class_name)()
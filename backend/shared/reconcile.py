@@ -0,0 +1,219 @@
+'''
+Business: Streaming reconciliation of wallet balances against the money trail
+Args: conn - connection the audit runs on (one read-only snapshot)
+      RECONCILE_CHUNK_ROWS - rows fetched per round trip (default 50000)
+Returns: mismatched wallets and split rounding drift via reconcile()
+
+A wallet's balance should equal the author splits credited to it (splits
+whose earnings ledger entry is settled into this wallet, or older splits
+credited directly), minus withdrawals that were not refunded, minus
+subscription renewals paid from it. Months archived by shared.partitions
+count through archived_totals. Each source is aggregated per wallet
+by Postgres (GROUP BY wallet_id ORDER BY wallet_id) and streamed through
+a server-side cursor, and the sorted streams are merged with the wallets
+table in one pass, so memory stays bounded by the chunk size however many
+rows or wallets there are. Amounts are compared in integer kopecks.
+
+Drift: every transaction whose platform and author splits do not add up
+to its amount, or whose ledger entry disagrees with its author split, is
+counted and sampled; older code computed splits with float arithmetic.
+
+CLI: python -m shared.reconcile [from_wallet_id to_wallet_id]
+'''
+
+import json
+import os
+import sys
+import time
+from typing import Dict, Any, Iterator, List, Optional, Tuple
+
+CHUNK_ROWS = int(os.environ.get('RECONCILE_CHUNK_ROWS', 50000))
+MAX_SAMPLES = 50
+MAX_WALLET_ID = 2147483647
+
+_WALLETS_SQL = """
+    SELECT w.id, w.user_id, w.balance, a.credited, a.subscriptions
+    FROM wallets w
+    LEFT JOIN archived_totals a ON a.user_id = w.user_id AND w.currency = 'RUB'
+    WHERE w.id BETWEEN %(from_id)s AND %(to_id)s
+    ORDER BY w.id
+"""
+
+_CREDITS_SQL = """
+    SELECT COALESCE(l.wallet_id, w.id) AS wallet_id, SUM(cs.amount)
+    FROM commission_splits cs
+    LEFT JOIN earnings_ledger l ON l.transaction_id = cs.transaction_id
+    LEFT JOIN wallets w ON l.id IS NULL AND w.user_id = cs.recipient_id AND w.currency = 'RUB'
+    WHERE cs.recipient_type = 'author'
+      AND cs.status = 'completed'
+      AND (l.id IS NULL OR l.settled_at IS NOT NULL)
+      AND COALESCE(l.wallet_id, w.id) BETWEEN %(from_id)s AND %(to_id)s
+    GROUP BY 1
+    ORDER BY 1
+"""
+
+_WITHDRAWALS_SQL = """
+    SELECT wallet_id, SUM(amount)
+    FROM withdrawals
+    WHERE status <> 'failed'
+      AND wallet_id BETWEEN %(from_id)s AND %(to_id)s
+    GROUP BY wallet_id
+    ORDER BY wallet_id
+"""
+
+_DEBITS_SQL = """
+    SELECT wallet_id, SUM(amount)
+    FROM transactions
+    WHERE type = 'subscription'
+      AND status = 'completed'
+      AND wallet_id BETWEEN %(from_id)s AND %(to_id)s
+    GROUP BY wallet_id
+    ORDER BY wallet_id
+"""
+
+_DRIFT_SQL = """
+    SELECT t.id, t.amount, s.platform_amount, s.author_amount, l.author_amount
+    FROM (
+        SELECT transaction_id,
+               COALESCE(SUM(amount) FILTER (WHERE recipient_type = 'platform'), 0) AS platform_amount,
+               COALESCE(SUM(amount) FILTER (WHERE recipient_type = 'author'), 0) AS author_amount
+        FROM commission_splits
+        GROUP BY transaction_id
+    ) s
+    JOIN transactions t ON t.id = s.transaction_id
+    LEFT JOIN earnings_ledger l ON l.transaction_id = t.id
+    WHERE t.wallet_id BETWEEN %(from_id)s AND %(to_id)s
+      AND (s.platform_amount + s.author_amount <> t.amount
+           OR l.author_amount <> s.author_amount)
+"""
+
+
+def _cents(amount: Any) -> int:
+    return int((amount or 0) * 100)
+
+
+def _stream(conn: Any, name: str, sql: str, params: Dict[str, Any]) -> Iterator[Tuple[Any, ...]]:
+    '''Rows of `sql` from a server-side cursor, CHUNK_ROWS per round trip.'''
+    with conn.cursor(name=f'reconcile_{name}') as cursor:
+        cursor.itersize = CHUNK_ROWS
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(CHUNK_ROWS)
+            if not rows:
+                return
+            yield from rows
+
+
+class _Totals:
+    '''Walks a wallet_id-ordered stream of (wallet_id, total) alongside the wallets.'''
+
+    def __init__(self, rows: Iterator[Tuple[Any, ...]]):
+        self._rows = rows
+        self._next = next(rows, None)
+
+    def take(self, wallet_id: int) -> int:
+        cents = 0
+        while self._next is not None and self._next[0] <= wallet_id:
+            if self._next[0] == wallet_id:
+                cents = _cents(self._next[1])
+            self._next = next(self._rows, None)
+        return cents
+
+    def close(self) -> None:
+        self._rows.close()
+
+
+def reconcile(conn: Any, from_wallet_id: Optional[int] = None, to_wallet_id: Optional[int] = None,
+              max_samples: int = MAX_SAMPLES) -> Dict[str, Any]:
+    '''Audit wallets in [from_wallet_id, to_wallet_id] inside one read-only snapshot.'''
+    params = {'from_id': from_wallet_id or 0, 'to_id': to_wallet_id or MAX_WALLET_ID}
+    started = time.perf_counter()
+    conn.rollback()
+    with conn.cursor() as cursor:
+        cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+
+    credits = _Totals(_stream(conn, 'credits', _CREDITS_SQL, params))
+    withdrawals = _Totals(_stream(conn, 'withdrawals', _WITHDRAWALS_SQL, params))
+    debits = _Totals(_stream(conn, 'debits', _DEBITS_SQL, params))
+
+    wallets = mismatched = 0
+    mismatch_cents = 0
+    samples: List[Dict[str, Any]] = []
+    for wallet_id, user_id, balance, archived_credited, archived_debited in _stream(conn, 'wallets', _WALLETS_SQL, params):
+        wallets += 1
+        credited = credits.take(wallet_id) + _cents(archived_credited)
+        withdrawn = withdrawals.take(wallet_id)
+        debited = debits.take(wallet_id) + _cents(archived_debited)
+        expected = credited - withdrawn - debited
+        diff = _cents(balance) - expected
+        if diff:
+            mismatched += 1
+            mismatch_cents += abs(diff)
+            if len(samples) < max_samples:
+                samples.append({
+                    'wallet_id': wallet_id,
+                    'user_id': user_id,
+                    'balance': _cents(balance) / 100,
+                    'expected': expected / 100,
+                    'difference': diff / 100,
+                    'credited': credited / 100,
+                    'withdrawn': withdrawn / 100,
+                    'subscriptions': debited / 100,
+                })
+    for totals in (credits, withdrawals, debits):
+        totals.close()
+
+    drifted = ledger_mismatches = 0
+    drift_cents = 0
+    drift_samples: List[Dict[str, Any]] = []
+    for transaction_id, amount, platform_amount, author_amount, ledger_amount in _stream(conn, 'drift', _DRIFT_SQL, params):
+        drift = _cents(platform_amount) + _cents(author_amount) - _cents(amount)
+        if drift:
+            drifted += 1
+            drift_cents += abs(drift)
+        if ledger_amount is not None and _cents(ledger_amount) != _cents(author_amount):
+            ledger_mismatches += 1
+        if len(drift_samples) < max_samples:
+            drift_samples.append({
+                'transaction_id': transaction_id,
+                'amount': float(amount),
+                'platform_amount': float(platform_amount),
+                'author_amount': float(author_amount),
+                'ledger_author_amount': float(ledger_amount) if ledger_amount is not None else None,
+            })
+    conn.rollback()
+
+    return {
+        'wallets': wallets,
+        'mismatched_wallets': mismatched,
+        'mismatch_total': mismatch_cents / 100,
+        'mismatches': samples,
+        'drift': {
+            'transactions': drifted,
+            'total': drift_cents / 100,
+            'ledger_mismatches': ledger_mismatches,
+            'samples': drift_samples,
+        },
+        'consistent': mismatched == 0 and drifted == 0 and ledger_mismatches == 0,
+        'elapsed_seconds': round(time.perf_counter() - started, 3),
+    }
+
+
+def main(argv: List[str]) -> int:
+    if len(argv) not in (0, 2):
+        print('usage: python -m shared.reconcile [from_wallet_id to_wallet_id]')
+        return 2
+
+    import psycopg2
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        bounds = [int(value) for value in argv] or [None, None]
+        result = reconcile(conn, *bounds)
+        print(json.dumps(result))
+        return 0 if result['consistent'] else 1
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
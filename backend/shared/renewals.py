@@ -0,0 +1,287 @@
+'''
+Business: Set-based subscription auto-renewal with resumable checkpoints
+Args: conn - the job's own connection
+      RENEWAL_CHUNK_SIZE - subscriptions renewed per statement (default 2000)
+      RENEWAL_LEAD_HOURS - renew subscriptions expiring this far ahead (default 24)
+      RENEWAL_GRACE_DAYS - days a failed renewal stays past_due (default 3)
+Returns: per-run counts of renewed and failed subscriptions
+
+A run renews every auto-renewing subscription that expires before its
+horizon, in id order, one chunk per statement: subscribers' wallets are
+locked in id order and debited once each, transactions, commission splits
+and earnings ledger entries are written as multi-row inserts, and
+expires_at is extended by the plan's period. Authors are credited through
+the earnings ledger, whose settlement (run at the end of each run)
+applies one aggregated update per author wallet. A subscriber whose
+balance does not cover the renewal is moved to 'past_due', and to
+'expired' once the grace period has passed.
+
+The run's checkpoint and counters in renewal_runs are updated by the same
+statement, so a chunk is either fully applied and checkpointed or not at
+all; a run that dies is resumed from its checkpoint by the next start.
+Each chunk prints one JSON progress line.
+
+CLI: python -m shared.renewals renew [--chunk-size N] [--max-chunks N]
+     python -m shared.renewals status
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Dict, Any, List, Optional
+from shared import ledger, settings
+
+CHUNK_SIZE = int(os.environ.get('RENEWAL_CHUNK_SIZE', 2000))
+LEAD_HOURS = int(os.environ.get('RENEWAL_LEAD_HOURS', 24))
+GRACE_DAYS = int(os.environ.get('RENEWAL_GRACE_DAYS', 3))
+
+_CHUNK_SQL = """
+    WITH chunk AS (
+        SELECT s.id, s.subscriber_id, s.author_id, s.plan_type, s.price, s.expires_at
+        FROM subscriptions s
+        WHERE s.id > %(after_id)s
+          AND s.auto_renew
+          AND s.status IN ('active', 'past_due')
+          AND s.expires_at <= %(horizon)s
+        ORDER BY s.id
+        LIMIT %(limit)s
+        FOR UPDATE
+    ),
+    subscriber_wallets AS (
+        SELECT w.id, w.user_id, w.balance
+        FROM wallets w
+        WHERE w.currency = 'RUB' AND w.user_id IN (SELECT subscriber_id FROM chunk)
+        ORDER BY w.id
+        FOR UPDATE
+    ),
+    charged AS (
+        SELECT c.*, sw.id AS wallet_id,
+               round(c.price * %(platform_pct)s::numeric / 100, 2) AS platform_amount,
+               COALESCE(sw.balance - SUM(c.price) OVER (PARTITION BY c.subscriber_id ORDER BY c.id) >= 0, false) AS paid
+        FROM chunk c
+        LEFT JOIN subscriber_wallets sw ON sw.user_id = c.subscriber_id
+    ),
+    debited AS (
+        UPDATE wallets w
+        SET balance = w.balance - d.total,
+            updated_at = LOCALTIMESTAMP
+        FROM (SELECT wallet_id, SUM(price) AS total FROM charged WHERE paid GROUP BY wallet_id) d
+        WHERE w.id = d.wallet_id
+        RETURNING w.id
+    ),
+    inserted AS (
+        INSERT INTO transactions
+            (user_id, wallet_id, type, amount, currency, status, payment_method, description, metadata)
+        SELECT subscriber_id, wallet_id, 'subscription', price, 'RUB', 'completed', 'balance',
+               'Subscription renewal #' || id, jsonb_build_object('subscription_id', id)
+        FROM charged
+        WHERE paid
+        ORDER BY id
+        RETURNING id, (metadata->>'subscription_id')::int AS subscription_id
+    ),
+    splits AS (
+        INSERT INTO commission_splits (transaction_id, recipient_type, recipient_id, amount, percentage, status)
+        SELECT i.id, r.recipient_type, r.recipient_id, r.amount, r.percentage, 'completed'
+        FROM inserted i
+        JOIN charged c ON c.id = i.subscription_id
+        CROSS JOIN LATERAL (VALUES
+            ('platform', NULL::int, c.platform_amount, %(platform_pct)s::numeric),
+            ('author', c.author_id, c.price - c.platform_amount, 100 - %(platform_pct)s::numeric)
+        ) AS r(recipient_type, recipient_id, amount, percentage)
+    ),
+    entries AS (
+        INSERT INTO earnings_ledger (transaction_id, author_id, wallet_id, author_amount, platform_amount)
+        SELECT i.id, c.author_id, aw.id, c.price - c.platform_amount, c.platform_amount
+        FROM inserted i
+        JOIN charged c ON c.id = i.subscription_id
+        LEFT JOIN wallets aw ON aw.user_id = c.author_id AND aw.currency = 'RUB'
+    ),
+    renewed AS (
+        UPDATE subscriptions s
+        SET status = CASE
+                WHEN c.paid THEN 'active'
+                WHEN c.expires_at > LOCALTIMESTAMP - make_interval(days => %(grace_days)s) THEN 'past_due'
+                ELSE 'expired'
+            END,
+            expires_at = CASE
+                WHEN NOT c.paid THEN s.expires_at
+                WHEN c.plan_type = 'yearly' THEN GREATEST(c.expires_at, LOCALTIMESTAMP) + interval '1 year'
+                WHEN c.plan_type = 'weekly' THEN GREATEST(c.expires_at, LOCALTIMESTAMP) + interval '7 days'
+                ELSE GREATEST(c.expires_at, LOCALTIMESTAMP) + interval '1 month'
+            END,
+            updated_at = LOCALTIMESTAMP
+        FROM charged c
+        WHERE s.id = c.id
+    ),
+    checkpoint AS (
+        UPDATE renewal_runs r
+        SET last_subscription_id = COALESCE((SELECT MAX(id) FROM chunk), r.last_subscription_id),
+            chunks = r.chunks + 1,
+            renewed = r.renewed + (SELECT COUNT(*) FROM charged WHERE paid),
+            failed = r.failed + (SELECT COUNT(*) FROM charged WHERE NOT paid),
+            amount = r.amount + (SELECT COALESCE(SUM(price), 0) FROM charged WHERE paid),
+            updated_at = LOCALTIMESTAMP
+        WHERE r.id = %(run_id)s AND EXISTS (SELECT 1 FROM chunk)
+        RETURNING r.last_subscription_id
+    )
+    SELECT COUNT(*),
+           COUNT(*) FILTER (WHERE paid),
+           COALESCE(SUM(price) FILTER (WHERE paid), 0),
+           (SELECT last_subscription_id FROM checkpoint)
+    FROM charged
+"""
+
+
+def _start_run(conn: Any, horizon_hours: int) -> Dict[str, Any]:
+    '''Resume the unfinished run, if any, or start a new one.'''
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """SELECT id, horizon, last_subscription_id, chunks, renewed, failed
+               FROM renewal_runs WHERE status = 'running'
+               ORDER BY id LIMIT 1"""
+        )
+        row = cursor.fetchone()
+        resumed = row is not None
+        if not resumed:
+            cursor.execute(
+                """INSERT INTO renewal_runs (horizon)
+                   VALUES (LOCALTIMESTAMP + make_interval(hours => %s))
+                   RETURNING id, horizon, last_subscription_id, chunks, renewed, failed""",
+                (horizon_hours,)
+            )
+            row = cursor.fetchone()
+    conn.commit()
+    run_id, horizon, after_id, chunks, renewed, failed = row
+    return {'id': run_id, 'horizon': horizon, 'after_id': after_id, 'resumed': resumed,
+            'chunks': chunks, 'renewed': renewed, 'failed': failed}
+
+
+def renew_chunk(conn: Any, run: Dict[str, Any], platform_pct: float, limit: int = CHUNK_SIZE) -> Dict[str, Any]:
+    '''Renew the next chunk after the run's checkpoint and commit.'''
+    with conn.cursor() as cursor:
+        cursor.execute(_CHUNK_SQL, {
+            'run_id': run['id'],
+            'after_id': run['after_id'],
+            'horizon': run['horizon'],
+            'limit': limit,
+            'platform_pct': platform_pct,
+            'grace_days': GRACE_DAYS,
+        })
+        selected, renewed, amount, checkpoint = cursor.fetchone()
+    conn.commit()
+    if checkpoint is not None:
+        run['after_id'] = checkpoint
+    return {'selected': selected, 'renewed': renewed, 'failed': selected - renewed, 'amount': float(amount)}
+
+
+def renew(conn: Any, chunk_size: int = CHUNK_SIZE, max_chunks: Optional[int] = None,
+          horizon_hours: int = LEAD_HOURS) -> Dict[str, Any]:
+    '''
+    Run (or resume) a renewal pass until no due subscription is left past
+    the checkpoint, then settle authors' earnings. Only one runner at a
+    time: a second one returns immediately.
+    '''
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(hashtext('subscription_renewals'))")
+        if not cursor.fetchone()[0]:
+            conn.rollback()
+            return {'started': False, 'reason': 'another renewal run is in progress'}
+    try:
+        platform_pct = float(settings.get(conn, 'platform_commission_percentage'))
+        run = _start_run(conn, horizon_hours)
+        started = time.perf_counter()
+        totals = {'chunks': 0, 'selected': 0, 'renewed': 0, 'failed': 0, 'amount': 0.0}
+        finished = False
+        while max_chunks is None or totals['chunks'] < max_chunks:
+            result = renew_chunk(conn, run, platform_pct, chunk_size)
+            if not result['selected']:
+                finished = True
+                break
+            totals['chunks'] += 1
+            for key in ('selected', 'renewed', 'failed', 'amount'):
+                totals[key] += result[key]
+            elapsed = time.perf_counter() - started
+            print(json.dumps({
+                'renewal_run': run['id'],
+                'chunk': run['chunks'] + totals['chunks'],
+                **result,
+                'checkpoint': run['after_id'],
+                'renewed_total': run['renewed'] + totals['renewed'],
+                'rate_per_second': round(totals['selected'] / elapsed, 1) if elapsed else None,
+            }))
+
+        if finished:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """UPDATE renewal_runs
+                       SET status = 'completed', finished_at = LOCALTIMESTAMP, updated_at = LOCALTIMESTAMP
+                       WHERE id = %s""",
+                    (run['id'],)
+                )
+            conn.commit()
+        settled = ledger.settle(conn) if totals['renewed'] else None
+    finally:
+        conn.rollback()
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_unlock(hashtext('subscription_renewals'))")
+        conn.commit()
+
+    return {
+        'started': True,
+        'run_id': run['id'],
+        'resumed': run['resumed'],
+        'completed': finished,
+        **totals,
+        'settled': settled,
+        'elapsed_seconds': round(time.perf_counter() - started, 3),
+    }
+
+
+def status(conn: Any) -> Dict[str, Any]:
+    '''Latest run's progress and the subscriptions still due after its checkpoint.'''
+    with conn.cursor() as cursor:
+        cursor.execute(
+            """SELECT r.id, r.status, r.horizon::text, r.last_subscription_id, r.chunks, r.renewed,
+                      r.failed, r.amount, r.started_at::text, r.updated_at::text, r.finished_at::text,
+                      (SELECT COUNT(*) FROM subscriptions s
+                       WHERE s.id > r.last_subscription_id AND s.auto_renew
+                         AND s.status IN ('active', 'past_due') AND s.expires_at <= r.horizon)
+               FROM renewal_runs r
+               ORDER BY r.id DESC
+               LIMIT 1"""
+        )
+        row = cursor.fetchone()
+    if row is None:
+        return {'run': None}
+    columns = ('id', 'status', 'horizon', 'checkpoint', 'chunks', 'renewed', 'failed', 'amount',
+               'started_at', 'updated_at', 'finished_at', 'remaining')
+    run = dict(zip(columns, row))
+    run['amount'] = float(run['amount'])
+    return {'run': run}
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(prog='python -m shared.renewals')
+    parser.add_argument('command', choices=['renew', 'status'])
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--max-chunks', type=int)
+    parser.add_argument('--lead-hours', type=int, default=LEAD_HOURS)
+    args = parser.parse_args(argv)
+
+    import psycopg2
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        if args.command == 'renew':
+            result = renew(conn, args.chunk_size, args.max_chunks, args.lead_hours)
+        else:
+            result = status(conn)
+        print(json.dumps(result))
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,124 @@
+'''
+Business: HTTP response helpers shared by the backend functions
+Args: event - incoming function event (for Accept-Encoding / If-None-Match)
+Returns: function response dicts with CORS headers, ETag and compression
+
+Bodies are encoded in one json.dumps pass: Decimal becomes a number,
+date/datetime ISO 8601, and JSONB values arrive from psycopg2 already
+decoded. GET responses carry an ETag and answer 304 when the client sends
+it back. Bodies over COMPRESS_MIN_BYTES are brotli- or gzip-compressed
+when the client accepts it.
+'''
+
+import base64
+import gzip
+import hashlib
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Dict, Any, Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = 1024
+CORS_HEADERS = {'Access-Control-Allow-Origin': '*'}
+
+
+class _Encoder(json.JSONEncoder):
+    def default(self, value: Any) -> Any:
+        if isinstance(value, Decimal):
+            return float(value)
+        if isinstance(value, (datetime, date)):
+            return value.isoformat()
+        if isinstance(value, memoryview):
+            return value.tobytes().decode()
+        return super().default(value)
+
+
+def dumps(payload: Any) -> str:
+    return json.dumps(payload, cls=_Encoder, ensure_ascii=False)
+
+
+def header(event: Optional[Dict[str, Any]], name: str) -> str:
+    headers = (event or {}).get('headers') or {}
+    name = name.lower()
+    for key, value in headers.items():
+        if key.lower() == name:
+            return value or ''
+    return ''
+
+
+def etag_for(body: str) -> str:
+    return 'W/"' + hashlib.sha1(body.encode('utf-8')).hexdigest()[:20] + '"'
+
+
+def _accepted_encoding(event: Optional[Dict[str, Any]]) -> Optional[str]:
+    accepted = {part.split(';')[0].strip() for part in header(event, 'Accept-Encoding').split(',')}
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted:
+        return 'gzip'
+    return None
+
+
+def raw_response(status: int, body: str, content_type: str, event: Optional[Dict[str, Any]] = None,
+                 headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    response_headers = {'Content-Type': content_type, **CORS_HEADERS, **(headers or {})}
+
+    if event is not None and event.get('httpMethod') == 'GET' and status == 200:
+        etag = etag_for(body)
+        response_headers['ETag'] = etag
+        expose = response_headers.get('Access-Control-Expose-Headers')
+        response_headers['Access-Control-Expose-Headers'] = f'{expose}, ETag' if expose else 'ETag'
+        if etag in {tag.strip() for tag in header(event, 'If-None-Match').split(',')}:
+            return {
+                'statusCode': 304,
+                'headers': {key: value for key, value in response_headers.items() if key != 'Content-Type'},
+                'isBase64Encoded': False,
+                'body': ''
+            }
+
+    encoded = body.encode('utf-8')
+    encoding = _accepted_encoding(event) if len(encoded) >= COMPRESS_MIN_BYTES else None
+    if encoding is None:
+        return {
+            'statusCode': status,
+            'headers': response_headers,
+            'isBase64Encoded': False,
+            'body': body
+        }
+
+    compressed = brotli.compress(encoded, quality=5) if encoding == 'br' else gzip.compress(encoded, compresslevel=6)
+    response_headers['Content-Encoding'] = encoding
+    response_headers['Vary'] = 'Accept-Encoding'
+    return {
+        'statusCode': status,
+        'headers': response_headers,
+        'isBase64Encoded': True,
+        'body': base64.b64encode(compressed).decode('ascii')
+    }
+
+
+def json_response(status: int, payload: Any, event: Optional[Dict[str, Any]] = None,
+                  headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    return raw_response(status, dumps(payload), 'application/json', event, headers)
+
+
+def error(status: int, message: str, **extra: Any) -> Dict[str, Any]:
+    return json_response(status, {'error': message, **extra})
+
+
+def preflight(methods: str, allow_headers: str) -> Dict[str, Any]:
+    return {
+        'statusCode': 200,
+        'headers': {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': methods,
+            'Access-Control-Allow-Headers': allow_headers,
+            'Access-Control-Max-Age': '86400'
+        },
+        'body': ''
+    }
@@ -0,0 +1,171 @@
+'''
+Business: Hourly and daily commission rollups (commission_rollups)
+Args: conn - connection to read reports from
+Returns: bucketed earnings for report()
+
+One row per (granularity, bucket_start, author_id) holds the platform and
+author share of that author's sales plus the number of purchase
+transactions. Each purchase transaction has exactly one author split, so
+summing transaction_count across authors gives distinct transactions.
+Buckets are filled by ledger settlement (shared.ledger); reads add the
+still-unsettled earnings_ledger entries, so reports are exact at any time.
+'''
+
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional, Tuple
+from shared import aio
+
+GRANULARITIES = ('hour', 'day')
+MAX_HOURLY_RANGE = timedelta(days=93)
+
+_BUCKETS_SQL = """
+    SELECT granularity, bucket_start, author_id, platform_total, author_total, transaction_count
+    FROM commission_rollups
+    UNION ALL
+    SELECT g.granularity, date_trunc(g.granularity, l.created_at), l.author_id,
+           l.platform_amount, l.author_amount, 1
+    FROM earnings_ledger l
+    CROSS JOIN (VALUES ('hour'), ('day')) AS g(granularity)
+    WHERE l.settled_at IS NULL
+"""
+
+
+def totals(conn: Any) -> Dict[str, Any]:
+    '''All-time totals, summed from the daily buckets.'''
+    with conn.cursor() as cursor:
+        cursor.execute(
+            f"""SELECT COALESCE(SUM(platform_total), 0)::float AS platform_total,
+                       COALESCE(SUM(author_total), 0)::float AS authors_total,
+                       COALESCE(SUM(transaction_count), 0)::int AS total_transactions
+                FROM ({_BUCKETS_SQL}) b
+                WHERE granularity = 'day'"""
+        )
+        row = cursor.fetchone()
+    return {
+        'platform_total': row[0],
+        'authors_total': row[1],
+        'total_transactions': row[2],
+    }
+
+
+def parse_range(params: Dict[str, Any]) -> Dict[str, Any]:
+    '''Validate from/to/granularity; raises ValueError with a user-facing message.'''
+    granularity = params.get('granularity', 'day')
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of: {', '.join(GRANULARITIES)}")
+    to_value = params.get('to')
+    from_value = params.get('from')
+    try:
+        end = datetime.fromisoformat(to_value) if to_value else datetime.now()
+        start = datetime.fromisoformat(from_value) if from_value else end - timedelta(days=30)
+    except (TypeError, ValueError):
+        raise ValueError('from/to must be ISO 8601 dates')
+    if start >= end:
+        raise ValueError('from must be earlier than to')
+    if granularity == 'hour' and end - start > MAX_HOURLY_RANGE:
+        raise ValueError(f'Hourly reports are limited to {MAX_HOURLY_RANGE.days} days')
+    author_id = params.get('author_id')
+    return {
+        'granularity': granularity,
+        'from': start,
+        'to': end,
+        'author_id': int(author_id) if author_id else None,
+    }
+
+
+def _report_queries(granularity: str, start: datetime, end: datetime,
+                    author_id: Optional[int], by_author: bool) -> List[Tuple[str, Dict[str, Any]]]:
+    filters = {
+        'granularity': granularity,
+        'start': start,
+        'end': end,
+        'author_id': author_id,
+    }
+    where = """granularity = %(granularity)s
+               AND bucket_start >= date_trunc(%(granularity)s, %(start)s::timestamp)
+               AND bucket_start < %(end)s
+               AND (%(author_id)s::int IS NULL OR author_id = %(author_id)s::int)"""
+
+    queries = [(
+        f"""SELECT bucket_start,
+                   SUM(platform_total)::float AS platform_total,
+                   SUM(author_total)::float AS authors_total,
+                   SUM(transaction_count)::int AS transactions
+            FROM ({_BUCKETS_SQL}) b
+            WHERE {where}
+            GROUP BY bucket_start
+            ORDER BY bucket_start""",
+        filters
+    )]
+    if by_author:
+        queries.append((
+            f"""SELECT author_id,
+                       SUM(platform_total)::float AS platform_total,
+                       SUM(author_total)::float AS author_total,
+                       SUM(transaction_count)::int AS transactions
+                FROM ({_BUCKETS_SQL}) b
+                WHERE {where}
+                GROUP BY author_id
+                ORDER BY SUM(author_total) DESC""",
+            filters
+        ))
+    return queries
+
+
+def _report_result(granularity: str, start: datetime, end: datetime,
+                   results: List[List[Tuple[Any, ...]]]) -> Dict[str, Any]:
+    buckets = [
+        {
+            'bucket': row[0].isoformat(),
+            'platform_total': row[1],
+            'authors_total': row[2],
+            'transactions': row[3],
+        }
+        for row in results[0]
+    ]
+
+    result: Dict[str, Any] = {
+        'granularity': granularity,
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'buckets': buckets,
+        'platform_total': round(sum(b['platform_total'] for b in buckets), 2),
+        'authors_total': round(sum(b['authors_total'] for b in buckets), 2),
+        'total_transactions': sum(b['transactions'] for b in buckets),
+    }
+
+    if len(results) > 1:
+        result['authors'] = [
+            {
+                'author_id': row[0],
+                'platform_total': row[1],
+                'author_total': row[2],
+                'transactions': row[3],
+            }
+            for row in results[1]
+        ]
+
+    return result
+
+
+def report(conn: Any, granularity: str, start: datetime, end: datetime,
+           author_id: Optional[int] = None, by_author: bool = False) -> Dict[str, Any]:
+    '''
+    Earnings per bucket in [start, end). Buckets are aligned with
+    date_trunc, so a partial first bucket is included whole.
+    '''
+    results = []
+    with conn.cursor() as cursor:
+        for sql, params in _report_queries(granularity, start, end, author_id, by_author):
+            cursor.execute(sql, params)
+            results.append(cursor.fetchall())
+    return _report_result(granularity, start, end, results)
+
+
+async def report_async(granularity: str, start: datetime, end: datetime,
+                       author_id: Optional[int] = None, by_author: bool = False,
+                       dsn: Optional[str] = None) -> Dict[str, Any]:
+    '''report() with the bucket and per-author queries in one pipeline, read from `dsn`.'''
+    async with aio.connection(dsn) as aconn:
+        results = await aio.pipeline(aconn, _report_queries(granularity, start, end, author_id, by_author))
+    return _report_result(granularity, start, end, results)
@@ -0,0 +1,59 @@
+'''
+Business: In-process cache of the platform_settings table
+Args: SETTINGS_CACHE_TTL - max seconds a cached snapshot is served (default 60)
+Returns: setting values via get(conn, key)
+
+The whole table is bulk-loaded once per warm instance. Every pooled
+connection LISTENs on platform_settings_changed, and admin.handler NOTIFYs
+that channel inside its update transaction, so a change reaches warm
+instances on their next read without an extra round trip. The TTL bounds
+staleness if a notification is missed (e.g. the listening connection was
+recycled).
+'''
+
+import os
+import threading
+import time
+from typing import Dict, Any, Optional
+from shared import db
+
+CHANNEL = 'platform_settings_changed'
+TTL_SECONDS = float(os.environ.get('SETTINGS_CACHE_TTL', 60))
+
+_LOAD = db.Prepared('settings_load', 'SELECT key, value FROM platform_settings')
+
+_lock = threading.Lock()
+_values: Dict[str, str] = {}
+_loaded_at: Optional[float] = None
+
+
+def invalidate() -> None:
+    global _loaded_at
+    with _lock:
+        _loaded_at = None
+
+
+db.listen(CHANNEL, lambda payload: invalidate())
+
+
+def _load(conn: Any) -> None:
+    global _values, _loaded_at
+    with conn.cursor() as cursor:
+        _LOAD.execute(cursor)
+        values = {key: value for key, value in cursor.fetchall()}
+    with _lock:
+        _values = values
+        _loaded_at = time.monotonic()
+
+
+def get(conn: Any, key: str, default: Optional[str] = None) -> Optional[str]:
+    db.drain_notifications(conn)
+    loaded_at = _loaded_at
+    if loaded_at is None or time.monotonic() - loaded_at > TTL_SECONDS:
+        _load(conn)
+    return _values.get(key, default)
+
+
+def notify_changed(cursor: Any, key: str) -> None:
+    '''Queue a change notification; delivered when the caller commits.'''
+    cursor.execute('SELECT pg_notify(%s, %s)', (CHANNEL, key))
@@ -0,0 +1,201 @@
+'''
+Business: Incrementally maintained per-user wallet totals (wallet_summaries)
+Args: cursor - cursor inside the caller's purchase/withdraw transaction
+Returns: nothing for writers; rebuild/check results for maintenance
+
+total_earned is the sum of completed author commission splits paid to the
+user that have been settled from earnings_ledger (shared.ledger), plus
+those of months moved to archived_totals (shared.partitions); the wallet
+GET adds the unsettled entries. total_purchases is the number of rows in
+purchases for the user. Writers update the summary in the same transaction
+as the raw rows, so the wallet GET can read it with a primary-key lookup.
+purchase_work() (V0007) applies the buyer upsert server-side for single
+purchases; keep the two in sync.
+
+rebuild() is a maintenance operation (CLI only): it recomputes users in
+user_id batches, each in its own transaction that row-locks just that
+batch's summaries, so purchases by other users are never blocked.
+
+CLI: python -m shared.wallet_summary rebuild [user_id ...]
+     python -m shared.wallet_summary check [limit]
+'''
+
+import json
+import os
+import sys
+from typing import Dict, Any, List, Optional, Sequence, Tuple
+
+REBUILD_BATCH_SIZE = int(os.environ.get('WALLET_SUMMARY_REBUILD_BATCH_SIZE', 1000))
+
+_SOURCE_SQL = """
+    SELECT u.id AS user_id,
+           COALESCE(e.total_earned, 0) + COALESCE(a.earned, 0) - COALESCE(l.pending_earned, 0) AS total_earned,
+           COALESCE(p.total_purchases, 0) AS total_purchases,
+           GREATEST(e.last_at, a.last_earned_at, p.last_at, w.last_at) AS last_activity_at
+    FROM users u
+    LEFT JOIN (
+        SELECT recipient_id, SUM(amount) AS total_earned, MAX(created_at) AS last_at
+        FROM commission_splits
+        WHERE recipient_type = 'author' AND status = 'completed'
+          AND (%(user_ids)s::int[] IS NULL OR recipient_id = ANY(%(user_ids)s::int[]))
+        GROUP BY recipient_id
+    ) e ON e.recipient_id = u.id
+    LEFT JOIN archived_totals a ON a.user_id = u.id
+    LEFT JOIN (
+        SELECT author_id, SUM(author_amount) AS pending_earned
+        FROM earnings_ledger
+        WHERE settled_at IS NULL
+          AND (%(user_ids)s::int[] IS NULL OR author_id = ANY(%(user_ids)s::int[]))
+        GROUP BY author_id
+    ) l ON l.author_id = u.id
+    LEFT JOIN (
+        SELECT user_id, COUNT(*) AS total_purchases, MAX(created_at) AS last_at
+        FROM purchases
+        WHERE %(user_ids)s::int[] IS NULL OR user_id = ANY(%(user_ids)s::int[])
+        GROUP BY user_id
+    ) p ON p.user_id = u.id
+    LEFT JOIN (
+        SELECT user_id, MAX(created_at) AS last_at
+        FROM withdrawals
+        WHERE %(user_ids)s::int[] IS NULL OR user_id = ANY(%(user_ids)s::int[])
+        GROUP BY user_id
+    ) w ON w.user_id = u.id
+    WHERE %(user_ids)s::int[] IS NULL OR u.id = ANY(%(user_ids)s::int[])
+"""
+
+
+def deltas_sql(deltas: Dict[int, Dict[str, Any]]) -> Tuple[str, List[Any]]:
+    '''
+    Build the upsert for {user_id: {'earned': amount, 'purchases': count}}.
+    Rows are written in user_id order so concurrent writers lock consistently.
+    '''
+    rows: List[Any] = []
+    placeholders: List[str] = []
+    for user_id in sorted(deltas):
+        delta = deltas[user_id]
+        placeholders.append('(%s, %s, %s, CURRENT_TIMESTAMP)')
+        rows.extend([user_id, delta.get('earned', 0), delta.get('purchases', 0)])
+    return (
+        f"""INSERT INTO wallet_summaries (user_id, total_earned, total_purchases, last_activity_at)
+            VALUES {', '.join(placeholders)}
+            ON CONFLICT (user_id) DO UPDATE
+            SET total_earned = wallet_summaries.total_earned + EXCLUDED.total_earned,
+                total_purchases = wallet_summaries.total_purchases + EXCLUDED.total_purchases,
+                last_activity_at = EXCLUDED.last_activity_at,
+                updated_at = CURRENT_TIMESTAMP""",
+        rows
+    )
+
+
+def apply_deltas(cursor: Any, deltas: Dict[int, Dict[str, Any]]) -> None:
+    if deltas:
+        cursor.execute(*deltas_sql(deltas))
+
+
+def record_withdrawal(cursor: Any, user_id: int) -> None:
+    apply_deltas(cursor, {int(user_id): {}})
+
+
+def _rebuild_batch(conn: Any, user_ids: List[int]) -> int:
+    with conn.cursor() as cursor:
+        # Create missing rows, then lock the batch in user_id order (the
+        # order writers use) before reading the raw tables: a purchase
+        # committed before the lock is counted, one after it waits and
+        # applies its increment on top.
+        cursor.execute(
+            """INSERT INTO wallet_summaries (user_id)
+               SELECT user_id FROM unnest(%s::int[]) AS user_id ORDER BY user_id
+               ON CONFLICT (user_id) DO NOTHING""",
+            (user_ids,)
+        )
+        cursor.execute(
+            'SELECT user_id FROM wallet_summaries WHERE user_id = ANY(%s) ORDER BY user_id FOR UPDATE',
+            (user_ids,)
+        )
+        cursor.execute(
+            f"""UPDATE wallet_summaries s
+                SET total_earned = src.total_earned,
+                    total_purchases = src.total_purchases,
+                    last_activity_at = src.last_activity_at,
+                    updated_at = CURRENT_TIMESTAMP
+                FROM ({_SOURCE_SQL}) src
+                WHERE s.user_id = src.user_id""",
+            {'user_ids': user_ids}
+        )
+        count = cursor.rowcount
+    conn.commit()
+    return count
+
+
+def rebuild(conn: Any, user_ids: Optional[Sequence[int]] = None, batch_size: int = REBUILD_BATCH_SIZE) -> int:
+    '''
+    Recompute summaries from the raw tables, `batch_size` users per
+    transaction. Only the batch being rebuilt is locked.
+    '''
+    selected = list(user_ids) if user_ids else None
+    rebuilt = 0
+    after = 0
+    while True:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """SELECT id FROM users
+                   WHERE id > %s AND (%s::int[] IS NULL OR id = ANY(%s::int[]))
+                   ORDER BY id
+                   LIMIT %s""",
+                (after, selected, selected, batch_size)
+            )
+            batch = [row[0] for row in cursor.fetchall()]
+        if not batch:
+            conn.rollback()
+            return rebuilt
+        rebuilt += _rebuild_batch(conn, batch)
+        after = batch[-1]
+
+
+def check(conn: Any, limit: int = 100) -> Dict[str, Any]:
+    '''Compare stored summaries with totals recomputed from the raw tables.'''
+    with conn.cursor() as cursor:
+        cursor.execute(
+            f"""SELECT src.user_id,
+                       COALESCE(s.total_earned, 0)::float AS stored_earned,
+                       src.total_earned::float AS actual_earned,
+                       COALESCE(s.total_purchases, 0) AS stored_purchases,
+                       src.total_purchases AS actual_purchases
+                FROM ({_SOURCE_SQL}) src
+                LEFT JOIN wallet_summaries s ON s.user_id = src.user_id
+                WHERE COALESCE(s.total_earned, 0) <> src.total_earned
+                   OR COALESCE(s.total_purchases, 0) <> src.total_purchases
+                ORDER BY src.user_id""",
+            {'user_ids': None}
+        )
+        columns = [column.name for column in cursor.description]
+        mismatches = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    conn.rollback()
+    return {
+        'consistent': not mismatches,
+        'mismatch_count': len(mismatches),
+        'mismatches': mismatches[:limit],
+    }
+
+
+def main(argv: List[str]) -> int:
+    if not argv or argv[0] not in ('rebuild', 'check'):
+        print('usage: python -m shared.wallet_summary rebuild [user_id ...] | check [limit]')
+        return 2
+
+    import psycopg2
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        if argv[0] == 'rebuild':
+            user_ids = [int(arg) for arg in argv[1:]]
+            print(json.dumps({'rebuilt': rebuild(conn, user_ids or None)}))
+            return 0
+        result = check(conn, int(argv[1]) if len(argv) > 1 else 100)
+        print(json.dumps(result))
+        return 0 if result['consistent'] else 1
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,219 @@
+'''
+Business: Withdrawal worker: claim pending withdrawals, pay out, settle in bulk
+Args: conn - worker's own connection; provider - shared.payouts provider
+Returns: per-run counts of completed, failed (refunded) and retried payouts
+
+Each batch is claimed with FOR UPDATE SKIP LOCKED and flipped to
+'processing' in a short transaction, so any number of workers can run side
+by side without waiting on each other and no lock is held while payouts
+are in flight. Payouts go out concurrently from a thread pool. Results are
+written back with one statement per batch: withdrawals and their pending
+'withdrawal' transactions are completed or failed, and failed amounts are
+refunded to the wallets with a 'withdrawal_refund' transaction. Payouts
+with an unknown outcome go back to 'pending' and are retried with a
+linear backoff until MAX_ATTEMPTS, then failed and refunded; claims
+left in 'processing' by a dead worker are picked up after
+CLAIM_TIMEOUT_SECONDS.
+
+CLI: python -m shared.withdrawals process [--batch-size N] [--concurrency N]
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
+from shared import payouts
+
+BATCH_SIZE = int(os.environ.get('WITHDRAWAL_BATCH_SIZE', 500))
+CONCURRENCY = int(os.environ.get('WITHDRAWAL_CONCURRENCY', 64))
+CLAIM_TIMEOUT_SECONDS = int(os.environ.get('WITHDRAWAL_CLAIM_TIMEOUT', 600))
+MAX_ATTEMPTS = 5
+RETRY_DELAY_SECONDS = 30
+
+_CLAIM_SQL = """
+    WITH batch AS (
+        SELECT id FROM withdrawals
+        WHERE (status = 'pending'
+               AND (attempts = 0 OR updated_at < LOCALTIMESTAMP - make_interval(secs => attempts * %(retry_delay)s)))
+           OR (status = 'processing' AND updated_at < LOCALTIMESTAMP - make_interval(secs => %(timeout)s))
+        ORDER BY id
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE withdrawals w
+    SET status = 'processing',
+        attempts = w.attempts + 1,
+        updated_at = LOCALTIMESTAMP
+    FROM batch
+    WHERE w.id = batch.id
+    RETURNING w.id, w.user_id, w.wallet_id, w.amount, w.payment_method, w.payment_details
+"""
+
+_FINISH_SQL = """
+    WITH results (id, outcome, reference, reason) AS (
+        VALUES {values}
+    ),
+    finished AS (
+        UPDATE withdrawals w
+        SET status = CASE
+                WHEN r.outcome <> 'retry' THEN r.outcome
+                WHEN w.attempts >= {max_attempts} THEN 'failed'
+                ELSE 'pending'
+            END,
+            provider_reference = r.reference,
+            failure_reason = r.reason,
+            processed_at = CASE
+                WHEN r.outcome <> 'retry' OR w.attempts >= {max_attempts} THEN LOCALTIMESTAMP
+            END,
+            updated_at = LOCALTIMESTAMP
+        FROM results r
+        WHERE w.id = r.id AND w.status = 'processing'
+        RETURNING w.id, w.user_id, w.wallet_id, w.amount, w.payment_method, w.status, w.created_at
+    ),
+    closed AS (
+        UPDATE transactions t
+        SET status = f.status,
+            updated_at = LOCALTIMESTAMP
+        FROM finished f
+        WHERE t.type = 'withdrawal'
+          AND (t.metadata->>'withdrawal_id')::int = f.id
+          -- Written with the withdrawal; lets the scan skip older months.
+          AND t.created_at >= f.created_at
+          AND f.status IN ('completed', 'failed')
+        RETURNING t.id
+    ),
+    refunds AS (
+        SELECT wallet_id, SUM(amount) AS amount
+        FROM finished
+        WHERE status = 'failed'
+        GROUP BY wallet_id
+    ),
+    locked AS (
+        SELECT id FROM wallets
+        WHERE id IN (SELECT wallet_id FROM refunds)
+        ORDER BY id
+        FOR UPDATE
+    ),
+    refunded AS (
+        UPDATE wallets w
+        SET balance = w.balance + r.amount,
+            updated_at = LOCALTIMESTAMP
+        FROM locked
+        JOIN refunds r ON r.wallet_id = locked.id
+        WHERE w.id = locked.id
+        RETURNING w.id
+    ),
+    refund_transactions AS (
+        INSERT INTO transactions
+            (user_id, wallet_id, type, amount, currency, status, payment_method, description, metadata)
+        SELECT user_id, wallet_id, 'withdrawal_refund', amount, 'RUB', 'completed', payment_method,
+               'Refund for withdrawal #' || id, jsonb_build_object('withdrawal_id', id)
+        FROM finished
+        WHERE status = 'failed'
+        RETURNING id
+    )
+    SELECT COUNT(*) FILTER (WHERE status = 'completed'),
+           COUNT(*) FILTER (WHERE status = 'failed'),
+           COUNT(*) FILTER (WHERE status = 'pending'),
+           (SELECT COUNT(*) FROM closed),
+           (SELECT COUNT(*) FROM refund_transactions)
+    FROM finished
+"""
+
+
+def claim(conn: Any, limit: int = BATCH_SIZE) -> List[Dict[str, Any]]:
+    '''Claim up to `limit` withdrawals for this worker and commit the claim.'''
+    with conn.cursor() as cursor:
+        cursor.execute(_CLAIM_SQL, {
+            'limit': limit,
+            'timeout': CLAIM_TIMEOUT_SECONDS,
+            'retry_delay': RETRY_DELAY_SECONDS,
+        })
+        columns = [column.name for column in cursor.description]
+        claimed = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    conn.commit()
+    return claimed
+
+
+def _send(provider: payouts.PayoutProvider, withdrawal: Dict[str, Any]) -> Tuple[int, str, Optional[str], Optional[str]]:
+    try:
+        result = provider.send(withdrawal)
+    except payouts.PayoutError as e:
+        return withdrawal['id'], 'retry', None, str(e) or 'Payout outcome unknown'
+    except Exception as e:
+        return withdrawal['id'], 'retry', None, f'{type(e).__name__}: {e}'
+    if result.ok:
+        return withdrawal['id'], 'completed', result.reference, None
+    return withdrawal['id'], 'failed', result.reference, result.reason or 'Declined'
+
+
+def finish(conn: Any, results: List[Tuple[int, str, Optional[str], Optional[str]]]) -> Dict[str, int]:
+    '''Write a batch of payout results back in one statement and commit.'''
+    if not results:
+        return {'completed': 0, 'failed': 0, 'retried': 0, 'transactions': 0, 'refunds': 0}
+    values: List[Any] = []
+    for result in results:
+        values.extend(result)
+    sql = _FINISH_SQL.format(
+        values=', '.join(['(%s::int, %s::text, %s::text, %s::text)'] * len(results)),
+        max_attempts=MAX_ATTEMPTS
+    )
+    with conn.cursor() as cursor:
+        cursor.execute(sql, values)
+        completed, failed, retried, transactions, refunds = cursor.fetchone()
+    conn.commit()
+    return {
+        'completed': completed,
+        'failed': failed,
+        'retried': retried,
+        'transactions': transactions,
+        'refunds': refunds,
+    }
+
+
+def process(conn: Any, provider: payouts.PayoutProvider, batch_size: int = BATCH_SIZE,
+            concurrency: int = CONCURRENCY, max_batches: Optional[int] = None) -> Dict[str, Any]:
+    '''Claim, pay out and finish batches until nothing is left to claim.'''
+    totals: Dict[str, Any] = {'batches': 0, 'claimed': 0, 'completed': 0, 'failed': 0,
+                              'retried': 0, 'transactions': 0, 'refunds': 0}
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while max_batches is None or totals['batches'] < max_batches:
+            claimed = claim(conn, batch_size)
+            if not claimed:
+                break
+            results = list(pool.map(lambda withdrawal: _send(provider, withdrawal), claimed))
+            for key, value in finish(conn, results).items():
+                totals[key] += value
+            totals['batches'] += 1
+            totals['claimed'] += len(claimed)
+    totals['elapsed_seconds'] = round(time.perf_counter() - started, 3)
+    return totals
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(prog='python -m shared.withdrawals')
+    parser.add_argument('command', choices=['process'])
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY)
+    parser.add_argument('--max-batches', type=int)
+    parser.add_argument('--provider', help="package.module:ClassName, or 'fake' for local runs (default: $PAYOUT_PROVIDER)")
+    args = parser.parse_args(argv)
+    provider = payouts.load_provider(args.provider)
+
+    import psycopg2
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        result = process(conn, provider, args.batch_size,
+                         args.concurrency, args.max_batches)
+        print(json.dumps(result))
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
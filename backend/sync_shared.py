@@ -0,0 +1,91 @@
+'''
+Business: Vendor the shared modules each function imports into its directory
+Args: --check - list what each function would get, and fail on a missing module
+      --clean - remove the vendored copies
+Returns: exit code 0 when every function's shared imports resolve
+
+poehali.dev deploys each backend/<fn>/ directory on its own, so a
+handler's `from shared import ...` only resolves when shared/ sits next
+to its index.py. This is the build step that puts it there: it follows
+the imports of index.py through backend/shared (lazy imports inside
+functions included) and copies only those modules into backend/<fn>/shared.
+Run it before deploying; the copies are generated, ignored by git and
+never edited by hand. CI runs it and imports every handler from its own
+directory.
+
+CLI: python backend/sync_shared.py [--check | --clean]
+'''
+
+import argparse
+import ast
+import shutil
+import sys
+from pathlib import Path
+from typing import List, Set
+
+BACKEND_DIR = Path(__file__).resolve().parent
+SOURCE_DIR = BACKEND_DIR / 'shared'
+
+
+def functions() -> List[Path]:
+    '''Every backend/<fn>/ with a handler.'''
+    return sorted(path.parent for path in BACKEND_DIR.glob('*/index.py'))
+
+
+def _shared_imports(path: Path) -> Set[str]:
+    names = set()
+    for node in ast.walk(ast.parse(path.read_text(encoding='utf-8'))):
+        if isinstance(node, ast.ImportFrom) and node.module == 'shared':
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and (node.module or '').startswith('shared.'):
+            names.add(node.module.split('.')[1])
+        elif isinstance(node, ast.Import):
+            names.update(alias.name.split('.')[1] for alias in node.names if alias.name.startswith('shared.'))
+    return names
+
+
+def required(target: Path) -> Set[str]:
+    '''Module names in backend/shared that target/index.py needs, transitively.'''
+    needed: Set[str] = set()
+    queue = list(_shared_imports(target / 'index.py'))
+    while queue:
+        name = queue.pop()
+        if name in needed:
+            continue
+        needed.add(name)
+        source = SOURCE_DIR / f'{name}.py'
+        if not source.is_file():
+            raise SystemExit(f'{target.name}: shared.{name} does not exist')
+        queue.extend(_shared_imports(source))
+    return needed
+
+
+def sync(target: Path) -> List[str]:
+    modules = sorted(required(target))
+    copy = target / 'shared'
+    if copy.is_dir():
+        shutil.rmtree(copy)
+    copy.mkdir()
+    for name in ['__init__', *modules]:
+        shutil.copyfile(SOURCE_DIR / f'{name}.py', copy / f'{name}.py')
+    return modules
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--check', action='store_true')
+    mode.add_argument('--clean', action='store_true')
+    args = parser.parse_args(argv)
+
+    for target in functions():
+        if args.clean:
+            shutil.rmtree(target / 'shared', ignore_errors=True)
+            continue
+        modules = sorted(required(target)) if args.check else sync(target)
+        print(f"{target.name}: {', '.join(modules)}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
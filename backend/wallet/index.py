@@ -7,187 +7,159 @@ Returns: HTTP response dict with wallet data
 
 import json
 import os
-from typing import Dict, Any
-from datetime import datetime
-import psycopg2
+from typing import Dict, Any, Optional
 from psycopg2.extras import RealDictCursor
+from shared import db, idempotency, ledger, metrics, response, settings, wallet_summary
 
+_WALLET_LOOKUP = db.Prepared('wallet_lookup', """
+    SELECT w.id, w.user_id, w.balance + p.pending_balance as balance,
+           w.currency, w.created_at, w.updated_at,
+           COALESCE(s.total_earned, 0) + p.pending_earned as total_earned,
+           COALESCE(s.total_purchases, 0) as total_purchases,
+           GREATEST(s.last_activity_at, p.last_pending_at) as last_activity_at
+    FROM wallets w
+    LEFT JOIN wallet_summaries s ON s.user_id = w.user_id
+    CROSS JOIN LATERAL (
+        SELECT COALESCE(SUM(l.author_amount) FILTER (WHERE COALESCE(l.wallet_id, w.id) = w.id), 0) as pending_balance,
+               COALESCE(SUM(l.author_amount), 0) as pending_earned,
+               MAX(l.created_at) as last_pending_at
+        FROM earnings_ledger l
+        WHERE l.author_id = w.user_id AND l.settled_at IS NULL
+    ) p
+    WHERE w.user_id = %s AND w.currency = %s
+""")
+
+_WALLET_LOCK = db.Prepared(
+    'wallet_lock', "SELECT id, balance FROM wallets WHERE user_id = %s AND currency = %s FOR UPDATE"
+)
+
+
+def get_wallet(conn: Any, user_id: Any, create: bool) -> Optional[Dict[str, Any]]:
+    '''The user's RUB wallet with live totals; opened empty if missing and `create` is set.'''
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    _WALLET_LOOKUP.execute(cursor, (user_id, 'RUB'))
+    wallet = cursor.fetchone()
+
+    if not wallet and create:
+        cursor.execute(
+            """INSERT INTO wallets (user_id, balance, currency) VALUES (%s, %s, %s)
+               RETURNING *, 0 as total_earned, 0 as total_purchases, NULL::timestamp as last_activity_at""",
+            (user_id, 0, 'RUB')
+        )
+        wallet = cursor.fetchone()
+        conn.commit()
+
+    cursor.close()
+    return wallet
+
+
+def withdraw(conn: Any, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    user_id = body_data.get('user_id')
+    amount = body_data.get('amount')
+    payment_method = body_data.get('payment_method')
+    payment_details = body_data.get('payment_details', {})
+
+    if not all([user_id, amount, payment_method]):
+        return response.error(400, 'Missing required fields')
+
+    cursor = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        min_amount = float(settings.get(conn, 'min_withdrawal_amount'))
+    
+        if float(amount) < min_amount:
+            cursor.close()
+            return response.error(400, f'Minimum withdrawal is {min_amount} RUB')
+    
+        _WALLET_LOCK.execute(cursor, (user_id, 'RUB'))
+        wallet = cursor.fetchone()
+        if wallet:
+            # Fold this author's pending earnings into the balance under the
+            # wallet lock, so the check below sees every completed sale.
+            if ledger.settle_batch(conn, None, author_id=int(user_id))['wallets']:
+                cursor.execute("SELECT id, balance FROM wallets WHERE id = %s", (wallet['id'],))
+                wallet = cursor.fetchone()
+    
+        if not wallet or float(wallet['balance']) < float(amount):
+            conn.rollback()
+            cursor.close()
+            return response.error(400, 'Insufficient funds')
+    
+        cursor.execute(
+            """INSERT INTO withdrawals 
+               (user_id, wallet_id, amount, status, payment_method, payment_details)
+               VALUES (%s, %s, %s, %s, %s, %s) RETURNING id""",
+            (user_id, wallet['id'], amount, 'pending', payment_method, json.dumps(payment_details))
+        )
+        withdrawal_id = cursor.fetchone()['id']
+    
+        cursor.execute(
+            "UPDATE wallets SET balance = balance - %s WHERE id = %s",
+            (amount, wallet['id'])
+        )
+        wallet_summary.record_withdrawal(cursor, user_id)
+    
+        cursor.execute(
+            """INSERT INTO transactions 
+               (user_id, wallet_id, type, amount, currency, status, payment_method, description, metadata)
+               VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+            (user_id, wallet['id'], 'withdrawal', -float(amount), 'RUB', 'pending', payment_method,
+             f'Withdrawal #{withdrawal_id}', json.dumps({'withdrawal_id': withdrawal_id}))
+        )
+    
+        cursor.close()
+    
+        return idempotency.commit(conn, response.json_response(200, {
+            'withdrawal_id': withdrawal_id,
+            'status': 'pending',
+            'message': 'Withdrawal request created'
+        }))
+    
+    except Exception as e:
+        conn.rollback()
+        cursor.close()
+        return response.error(500, str(e))
+
+
+@metrics.instrumented('wallet')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+        return response.preflight(
+            'GET, POST, OPTIONS', f'Content-Type, X-User-Id, If-None-Match, Idempotency-Key, {db.WRITE_HEADER}'
+        )
     
     db_url = os.environ.get('DATABASE_URL')
     if not db_url:
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Database not configured'})
-        }
-    
-    conn = psycopg2.connect(db_url)
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
+        return response.error(500, 'Database not configured')
     
     if method == 'GET':
-        params = event.get('queryStringParameters', {})
+        params = event.get('queryStringParameters') or {}
         user_id = params.get('user_id')
-        
+    
         if not user_id:
-            cursor.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'user_id required'})
-            }
-        
-        cursor.execute(
-            """SELECT w.*, 
-                      COALESCE(SUM(CASE WHEN cs.recipient_type = 'author' THEN cs.amount ELSE 0 END), 0) as total_earned,
-                      COUNT(DISTINCT p.id) as total_purchases
-               FROM wallets w
-               LEFT JOIN transactions t ON t.wallet_id = w.id
-               LEFT JOIN commission_splits cs ON cs.transaction_id = t.id AND cs.recipient_id = %s
-               LEFT JOIN purchases p ON p.user_id = %s
-               WHERE w.user_id = %s AND w.currency = %s
-               GROUP BY w.id""",
-            (user_id, user_id, user_id, 'RUB')
-        )
-        wallet = cursor.fetchone()
-        
+            return response.error(400, 'user_id required')
+    
+        with db.read_connection(db_url, user_id, event) as conn:
+            wallet = get_wallet(conn, user_id, create=False)
+    
         if not wallet:
-            cursor.execute(
-                "INSERT INTO wallets (user_id, balance, currency) VALUES (%s, %s, %s) RETURNING *",
-                (user_id, 0, 'RUB')
-            )
-            conn.commit()
-            wallet = cursor.fetchone()
-        
-        if 'created_at' in wallet and wallet['created_at']:
-            wallet['created_at'] = wallet['created_at'].isoformat()
-        if 'updated_at' in wallet and wallet['updated_at']:
-            wallet['updated_at'] = wallet['updated_at'].isoformat()
-        
-        cursor.close()
-        conn.close()
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'isBase64Encoded': False,
-            'body': json.dumps(dict(wallet))
-        }
-    
-    if method == 'POST':
-        body_data = json.loads(event.get('body', '{}'))
-        action = body_data.get('action')
+            # New users (or a wallet the replica has not replayed yet) are
+            # looked up again, and opened, on the primary.
+            with db.connection(db_url) as conn:
+                wallet = get_wallet(conn, user_id, create=True)
+    
+        return response.json_response(200, wallet, event)
+    
+    with db.connection(db_url) as conn:
+        if method == 'POST':
+            body_data = json.loads(event.get('body', '{}'))
+            action = body_data.get('action')
         
-        if action == 'withdraw':
-            user_id = body_data.get('user_id')
-            amount = body_data.get('amount')
-            payment_method = body_data.get('payment_method')
-            payment_details = body_data.get('payment_details', {})
-            
-            if not all([user_id, amount, payment_method]):
-                cursor.close()
-                conn.close()
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Missing required fields'})
-                }
-            
-            try:
-                conn.autocommit = False
-                
-                cursor.execute(
-                    "SELECT value FROM platform_settings WHERE key = %s",
-                    ('min_withdrawal_amount',)
-                )
-                min_amount = float(cursor.fetchone()['value'])
-                
-                if float(amount) < min_amount:
-                    conn.close()
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': f'Minimum withdrawal is {min_amount} RUB'})
-                    }
-                
-                cursor.execute(
-                    "SELECT id, balance FROM wallets WHERE user_id = %s AND currency = %s FOR UPDATE",
-                    (user_id, 'RUB')
-                )
-                wallet = cursor.fetchone()
-                
-                if not wallet or float(wallet['balance']) < float(amount):
-                    conn.rollback()
-                    conn.close()
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Insufficient funds'})
-                    }
-                
-                cursor.execute(
-                    """INSERT INTO withdrawals 
-                       (user_id, wallet_id, amount, status, payment_method, payment_details)
-                       VALUES (%s, %s, %s, %s, %s, %s) RETURNING id""",
-                    (user_id, wallet['id'], amount, 'pending', payment_method, json.dumps(payment_details))
-                )
-                withdrawal_id = cursor.fetchone()['id']
-                
-                cursor.execute(
-                    "UPDATE wallets SET balance = balance - %s WHERE id = %s",
-                    (amount, wallet['id'])
-                )
-                
-                cursor.execute(
-                    """INSERT INTO transactions 
-                       (user_id, wallet_id, type, amount, currency, status, payment_method, description)
-                       VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
-                    (user_id, wallet['id'], 'withdrawal', -float(amount), 'RUB', 'pending', payment_method, f'Withdrawal #{withdrawal_id}')
-                )
-                
-                conn.commit()
-                cursor.close()
-                conn.close()
-                
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'isBase64Encoded': False,
-                    'body': json.dumps({
-                        'withdrawal_id': withdrawal_id,
-                        'status': 'pending',
-                        'message': 'Withdrawal request created'
-                    })
-                }
-                
-            except Exception as e:
-                conn.rollback()
-                cursor.close()
-                conn.close()
-                return {
-                    'statusCode': 500,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': str(e)})
-                }
+            if action == 'withdraw':
+                user_id = body_data.get('user_id')
+                result = idempotency.guard(conn, f'withdraw:{user_id}', event, body_data,
+                                           lambda: withdraw(conn, body_data))
+                return db.note_write(user_id, result)
     
-    cursor.close()
-    conn.close()
-    return {
-        'statusCode': 405,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'error': 'Method not allowed'})
-    }
+        return response.error(405, 'Method not allowed')
@@ -0,0 +1,33 @@
+CREATE TABLE IF NOT EXISTS wallet_summaries (
+    user_id INTEGER PRIMARY KEY REFERENCES users(id),
+    total_earned DECIMAL(12, 2) DEFAULT 0.00 NOT NULL,
+    total_purchases INTEGER DEFAULT 0 NOT NULL,
+    last_activity_at TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_commission_splits_recipient ON commission_splits(recipient_type, recipient_id);
+
+INSERT INTO wallet_summaries (user_id, total_earned, total_purchases, last_activity_at)
+SELECT u.id,
+       COALESCE(e.total_earned, 0),
+       COALESCE(p.total_purchases, 0),
+       GREATEST(e.last_at, p.last_at, w.last_at)
+FROM users u
+LEFT JOIN (
+    SELECT recipient_id, SUM(amount) AS total_earned, MAX(created_at) AS last_at
+    FROM commission_splits
+    WHERE recipient_type = 'author' AND status = 'completed'
+    GROUP BY recipient_id
+) e ON e.recipient_id = u.id
+LEFT JOIN (
+    SELECT user_id, COUNT(*) AS total_purchases, MAX(created_at) AS last_at
+    FROM purchases
+    GROUP BY user_id
+) p ON p.user_id = u.id
+LEFT JOIN (
+    SELECT user_id, MAX(created_at) AS last_at
+    FROM withdrawals
+    GROUP BY user_id
+) w ON w.user_id = u.id
+ON CONFLICT (user_id) DO NOTHING;
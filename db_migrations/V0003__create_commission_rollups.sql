@@ -0,0 +1,30 @@
+CREATE TABLE IF NOT EXISTS commission_rollups (
+    granularity VARCHAR(10) NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    author_id INTEGER NOT NULL DEFAULT 0,
+    platform_total DECIMAL(14, 2) DEFAULT 0.00 NOT NULL,
+    author_total DECIMAL(14, 2) DEFAULT 0.00 NOT NULL,
+    transaction_count INTEGER DEFAULT 0 NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (granularity, bucket_start, author_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_commission_rollups_author ON commission_rollups(author_id, granularity, bucket_start);
+
+WITH per_transaction AS (
+    SELECT transaction_id,
+           MIN(created_at) AS created_at,
+           COALESCE(MAX(recipient_id) FILTER (WHERE recipient_type = 'author'), 0) AS author_id,
+           COALESCE(SUM(amount) FILTER (WHERE recipient_type = 'platform'), 0) AS platform_amount,
+           COALESCE(SUM(amount) FILTER (WHERE recipient_type = 'author'), 0) AS author_amount
+    FROM commission_splits
+    WHERE status = 'completed'
+    GROUP BY transaction_id
+)
+INSERT INTO commission_rollups (granularity, bucket_start, author_id, platform_total, author_total, transaction_count)
+SELECT g.granularity, date_trunc(g.granularity, t.created_at), t.author_id,
+       SUM(t.platform_amount), SUM(t.author_amount), COUNT(*)
+FROM per_transaction t
+CROSS JOIN (VALUES ('hour'), ('day')) AS g(granularity)
+GROUP BY 1, 2, 3
+ON CONFLICT (granularity, bucket_start, author_id) DO NOTHING;
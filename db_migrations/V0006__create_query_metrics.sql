@@ -0,0 +1,13 @@
+CREATE TABLE IF NOT EXISTS query_metrics (
+    bucket_start TIMESTAMP NOT NULL,
+    function_name VARCHAR(50) NOT NULL,
+    fingerprint VARCHAR(32) NOT NULL,
+    statement TEXT NOT NULL,
+    locking BOOLEAN NOT NULL DEFAULT FALSE,
+    calls INTEGER NOT NULL DEFAULT 0,
+    total_ms DOUBLE PRECISION NOT NULL DEFAULT 0,
+    max_ms DOUBLE PRECISION NOT NULL DEFAULT 0,
+    row_count BIGINT NOT NULL DEFAULT 0,
+    histogram INTEGER[] NOT NULL,
+    PRIMARY KEY (bucket_start, function_name, fingerprint)
+);
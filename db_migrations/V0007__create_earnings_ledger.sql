@@ -0,0 +1,82 @@
+CREATE TABLE IF NOT EXISTS earnings_ledger (
+    id BIGSERIAL PRIMARY KEY,
+    transaction_id INTEGER NOT NULL UNIQUE REFERENCES transactions(id),
+    author_id INTEGER NOT NULL REFERENCES users(id),
+    wallet_id INTEGER REFERENCES wallets(id),
+    author_amount DECIMAL(10, 2) NOT NULL,
+    platform_amount DECIMAL(10, 2) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    settled_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_earnings_ledger_unsettled
+    ON earnings_ledger(author_id) INCLUDE (wallet_id, author_amount, platform_amount)
+    WHERE settled_at IS NULL;
+
+CREATE OR REPLACE FUNCTION purchase_work(
+    p_user_id INTEGER,
+    p_work_id INTEGER,
+    p_amount DECIMAL(10, 2),
+    p_payment_method VARCHAR(50),
+    p_platform_percentage DECIMAL(5, 2)
+)
+RETURNS TABLE (
+    out_transaction_id INTEGER,
+    out_purchase_id INTEGER,
+    out_author_amount DECIMAL(10, 2),
+    out_platform_amount DECIMAL(10, 2)
+)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_author_id INTEGER;
+    v_wallet_id INTEGER;
+    v_transaction_id INTEGER;
+    v_purchase_id INTEGER;
+    v_platform_amount DECIMAL(10, 2);
+    v_author_amount DECIMAL(10, 2);
+BEGIN
+    SELECT w.author_id INTO v_author_id FROM works w WHERE w.id = p_work_id;
+    IF NOT FOUND THEN
+        RAISE EXCEPTION 'Work not found' USING ERRCODE = 'no_data_found';
+    END IF;
+
+    INSERT INTO wallets (user_id, balance, currency)
+    VALUES (p_user_id, 0, 'RUB')
+    ON CONFLICT (user_id, currency) DO NOTHING;
+    SELECT w.id INTO v_wallet_id FROM wallets w WHERE w.user_id = p_user_id AND w.currency = 'RUB';
+
+    v_platform_amount := round(p_amount * p_platform_percentage / 100, 2);
+    v_author_amount := p_amount - v_platform_amount;
+
+    INSERT INTO transactions (user_id, wallet_id, type, amount, currency, status, payment_method, description)
+    VALUES (p_user_id, v_wallet_id, 'purchase', p_amount, 'RUB', 'completed', p_payment_method,
+            'Purchase work #' || p_work_id)
+    RETURNING id INTO v_transaction_id;
+
+    INSERT INTO commission_splits (transaction_id, recipient_type, recipient_id, amount, percentage, status)
+    VALUES (v_transaction_id, 'platform', NULL, v_platform_amount, p_platform_percentage, 'completed'),
+           (v_transaction_id, 'author', v_author_id, v_author_amount, 100 - p_platform_percentage, 'completed');
+
+    -- The author's wallet, summary and rollup rows are credited later by
+    -- settlement (shared/ledger.py), so purchases of one author never queue
+    -- on the same row locks.
+    INSERT INTO earnings_ledger (transaction_id, author_id, wallet_id, author_amount, platform_amount)
+    SELECT v_transaction_id, v_author_id, aw.id, v_author_amount, v_platform_amount
+    FROM (SELECT 1) AS one
+    LEFT JOIN wallets aw ON aw.user_id = v_author_id AND aw.currency = 'RUB';
+
+    INSERT INTO wallet_summaries (user_id, total_earned, total_purchases, last_activity_at)
+    VALUES (p_user_id, 0, 1, CURRENT_TIMESTAMP)
+    ON CONFLICT (user_id) DO UPDATE
+    SET total_purchases = wallet_summaries.total_purchases + 1,
+        last_activity_at = EXCLUDED.last_activity_at,
+        updated_at = CURRENT_TIMESTAMP;
+
+    INSERT INTO purchases (user_id, work_id, transaction_id, price)
+    VALUES (p_user_id, p_work_id, v_transaction_id, p_amount)
+    RETURNING id INTO v_purchase_id;
+
+    RETURN QUERY SELECT v_transaction_id, v_purchase_id, v_author_amount, v_platform_amount;
+END;
+$$;
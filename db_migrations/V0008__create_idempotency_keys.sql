@@ -0,0 +1,13 @@
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    scope VARCHAR(100) NOT NULL,
+    key VARCHAR(255) NOT NULL,
+    request_hash CHAR(40) NOT NULL,
+    status VARCHAR(20) DEFAULT 'in_flight' NOT NULL,
+    response_status SMALLINT,
+    response_body TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    expires_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (scope, key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys(expires_at);
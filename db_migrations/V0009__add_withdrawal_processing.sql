@@ -0,0 +1,16 @@
+ALTER TABLE withdrawals ADD COLUMN IF NOT EXISTS attempts INTEGER DEFAULT 0 NOT NULL;
+ALTER TABLE withdrawals ADD COLUMN IF NOT EXISTS provider_reference VARCHAR(255);
+ALTER TABLE withdrawals ADD COLUMN IF NOT EXISTS failure_reason TEXT;
+
+CREATE INDEX IF NOT EXISTS idx_withdrawals_open ON withdrawals(id)
+    WHERE status IN ('pending', 'processing');
+
+UPDATE transactions
+SET metadata = COALESCE(metadata, '{}'::jsonb)
+             || jsonb_build_object('withdrawal_id', substring(description FROM '^Withdrawal #([0-9]+)$')::int)
+WHERE type = 'withdrawal'
+  AND description ~ '^Withdrawal #[0-9]+$'
+  AND (metadata IS NULL OR NOT metadata ? 'withdrawal_id');
+
+CREATE INDEX IF NOT EXISTS idx_transactions_withdrawal_id ON transactions(((metadata->>'withdrawal_id')::int))
+    WHERE type = 'withdrawal';
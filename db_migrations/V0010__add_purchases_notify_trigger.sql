@@ -0,0 +1,22 @@
+-- Tell warm entitlement caches (backend/shared/entitlements.py) about new
+-- purchases. One notification per buyer per statement, so a cart checkout
+-- sends a single 'user_id:work_id,work_id,...' payload; it is delivered
+-- to listeners when the purchase commits, at no extra round trip.
+CREATE OR REPLACE FUNCTION notify_purchases_recorded()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    PERFORM pg_notify('purchases_recorded', user_id || ':' || string_agg(work_id::text, ',' ORDER BY work_id))
+    FROM recorded
+    GROUP BY user_id;
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS purchases_notify ON purchases;
+CREATE TRIGGER purchases_notify
+    AFTER INSERT ON purchases
+    REFERENCING NEW TABLE AS recorded
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION notify_purchases_recorded();
@@ -0,0 +1,12 @@
+-- Staging for buffered view/like events (backend/shared/counters.py).
+-- UNLOGGED: appends write no WAL, and a Postgres crash truncating the
+-- table loses at most one merge interval of counts. Rows are merged into
+-- works.views / works.likes with one set-based UPDATE and deleted.
+CREATE UNLOGGED TABLE IF NOT EXISTS work_counter_deltas (
+    work_id INTEGER NOT NULL,
+    views INTEGER DEFAULT 0 NOT NULL,
+    likes INTEGER DEFAULT 0 NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_work_counter_deltas_work_id ON work_counter_deltas(work_id);
@@ -0,0 +1,53 @@
+-- Compact per-work statistics that leaderboards are ranked from
+-- (backend/shared/leaderboards.py). Sales and author earnings are folded
+-- in from purchases past leaderboard_state.purchase_watermark; views are
+-- added by the counters merge (backend/shared/counters.py).
+CREATE TABLE IF NOT EXISTS work_stats_hourly (
+    work_id INTEGER NOT NULL,
+    bucket_start TIMESTAMP NOT NULL,
+    sales INTEGER DEFAULT 0 NOT NULL,
+    earnings DECIMAL(14, 2) DEFAULT 0 NOT NULL,
+    views BIGINT DEFAULT 0 NOT NULL,
+    PRIMARY KEY (work_id, bucket_start)
+);
+
+CREATE INDEX IF NOT EXISTS idx_work_stats_hourly_bucket ON work_stats_hourly(bucket_start);
+
+CREATE TABLE IF NOT EXISTS work_stats (
+    work_id INTEGER PRIMARY KEY,
+    sales INTEGER DEFAULT 0 NOT NULL,
+    earnings DECIMAL(14, 2) DEFAULT 0 NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS leaderboard_state (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    purchase_watermark INTEGER DEFAULT 0 NOT NULL,
+    refreshed_at TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS leaderboard_entries (
+    board VARCHAR(10) NOT NULL,
+    metric VARCHAR(10) NOT NULL,
+    period VARCHAR(5) NOT NULL,
+    rank INTEGER NOT NULL,
+    subject_id INTEGER NOT NULL,
+    score DECIMAL(14, 2) NOT NULL,
+    PRIMARY KEY (board, metric, period, rank)
+);
+
+INSERT INTO work_stats_hourly (work_id, bucket_start, sales, earnings)
+SELECT p.work_id, date_trunc('hour', p.created_at), COUNT(*), COALESCE(SUM(cs.amount), 0)
+FROM purchases p
+LEFT JOIN commission_splits cs ON cs.transaction_id = p.transaction_id AND cs.recipient_type = 'author'
+GROUP BY 1, 2
+ON CONFLICT (work_id, bucket_start) DO NOTHING;
+
+INSERT INTO work_stats (work_id, sales, earnings)
+SELECT work_id, SUM(sales), SUM(earnings)
+FROM work_stats_hourly
+GROUP BY work_id
+ON CONFLICT (work_id) DO NOTHING;
+
+INSERT INTO leaderboard_state (id, purchase_watermark)
+SELECT 1, COALESCE(MAX(id), 0) FROM purchases
+ON CONFLICT (id) DO NOTHING;
@@ -0,0 +1,22 @@
+-- Checkpoints and progress of subscription renewal runs
+-- (backend/shared/renewals.py). Each chunk advances last_subscription_id
+-- in the same transaction that renews it, so a crashed run resumes
+-- right after the last committed chunk.
+CREATE TABLE IF NOT EXISTS renewal_runs (
+    id SERIAL PRIMARY KEY,
+    horizon TIMESTAMP NOT NULL,
+    status VARCHAR(20) DEFAULT 'running' NOT NULL,
+    last_subscription_id INTEGER DEFAULT 0 NOT NULL,
+    chunks INTEGER DEFAULT 0 NOT NULL,
+    renewed INTEGER DEFAULT 0 NOT NULL,
+    failed INTEGER DEFAULT 0 NOT NULL,
+    amount DECIMAL(14, 2) DEFAULT 0 NOT NULL,
+    started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    finished_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_renewal_runs_running ON renewal_runs(id) WHERE status = 'running';
+
+CREATE INDEX IF NOT EXISTS idx_subscriptions_renewable ON subscriptions(id) INCLUDE (expires_at)
+    WHERE auto_renew AND status IN ('active', 'past_due');
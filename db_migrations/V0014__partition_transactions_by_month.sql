@@ -0,0 +1,156 @@
+-- Range-partition transactions and commission_splits by month on created_at
+-- (backend/shared/partitions.py creates upcoming months and archives old
+-- ones). Splits are written in the same database transaction as their
+-- transaction, so both land in the same month.
+--
+-- Foreign keys pointing at transactions(id) are dropped: a partitioned
+-- table can only be referenced through a key that includes created_at,
+-- and archived months are detached while the purchases and ledger
+-- entries that reference them stay.
+ALTER TABLE commission_splits DROP CONSTRAINT IF EXISTS commission_splits_transaction_id_fkey;
+ALTER TABLE purchases DROP CONSTRAINT IF EXISTS purchases_transaction_id_fkey;
+ALTER TABLE earnings_ledger DROP CONSTRAINT IF EXISTS earnings_ledger_transaction_id_fkey;
+
+ALTER TABLE transactions RENAME TO transactions_unpartitioned;
+ALTER INDEX transactions_pkey RENAME TO transactions_unpartitioned_pkey;
+ALTER TABLE commission_splits RENAME TO commission_splits_unpartitioned;
+ALTER INDEX commission_splits_pkey RENAME TO commission_splits_unpartitioned_pkey;
+ALTER SEQUENCE transactions_id_seq OWNED BY NONE;
+ALTER SEQUENCE commission_splits_id_seq OWNED BY NONE;
+
+CREATE TABLE transactions (
+    id INTEGER DEFAULT nextval('transactions_id_seq') NOT NULL,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    wallet_id INTEGER NOT NULL REFERENCES wallets(id),
+    type VARCHAR(50) NOT NULL,
+    amount DECIMAL(10, 2) NOT NULL,
+    currency VARCHAR(3) DEFAULT 'RUB' NOT NULL,
+    status VARCHAR(50) DEFAULT 'pending' NOT NULL,
+    payment_method VARCHAR(50),
+    description TEXT,
+    metadata JSONB,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE commission_splits (
+    id INTEGER DEFAULT nextval('commission_splits_id_seq') NOT NULL,
+    transaction_id INTEGER NOT NULL,
+    recipient_type VARCHAR(50) NOT NULL,
+    recipient_id INTEGER,
+    amount DECIMAL(10, 2) NOT NULL,
+    percentage DECIMAL(5, 2) NOT NULL,
+    status VARCHAR(50) DEFAULT 'pending' NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+ALTER SEQUENCE transactions_id_seq OWNED BY transactions.id;
+ALTER SEQUENCE commission_splits_id_seq OWNED BY commission_splits.id;
+
+-- Rows for a month without a partition (the maintenance job did not run)
+-- land here instead of failing the payment; ensure_month_partition() moves
+-- them into the month's partition when it is created.
+CREATE TABLE transactions_default PARTITION OF transactions DEFAULT;
+CREATE TABLE commission_splits_default PARTITION OF commission_splits DEFAULT;
+
+CREATE OR REPLACE FUNCTION ensure_month_partition(p_parent TEXT, p_month DATE)
+RETURNS TEXT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_start DATE := date_trunc('month', p_month)::date;
+    v_end DATE := (date_trunc('month', p_month) + interval '1 month')::date;
+    v_name TEXT := p_parent || '_p' || to_char(p_month, 'YYYY_MM');
+    v_default TEXT := p_parent || '_default';
+    v_stray BOOLEAN;
+BEGIN
+    IF to_regclass(v_name) IS NOT NULL THEN
+        RETURN NULL;
+    END IF;
+
+    EXECUTE format('SELECT EXISTS (SELECT 1 FROM %I WHERE created_at >= %L AND created_at < %L)',
+                   v_default, v_start, v_end)
+    INTO v_stray;
+
+    IF v_stray THEN
+        EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', p_parent, v_default);
+        EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                       v_name, p_parent, v_start, v_end);
+        EXECUTE format('WITH moved AS (DELETE FROM %I WHERE created_at >= %L AND created_at < %L RETURNING *)
+                        INSERT INTO %I SELECT * FROM moved',
+                       v_default, v_start, v_end, v_name);
+        EXECUTE format('ALTER TABLE %I ATTACH PARTITION %I DEFAULT', p_parent, v_default);
+    ELSE
+        EXECUTE format('CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                       v_name, p_parent, v_start, v_end);
+    END IF;
+    RETURN v_name;
+END;
+$$;
+
+SELECT ensure_month_partition(p.parent, m.month::date)
+FROM (VALUES ('transactions'), ('commission_splits')) AS p(parent)
+CROSS JOIN generate_series(
+    date_trunc('month', LEAST(
+        (SELECT MIN(created_at) FROM transactions_unpartitioned),
+        (SELECT MIN(created_at) FROM commission_splits_unpartitioned),
+        LOCALTIMESTAMP
+    )),
+    date_trunc('month', LOCALTIMESTAMP) + interval '3 months',
+    interval '1 month'
+) AS m(month);
+
+INSERT INTO transactions
+    (id, user_id, wallet_id, type, amount, currency, status, payment_method, description, metadata,
+     created_at, updated_at)
+SELECT id, user_id, wallet_id, type, amount, currency, status, payment_method, description, metadata,
+       COALESCE(created_at, updated_at, LOCALTIMESTAMP), updated_at
+FROM transactions_unpartitioned;
+
+INSERT INTO commission_splits
+    (id, transaction_id, recipient_type, recipient_id, amount, percentage, status, created_at)
+SELECT cs.id, cs.transaction_id, cs.recipient_type, cs.recipient_id, cs.amount, cs.percentage, cs.status,
+       COALESCE(cs.created_at, t.created_at, LOCALTIMESTAMP)
+FROM commission_splits_unpartitioned cs
+LEFT JOIN transactions_unpartitioned t ON t.id = cs.transaction_id;
+
+DROP TABLE commission_splits_unpartitioned;
+DROP TABLE transactions_unpartitioned;
+
+-- idx_transactions_user_id is not recreated: idx_transactions_user_created
+-- (V0005) starts with user_id and serves the same lookups.
+CREATE INDEX IF NOT EXISTS idx_transactions_user_created ON transactions(user_id, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_transactions_status ON transactions(status);
+CREATE INDEX IF NOT EXISTS idx_transactions_withdrawal_id ON transactions(((metadata->>'withdrawal_id')::int))
+    WHERE type = 'withdrawal';
+CREATE INDEX IF NOT EXISTS idx_transactions_created_brin ON transactions USING brin (created_at);
+
+CREATE INDEX IF NOT EXISTS idx_commission_splits_transaction_id ON commission_splits(transaction_id);
+CREATE INDEX IF NOT EXISTS idx_commission_splits_recipient ON commission_splits(recipient_type, recipient_id);
+CREATE INDEX IF NOT EXISTS idx_commission_splits_created_brin ON commission_splits USING brin (created_at);
+
+-- Months detached by shared.partitions.archive(), and what is exported.
+CREATE TABLE IF NOT EXISTS partition_archives (
+    partition VARCHAR(63) PRIMARY KEY,
+    parent VARCHAR(63) NOT NULL,
+    month DATE NOT NULL,
+    status VARCHAR(20) DEFAULT 'detached' NOT NULL,
+    row_count BIGINT NOT NULL,
+    file_path TEXT,
+    file_bytes BIGINT,
+    detached_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+    archived_at TIMESTAMP
+);
+
+-- Per-user totals of archived months, folded in when they are detached,
+-- so wallet summaries and reconciliation still account for them.
+CREATE TABLE IF NOT EXISTS archived_totals (
+    user_id INTEGER PRIMARY KEY REFERENCES users(id),
+    earned DECIMAL(14, 2) DEFAULT 0 NOT NULL,
+    last_earned_at TIMESTAMP,
+    credited DECIMAL(14, 2) DEFAULT 0 NOT NULL,
+    subscriptions DECIMAL(14, 2) DEFAULT 0 NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+);
@@ -0,0 +1,7 @@
+-- Every notifying commit takes the cluster-wide notify queue lock, which
+-- serialized all purchase commits, and idle instances stopped draining
+-- the queue. The payment handler now updates its entitlement cache after
+-- commit and other instances re-check works missing from their cache
+-- (backend/shared/entitlements.py).
+DROP TRIGGER IF EXISTS purchases_notify ON purchases;
+DROP FUNCTION IF EXISTS notify_purchases_recorded();
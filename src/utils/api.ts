@@ -14,8 +14,29 @@ const DEFAULT_TIMEOUT = 10000;
 const DEFAULT_RETRIES = 3;
 const DEFAULT_RETRY_DELAY = 1000;
 
+// Reads may be served by a lagging read replica. Write responses carry
+// X-Write-Timestamp; echoing it on later reads sends them to the primary
+// until the replica has caught up, whichever backend instance they reach.
+const WRITE_TIMESTAMP_HEADER = 'X-Write-Timestamp';
+const WRITE_TIMESTAMP_TTL = 60000;
+let lastWrite: { timestamp: string; storedAt: number } | null = null;
+
+function rememberWrite(response: Response) {
+  const timestamp = response.headers.get(WRITE_TIMESTAMP_HEADER);
+  if (timestamp && (!lastWrite || Number(timestamp) > Number(lastWrite.timestamp))) {
+    lastWrite = { timestamp, storedAt: Date.now() };
+  }
+}
+
+function readYourWritesHeaders(): Record<string, string> {
+  if (!lastWrite || Date.now() - lastWrite.storedAt > WRITE_TIMESTAMP_TTL) {
+    return {};
+  }
+  return { [WRITE_TIMESTAMP_HEADER]: lastWrite.timestamp };
+}
+
 class ApiError extends Error {
-  constructor(public status: number, message: string) {
+  constructor(public status: number, message: string, public retryAfter: number | null = null) {
     super(message);
     this.name = 'ApiError';
   }
@@ -55,6 +76,11 @@ export async function apiRequest<T = any>(
   } = options;
 
   let lastError: Error | null = null;
+
+  // One key for every attempt, so a retried POST is replayed, not re-executed.
+  const idempotencyHeaders: Record<string, string> =
+    fetchOptions.method === 'POST' ? { 'Idempotency-Key': crypto.randomUUID() } : {};
+  const isRead = !fetchOptions.method || fetchOptions.method === 'GET';
   
   for (let attempt = 0; attempt <= retries; attempt++) {
     try {
@@ -63,18 +89,30 @@ export async function apiRequest<T = any>(
         timeout,
         headers: {
           'Content-Type': 'application/json',
+          ...idempotencyHeaders,
+          ...(isRead ? readYourWritesHeaders() : {}),
           ...fetchOptions.headers
         }
       });
 
       if (!response.ok) {
         let errorMessage = `HTTP ${response.status}`;
+        let retryAfter: number | null = null;
         try {
           const errorData = await response.json();
           errorMessage = errorData.error || errorData.message || errorMessage;
+          retryAfter = errorData.retry_after ?? null;
         } catch {
         }
-        throw new ApiError(response.status, errorMessage);
+        const retryAfterHeader = Number(response.headers.get('Retry-After'));
+        if (retryAfterHeader > 0) {
+          retryAfter = retryAfterHeader;
+        }
+        throw new ApiError(response.status, errorMessage, response.status === 409 ? retryAfter : null);
+      }
+
+      if (!isRead) {
+        rememberWrite(response);
       }
 
       const contentType = response.headers.get('content-type');
@@ -89,6 +127,13 @@ export async function apiRequest<T = any>(
     } catch (error) {
       lastError = error as Error;
 
+      // A 409 with Retry-After means the first attempt with this
+      // Idempotency-Key is still running; retrying replays its result.
+      if (error instanceof ApiError && error.retryAfter !== null && attempt < retries) {
+        await delay(error.retryAfter * 1000);
+        continue;
+      }
+
       if (error instanceof ApiError && error.status >= 400 && error.status < 500) {
         return {
           error: error.message,